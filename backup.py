@@ -0,0 +1,547 @@
+"""
+Streaming backup and restore of the database trees
+
+Each tree is paged through by key and written as gzip-compressed JSON
+Lines ({"path": ..., "value": ...}, one record per line) next to a
+manifest.json. The manifest is checkpointed every page with the last key
+written, so an interrupted export resumes where it stopped. Only one page
+of records is held in memory at a time, whatever the size of the data.
+
+A backup chain (chain.json) is one full backup followed by deltas that
+hold only what changed since the previous run.
+"""
+
+import gzip
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import database
+from database import (
+    WriteBatch, day_bucket, get, id_floor, is_bucket, list_keys, query, query_page, rebuild_user_indexes,
+    user_cache
+)
+from rtdb_tree import key_rank
+
+PAGE_SIZE = 500
+MANIFEST = "manifest.json"
+CHAIN = "chain.json"
+FORMAT = 1
+
+# Tree -> depth of its records (0: the whole tree is one record,
+# 2: records sit one level further down, e.g. admin_logs/{day}/{id})
+TREES = {
+    "users": 1,
+    "payment_requests": 1,
+    "vpn_tokens": 1,
+    "pending_tokens": 1,
+    "user_payments": 2,
+    "user_tokens": 2,
+    "ledger": 2,
+    "ledger_snapshots": 2,
+    "vip_expiry": 1,
+    "username_index": 1,
+    "search_index": 1,
+    "broadcasts": 1,
+    "admin_logs": 2,
+    "user_activity": 2,
+    "notifications": 2,
+    "user_activity_days": 2,
+    "notifications_days": 2,
+    "stats": 0,
+}
+
+# Per-user subtrees for export_user (users/{uid} itself is depth 0)
+USER_TREES = {
+    "users": 0,
+    "user_payments": 1,
+    "user_tokens": 1,
+    "ledger": 1,
+    "ledger_snapshots": 1,
+    "user_activity": 1,
+    "notifications": 1,
+}
+
+
+# ========================
+# READING TREES
+# ========================
+def iter_records(path, depth, after=(), page_size=PAGE_SIZE):
+    """Yield (keys, value) for the records depth levels below path, in key order
+
+    after is the keys of the last record already seen; iteration starts
+    just past it.
+    """
+    if depth == 0:
+        if not after:
+            value = get(path)
+            if value is not None:
+                yield (), value
+        return
+
+    if depth == 1:
+        cursor = after[0] if after else None
+        while True:
+            page = query_page(path, "$key", limit=page_size, cursor=cursor)
+            for key, value in page["items"].items():
+                yield (key,), value
+
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    # Parents are listed shallow (keys only), then paged one by one
+    for key in list_keys(path):
+        if after and key_rank(key) < key_rank(after[0]):
+            continue
+        rest = after[1:] if after and key == after[0] else ()
+        for keys, value in iter_records(f"{path}/{key}", depth - 1, rest, page_size):
+            yield (key, *keys), value
+
+
+def with_cursor(records):
+    """(keys, value) -> (keys, value, cursor) for records whose cursor is their keys"""
+    for keys, value in records:
+        yield keys, value, list(keys)
+
+
+@contextmanager
+def database_at(location):
+    """Point database calls at another backend or Firebase URL (single-threaded tools only)"""
+    previous = database.backend
+    database.backend = database.open_backend(location)
+    try:
+        yield
+    finally:
+        database.backend = previous
+
+
+# ========================
+# FULL BACKUPS
+# ========================
+def read_json(path):
+    """Parsed JSON file, or None if it doesn't exist"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path, data):
+    """Replace a JSON file atomically (a crash never leaves half a file)"""
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def read_manifest(directory):
+    """The backup's manifest, or None if directory has none"""
+    return read_json(os.path.join(directory, MANIFEST))
+
+
+def write_manifest(directory, manifest):
+    write_json(os.path.join(directory, MANIFEST), manifest)
+
+
+def export_records(directory, manifest, prefix, records, state, page_size=PAGE_SIZE):
+    """Write (keys, value, cursor) records to a new part file, checkpointing every page
+
+    A resumed export starts a new part file; lines after the last
+    checkpoint of an interrupted part are ignored on import.
+    """
+    part = {"file": f"{prefix.replace('/', '.')}.{len(state['parts']):03d}.jsonl.gz", "records": 0}
+    state["parts"].append(part)
+
+    with gzip.open(os.path.join(directory, part["file"]), "wt", encoding="utf-8") as out:
+        for keys, value, cursor in records:
+            out.write(json.dumps({"path": "/".join(keys), "value": value},
+                                 ensure_ascii=False, separators=(",", ":")) + "\n")
+            part["records"] += 1
+            state["records"] += 1
+            state["cursor"] = cursor
+
+            if part["records"] % page_size == 0:
+                out.flush()
+                write_manifest(directory, manifest)
+
+    state["status"] = "done"
+    write_manifest(directory, manifest)
+
+
+def run_plan(directory, manifest, plan, page_size=PAGE_SIZE):
+    """Export each (section, name, depth, records_from) step not done yet
+
+    records_from(cursor) yields (keys, value, cursor) starting past cursor.
+    """
+    for section, name, depth, records_from in plan:
+        state = manifest[section].setdefault(name, {
+            "depth": depth, "status": "running", "records": 0, "cursor": None, "parts": []
+        })
+        if state["status"] == "done":
+            continue
+
+        prefix = name if section == "trees" else f"{name}.{section}"
+        export_records(directory, manifest, prefix, records_from(state["cursor"]), state, page_size)
+
+    manifest["finished"] = int(time.time())
+    write_manifest(directory, manifest)
+    return manifest
+
+
+def start_manifest(directory, **header):
+    """Unfinished manifest in directory to resume, or a new one"""
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    if manifest is None or manifest.get("finished"):
+        manifest = {"format": FORMAT, "kind": "full", "created": int(time.time()), "finished": None,
+                    **header, "trees": {}, "keys": {}}
+    return manifest
+
+
+def export_trees(directory, trees=None, page_size=PAGE_SIZE, **header):
+    """Export trees (path -> depth) into directory, resuming an unfinished export there
+
+    Returns the manifest.
+    """
+    trees = TREES if trees is None else trees
+    manifest = start_manifest(directory, **header)
+
+    plan = []
+    for path, depth in trees.items():
+        def records_from(cursor, path=path, depth=depth):
+            return with_cursor(iter_records(path, depth, tuple(cursor or ()), page_size))
+        plan.append(("trees", path, depth, records_from))
+
+    return run_plan(directory, manifest, plan, page_size)
+
+
+def export_user(directory, user_id, page_size=PAGE_SIZE):
+    """Export one user's records (profile, payments, tokens, ledger, logs) into directory"""
+    trees = {f"{name}/{user_id}": depth for name, depth in USER_TREES.items()}
+    return export_trees(directory, trees, page_size, kind="user", user_id=str(user_id))
+
+
+# ========================
+# RESTORE
+# ========================
+def read_part(directory, part):
+    """Yield the checkpointed records of one part file"""
+    if not part["records"]:
+        return
+
+    with gzip.open(os.path.join(directory, part["file"]), "rt", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            yield json.loads(line)
+            if number == part["records"]:
+                return
+
+
+def read_records(directory, manifest=None, trees=None, section="trees"):
+    """Yield (tree, record) for every record in a backup, in export order"""
+    manifest = manifest or read_manifest(directory)
+    if manifest is None:
+        raise FileNotFoundError(os.path.join(directory, MANIFEST))
+
+    for name, state in manifest.get(section, {}).items():
+        if trees is not None and name not in trees:
+            continue
+        for part in state["parts"]:
+            for record in read_part(directory, part):
+                yield name, record
+
+
+def import_backup(directory, trees=None, chunk_size=PAGE_SIZE):
+    """Restore a backup into the database, chunk_size records per write
+
+    Records are written with set, so an interrupted restore can simply be
+    run again. Returns records written per tree.
+    """
+    counts = {}
+    batch = WriteBatch()
+
+    for name, record in read_records(directory, trees=trees):
+        path = f"{name}/{record['path']}" if record["path"] else name
+        batch.set(path, record["value"])
+        counts[name] = counts.get(name, 0) + 1
+        if len(batch) >= chunk_size:
+            batch.commit()
+
+    batch.commit()
+    user_cache.clear()
+    return counts
+
+
+# ========================
+# INCREMENTAL BACKUPS
+# ========================
+# Writers stamp "updated" with their own clocks, so deltas overlap by this much
+CLOCK_SKEW = 300
+
+# Changed records are found through their indexed "updated" stamp
+UPDATED_TREES = ("users", "payment_requests", "vpn_tokens", "pending_tokens")
+
+# Per-user trees, read only for users whose records changed
+# (True: append-only with time-ordered ids, so only new ids are read)
+USER_KEYED_TREES = {"user_payments": False, "user_tokens": False, "ledger": True, "ledger_snapshots": True,
+                    "user_activity": True, "notifications": False}
+
+# Day-bucketed logs: buckets from the previous run's day on are copied again
+BUCKETED_TREES = {"admin_logs": 2, "user_activity_days": 2, "notifications_days": 2}
+
+# Small trees copied whole every time (the derived username/search
+# indexes are left out; restoring a chain rebuilds them)
+WHOLE_TREES = {"broadcasts": 1, "vip_expiry": 1, "stats": 0}
+
+
+def iter_changed(path, since, cursor=None, page_size=PAGE_SIZE):
+    """Yield (keys, value, cursor) for children of path with updated >= since, oldest change first
+
+    Stamps are not unique, so the cursor is the last stamp seen plus the
+    keys already returned with that stamp.
+    """
+    value_from = cursor["updated"] if cursor else since
+    seen = set(cursor["keys"]) if cursor else set()
+
+    while True:
+        limit = page_size + len(seen)
+        results = query(path, "updated", start_at=value_from, limit_to_first=limit)
+
+        for key, value in results.items():
+            if key in seen:
+                continue
+            if value.get("updated") != value_from:
+                value_from, seen = value.get("updated"), set()
+            seen.add(key)
+            yield (key,), value, {"updated": value_from, "keys": sorted(seen)}
+
+        if len(results) < limit:
+            return
+
+
+def iter_user_records(name, user_ids, since=None, cursor=None, page_size=PAGE_SIZE):
+    """Yield (keys, value, cursor) from name/{uid} for each of user_ids (ids from since only)"""
+    start_at = id_floor(since * 1000) if since else None
+
+    for user_id in user_ids:
+        if cursor and key_rank(user_id) < key_rank(cursor[0]):
+            continue
+        page_cursor = cursor[1] if cursor and user_id == cursor[0] else None
+
+        while True:
+            page = query_page(f"{name}/{user_id}", "$key", start_at=start_at, limit=page_size,
+                              cursor=page_cursor)
+            for key, value in page["items"].items():
+                yield (user_id, key), value, [user_id, key]
+
+            page_cursor = page["next_cursor"]
+            if page_cursor is None:
+                break
+
+
+def iter_buckets(path, depth, since, cursor=None, page_size=PAGE_SIZE):
+    """Yield (keys, value, cursor) from the day buckets of path from since's day on"""
+    first = day_bucket(since)
+
+    for bucket in list_keys(path):
+        if not is_bucket(bucket) or bucket < first or (cursor and bucket < cursor[0]):
+            continue
+        rest = tuple(cursor[1:]) if cursor and bucket == cursor[0] else ()
+        for keys, value in iter_records(f"{path}/{bucket}", depth - 1, rest, page_size):
+            yield (bucket, *keys), value, [bucket, *keys]
+
+
+def iter_keys(path, cursor=None):
+    """Yield ((key,), None, cursor) for the current child keys of path"""
+    for key in list_keys(path):
+        if cursor and key_rank(key) <= key_rank(cursor[0]):
+            continue
+        yield (key,), None, [key]
+
+
+def export_delta(directory, since, page_size=PAGE_SIZE):
+    """Export what changed since timestamp since into directory, resuming an unfinished run
+
+    Besides changed records, the current keys of each tree are saved so a
+    restore can drop records deleted since the previous backup.
+    """
+    manifest = start_manifest(directory, kind="delta", since=since)
+    touched = manifest.setdefault("touched_users", {})
+    since = since - CLOCK_SKEW
+
+    def tap(name, records):
+        # Users whose records changed: their per-user trees go in the delta too
+        for keys, value, cursor in records:
+            user_id = keys[0] if name == "users" else (value or {}).get("user_id")
+            if user_id:
+                touched[str(user_id)] = True
+            yield keys, value, cursor
+
+    plan = []
+    for name in UPDATED_TREES:
+        plan.append(("trees", name, 1, lambda cursor, name=name:
+                     tap(name, iter_changed(name, since, cursor, page_size))))
+        plan.append(("keys", name, 1, lambda cursor, name=name: iter_keys(name, cursor)))
+
+    for name, append_only in USER_KEYED_TREES.items():
+        def records_from(cursor, name=name, append_only=append_only):
+            user_ids = sorted(touched, key=key_rank)
+            return iter_user_records(name, user_ids, since if append_only else None, cursor, page_size)
+        plan.append(("trees", name, 2, records_from))
+
+    for name, depth in BUCKETED_TREES.items():
+        plan.append(("trees", name, depth, lambda cursor, name=name, depth=depth:
+                     iter_buckets(name, depth, since, cursor, page_size)))
+        plan.append(("keys", name, 1, lambda cursor, name=name: iter_keys(name, cursor)))
+
+    for name, depth in WHOLE_TREES.items():
+        plan.append(("trees", name, depth, lambda cursor, name=name, depth=depth:
+                     with_cursor(iter_records(name, depth, tuple(cursor or ()), page_size))))
+        if depth == 1:
+            plan.append(("keys", name, 1, lambda cursor, name=name: iter_keys(name, cursor)))
+
+    return run_plan(directory, manifest, plan, page_size)
+
+
+def prune_deleted(directory, manifest=None, chunk_size=PAGE_SIZE):
+    """Delete records whose keys were gone when the delta was taken, returns deletes per tree"""
+    manifest = manifest or read_manifest(directory)
+    deleted = {}
+
+    for name in manifest.get("keys", {}):
+        kept = {record["path"] for _, record in read_records(directory, manifest, [name], "keys")}
+        batch = WriteBatch()
+        for key in list_keys(name):
+            if key not in kept:
+                batch.delete(f"{name}/{key}")
+                deleted[name] = deleted.get(name, 0) + 1
+                if len(batch) >= chunk_size:
+                    batch.commit()
+        batch.commit()
+
+    return deleted
+
+
+# ========================
+# BACKUP CHAINS
+# ========================
+def read_chain(root):
+    return read_json(os.path.join(root, CHAIN)) or {"format": FORMAT, "backups": []}
+
+
+def backup_chain(root, full=False, page_size=PAGE_SIZE):
+    """Add a backup to the chain in root: full if asked (or first), else a delta
+
+    A delta covers the changes since the previous backup started (its high
+    water mark). An unfinished backup is resumed instead. Returns the chain
+    entry and the manifest.
+    """
+    os.makedirs(root, exist_ok=True)
+    chain = read_chain(root)
+    backups = chain["backups"]
+
+    if backups and not backups[-1]["finished"]:
+        entry = backups[-1]
+    else:
+        kind = "full" if full or not backups else "delta"
+        entry = {
+            "directory": f"{len(backups):03d}-{kind}",
+            "kind": kind,
+            "since": backups[-1]["until"] if kind == "delta" else None,
+            "until": int(time.time()),
+            "finished": None
+        }
+        backups.append(entry)
+        write_json(os.path.join(root, CHAIN), chain)
+
+    directory = os.path.join(root, entry["directory"])
+    if entry["kind"] == "full":
+        manifest = export_trees(directory, page_size=page_size)
+    else:
+        manifest = export_delta(directory, entry["since"], page_size)
+
+    entry["finished"] = int(time.time())
+    write_json(os.path.join(root, CHAIN), chain)
+    return entry, manifest
+
+
+def restore_chain(root, chunk_size=PAGE_SIZE):
+    """Restore the newest full backup in root and every finished delta after it
+
+    Returns a summary per backup applied.
+    """
+    backups = [entry for entry in read_chain(root)["backups"] if entry["finished"]]
+    fulls = [number for number, entry in enumerate(backups) if entry["kind"] == "full"]
+    if not fulls:
+        raise FileNotFoundError(f"no finished full backup in {root}")
+
+    summary = []
+    for entry in backups[fulls[-1]:]:
+        directory = os.path.join(root, entry["directory"])
+        restored = import_backup(directory, chunk_size=chunk_size)
+        deleted = prune_deleted(directory, chunk_size=chunk_size) if entry["kind"] == "delta" else {}
+        summary.append({"directory": entry["directory"], "restored": restored, "deleted": deleted})
+
+    if len(backups) > fulls[-1] + 1:
+        rebuild_user_indexes()
+
+    return summary
+
+
+# ========================
+# VERIFY
+# ========================
+def records_at(location, path, depth, page_size=PAGE_SIZE):
+    """iter_records against the database at location (a backend or Firebase URL)"""
+    records = iter_records(path, depth, page_size=page_size)
+    while True:
+        with database_at(location):
+            item = next(records, None)
+        if item is None:
+            return
+        yield item
+
+
+def verify(source_db, copy_db, trees=None, page_size=PAGE_SIZE, examples=10):
+    """Diff a restored copy against the source database, streaming both in key order
+
+    source_db and copy_db are backends or specs for database.open_backend
+    (e.g. a Firebase URL or "sqlite:PATH"). Returns {tree: {"missing",
+    "extra", "different", "examples"}} for the trees that differ.
+    """
+    trees = TREES if trees is None else trees
+    source_db, copy_db = database.open_backend(source_db), database.open_backend(copy_db)
+    report = {}
+
+    for name, depth in trees.items():
+        diff = {"missing": 0, "extra": 0, "different": 0, "examples": []}
+        source = records_at(source_db, name, depth, page_size)
+        copy = records_at(copy_db, name, depth, page_size)
+        left, right = next(source, None), next(copy, None)
+
+        while left is not None or right is not None:
+            left_order = tuple(map(key_rank, left[0])) if left else None
+            right_order = tuple(map(key_rank, right[0])) if right else None
+
+            if right is None or (left is not None and left_order < right_order):
+                kind, keys = "missing", left[0]
+                left = next(source, None)
+            elif left is None or right_order < left_order:
+                kind, keys = "extra", right[0]
+                right = next(copy, None)
+            else:
+                kind, keys = ("different" if left[1] != right[1] else None), left[0]
+                left, right = next(source, None), next(copy, None)
+
+            if kind:
+                diff[kind] += 1
+                if len(diff["examples"]) < examples:
+                    diff["examples"].append({"type": kind, "path": "/".join((name, *keys))})
+
+        if diff["missing"] or diff["extra"] or diff["different"]:
+            report[name] = diff
+
+    return report
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Benchmark peak memory of backups as the dataset grows
+
+Fills a local fake RTDB with synthetic users, payments and admin logs and
+compares export_all_data (everything in one dict) with the streaming
+exporter in backup.py, then restores the backup into an empty database
+and checks it matches.
+"""
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import backup
+import database
+from fake_rtdb import FakeRTDB
+
+
+def synthetic_data(users):
+    now = int(time.time())
+    data = {"users": {}, "payment_requests": {}, "admin_logs": {}}
+    for number in range(users):
+        user_id = str(8000000000 + number)
+        data["users"][user_id] = {"name": f"User {number}", "username": f"user{number}", "credits": number % 500,
+                                  "vip": False, "expiry": 0, "created_at": now, "last_active": now}
+        payment_id = f"p{number:09d}"
+        data["payment_requests"][payment_id] = {"user_id": user_id, "amount": 50, "payment_method": "kpay",
+                                                "status": "approved", "created": now, "payment_id": payment_id,
+                                                "proof": "x" * 200}
+        day = f"2026-10-{number % 28 + 1:02d}"
+        data["admin_logs"].setdefault(day, {})[f"l{number:09d}"] = {"action": "approve_payment",
+                                                                   "user_id": user_id, "timestamp": now}
+    return data
+
+
+def serve(data, urls):
+    """Run the fake RTDB in its own process, so its memory isn't traced here"""
+    urls.put(FakeRTDB(data).start().url)
+    while True:
+        time.sleep(3600)
+
+
+def peak_memory(function):
+    """(result, peak traced memory in MB) of one call"""
+    tracemalloc.start()
+    try:
+        result = function()
+        return result, tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,5000,20000", help="users per run")
+    parser.add_argument("--page-size", type=int, default=backup.PAGE_SIZE)
+    args = parser.parse_args()
+
+    trees = {"users": 1, "payment_requests": 1, "vpn_tokens": 1, "pending_tokens": 1, "admin_logs": 2}
+    print(f"{'users':>8} {'export_all_data':>16} {'streaming':>10} {'archive':>10} {'export':>8} {'restore':>8}")
+
+    for users in map(int, args.sizes.split(",")):
+        data = synthetic_data(users)
+        urls = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(data, urls), daemon=True)
+        server.start()
+        database.FIREBASE_DB = urls.get()
+        directory = tempfile.mkdtemp(prefix="backup-")
+
+        _, in_memory = peak_memory(database.export_all_data)
+
+        start = time.perf_counter()
+        _, streaming = peak_memory(lambda: backup.export_trees(directory, trees, page_size=args.page_size))
+        export_time = time.perf_counter() - start
+        archive = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+        database.delete("")
+        start = time.perf_counter()
+        backup.import_backup(directory, chunk_size=args.page_size)
+        restore_time = time.perf_counter() - start
+
+        ok = "✅" if database.get("") == data else "❌"
+        print(f"{users:>8,} {in_memory:>13.1f} MB {streaming:>7.1f} MB {archive / 1024 / 1024:>7.1f} MB "
+              f"{export_time:>7.1f}s {restore_time:>7.1f}s {ok}")
+
+        shutil.rmtree(directory)
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
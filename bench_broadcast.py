@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Broadcast dry run against local fake RTDB and Bot API servers
+
+Sends a broadcast to synthetic users, interrupts it half way as a crash
+would, resumes it from the checkpoint and checks every recipient got
+the message once (give or take the page that was in flight). Then checks
+that a VIP broadcast reads only the VIP expiry index, that a cancel while
+the last page goes out is not overwritten by "done", and that sends
+outliving the send timeout count as failed.
+"""
+
+import argparse
+import time
+from collections import Counter
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+import database
+from broadcast import BroadcastRunner, cancel_broadcast
+from fake_rtdb import FakeRTDB
+from fake_telegram import FakeTelegram
+from sender import SendScheduler
+
+
+def synthetic_users(count, blocked_every):
+    """(users, blocked user ids, vip_expiry index); every 3rd user is VIP, every 30th has just expired"""
+    users, index = {}, {}
+    now = int(time.time())
+    for number in range(count):
+        user_id = str(5000000000 + number)
+        vip = number % 3 == 0
+        expiry = now - 60 if number % 30 == 0 else now + 86400 + number
+        users[user_id] = {"name": f"User {number}", "credits": 0, "vip": vip, "expiry": expiry}
+        if vip:
+            index[database.expiry_key(expiry, user_id)] = {"user_id": user_id, "expiry": expiry}
+    blocked = [user_id for number, user_id in enumerate(users) if blocked_every and number % blocked_every == 0]
+    return users, blocked, index
+
+
+def check(label, ok, failures):
+    print(f"   {'✅' if ok else '❌'} {label}")
+    if not ok:
+        failures.append(label)
+
+
+def received_text(telegram, text):
+    return Counter(str(message["chat_id"]) for message in telegram.messages if message.get("text") == text)
+
+
+def check_vip(outbox, telegram, rtdb, users, blocked, page_size, failures):
+    """A VIP broadcast pages over vip_expiry and reaches exactly the current VIPs"""
+    now = time.time()
+    vips = {user_id for user_id, user_data in users.items() if user_data["vip"] and user_data["expiry"] > now}
+    text = "📣 VIP broadcast"
+    broadcast_id = database.create_broadcast(1, text, audience="vip")
+
+    before = rtdb.stats["requests"]
+    runner = BroadcastRunner(outbox, broadcast_id, page_size=page_size)
+    runner.run()
+    requests = rtdb.stats["requests"] - before
+
+    received = received_text(telegram, text)
+    reached = set(received) | (vips & set(blocked))
+    # A page read and a checkpoint per page
+    pages = -(-len(vips) // page_size)
+    check(f"VIP broadcast reached {len(received):,} of {len(vips):,} current VIPs in {requests} RTDB "
+          f"requests (a users scan reads {-(-len(users) // page_size)} pages)",
+          reached == vips and max(received.values(), default=1) == 1 and requests <= 2 * pages + 4, failures)
+
+
+def check_cancel(outbox, failures):
+    """Cancelling while the last page is out leaves the broadcast cancelled"""
+    broadcast_id = database.create_broadcast(1, "📣 Cancelled broadcast", audience="vip")
+    runner = BroadcastRunner(outbox, broadcast_id, page_size=10 ** 6)
+    runner.start()
+    while runner.thread.is_alive() and (runner.data is None or not outbox.pending):
+        time.sleep(0.01)
+    cancel_broadcast(broadcast_id)
+    runner.thread.join()
+
+    status = database.get_broadcast(broadcast_id)["status"]
+    check(f"cancel during the last page: status {status!r}", status == "cancelled", failures)
+
+
+def check_timeout(outbox, failures):
+    """Sends still queued when the send timeout runs out count as failed, without waiting for them"""
+    broadcast_id = database.create_broadcast(1, "📣 Timed out broadcast", audience="vip")
+    runner = BroadcastRunner(outbox, broadcast_id, page_size=10 ** 6, send_timeout=0.2)
+    start = time.perf_counter()
+    runner.run()
+    elapsed = time.perf_counter() - start
+
+    summary = runner.summary()
+    check(f"send timeout: {summary['failed']:,} sends counted failed after {elapsed:.1f}s, status "
+          f"{runner.data['status']!r}", summary["failed"] > 0 and runner.data["status"] == "done", failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--rate", type=int, default=500,
+                        help="global sends per second (Telegram's real limit is ~30)")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--blocked-every", type=int, default=50, help="every Nth user has blocked the bot")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated Bot API latency (s)")
+    args = parser.parse_args()
+
+    users, blocked, index = synthetic_users(args.users, args.blocked_every)
+    counters = {"total_users": len(users), "vip_users": len(index)}
+    rtdb = FakeRTDB({"users": users, "vip_expiry": index, "stats": {"counters": counters}}).start()
+    telegram = FakeTelegram(latency=args.latency, global_rate=args.rate, blocked=blocked).start()
+    database.FIREBASE_DB = rtdb.url
+
+    bot = Bot("123:fake", base_url=telegram.base_url, request=Request(con_pool_size=32))
+    outbox = SendScheduler(bot, global_rate=args.rate, workers=32).start()
+    broadcast_id = database.create_broadcast(1, "📣 Test broadcast")
+    print(f"📣 {args.users:,} users ({len(blocked):,} blocked), {args.rate}/s global limit")
+
+    # First run: "crash" half way
+    runner = BroadcastRunner(outbox, broadcast_id, page_size=args.page_size)
+    runner.start()
+    while runner.summary()["done"] < args.users // 2:
+        time.sleep(0.05)
+    runner.stop()
+    runner.thread.join()
+    checkpoint = database.get_broadcast(broadcast_id)
+    print(f"💥 interrupted at {progress_line(runner.summary())}, checkpoint cursor {checkpoint['cursor']}")
+
+    # Second run: resume from the checkpoint
+    reports = []
+    start = time.perf_counter()
+    runner = BroadcastRunner(outbox, broadcast_id, page_size=args.page_size, progress_every=1,
+                             on_progress=lambda _id, summary, finished: reports.append(summary))
+    runner.run()
+    elapsed = time.perf_counter() - start
+
+    for summary in reports[:-1]:
+        print(f"   … {progress_line(summary)}")
+    final = database.get_broadcast(broadcast_id)
+    print(f"🏁 {final['status']}: {progress_line(runner.summary())}")
+    print(f"   resumed run {elapsed:.1f}s, {runner.rate:.0f} msg/s, 429s from API: {telegram.stats['rate_limited']}")
+
+    received = Counter(str(message["chat_id"]) for message in telegram.messages)
+    missing = [user_id for user_id in users if user_id not in received and user_id not in blocked]
+    duplicates = sum(count - 1 for count in received.values() if count > 1)
+    failures = []
+    check(f"missing {len(missing)}, duplicates {duplicates} (at most one page: {args.page_size})",
+          not missing and duplicates <= args.page_size, failures)
+
+    check_vip(outbox, telegram, rtdb, users, blocked, args.page_size, failures)
+    check_cancel(outbox, failures)
+    check_timeout(outbox, failures)
+
+    per_second = 25
+    print(f"\n⏱️ 100,000 recipients at {per_second}/s ≈ {100000 / per_second / 60:.0f} min, "
+          f"{args.page_size} users held in memory at a time")
+
+    outbox.stop()
+    telegram.stop()
+    rtdb.stop()
+    for failure in failures:
+        print(f"❌ {failure}")
+    raise SystemExit(1 if failures else 0)
+
+
+def progress_line(summary):
+    return (f"{summary['done']:,}/{summary['total']:,} ({summary['percent']}%) "
+            f"sent {summary['sent']:,} blocked {summary['blocked']:,} failed {summary['failed']:,}"
+            + (f" eta {summary['eta_seconds']}s" if "eta_seconds" in summary else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Stress test concurrent balance changes against a local fake RTDB
+
+Several processes (separate in-process locks, so only ETag/If-Match
+protects them) with many threads each fire VIP purchases and credit
+top-ups at a few hot users, then check every credit is accounted for and
+has its ledger entry.
+The old read-then-write purchase runs the same load for comparison.
+"""
+
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+
+import database
+from fake_rtdb import FakeRTDB
+
+PRICE = 50
+DAYS = 30
+TOP_UP = 50
+
+
+def legacy_purchase(user_id):
+    """Old bot flow: read credits, then add_vip and cut_credits as separate writes"""
+    credits = int(database.get(f"users/{user_id}/credits") or 0)
+    if credits < PRICE:
+        return False
+    expiry = int(database.get(f"users/{user_id}/expiry") or 0)
+    database.update(f"users/{user_id}", {"vip": True, "expiry": max(int(time.time()), expiry) + DAYS * 86400})
+    database.set(f"users/{user_id}/credits", credits - PRICE)
+    return True
+
+
+def legacy_top_up(user_id):
+    credits = int(database.get(f"users/{user_id}/credits") or 0)
+    database.set(f"users/{user_id}/credits", credits + TOP_UP)
+
+
+def safe_purchase(user_id):
+    return database.purchase_vip(user_id, DAYS, PRICE)["success"]
+
+
+def safe_top_up(user_id):
+    database.add_credits(user_id, TOP_UP)
+
+
+def worker_process(url, mode, users, threads, operations, seed):
+    """Run operations on threads; returns per-user (top-ups, purchases, gave up) and conflict stats"""
+    database.FIREBASE_DB = url
+    database._session = None  # never share the parent's sockets after fork
+
+    purchase, top_up = (safe_purchase, safe_top_up) if mode == "safe" else (legacy_purchase, legacy_top_up)
+    tallies = {user_id: [0, 0, 0] for user_id in users}
+    lock = threading.Lock()
+
+    def run(thread_seed):
+        rng = random.Random(thread_seed)
+        for _ in range(operations):
+            user_id = rng.choice(users)
+            try:
+                if rng.random() < 0.4:
+                    top_up(user_id)
+                    outcome = 0
+                elif purchase(user_id):
+                    outcome = 1
+                else:
+                    continue
+            except database.TransactionConflict:
+                # Lost every retry: nothing was written
+                outcome = 2
+            with lock:
+                tallies[user_id][outcome] += 1
+
+    pool = [threading.Thread(target=run, args=(seed * 1000 + number,)) for number in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return tallies, dict(database.transaction_stats)
+
+
+def run(mode, args):
+    users = [str(7000000000 + number) for number in range(args.users)]
+    data = {"users": {user_id: {"name": user_id, "credits": args.credits, "vip": False, "expiry": 0}
+                      for user_id in users}}
+    fake = FakeRTDB(data).start()
+
+    start = time.time()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.starmap(worker_process, [
+            (fake.url, mode, users, args.threads, args.operations, seed) for seed in range(args.processes)
+        ])
+    elapsed = time.time() - start
+
+    top_ups = {user_id: sum(tallies[user_id][0] for tallies, _ in results) for user_id in users}
+    purchases = {user_id: sum(tallies[user_id][1] for tallies, _ in results) for user_id in users}
+    conflicts = sum(stats["conflicts"] for _, stats in results)
+    gave_up = sum(tallies[user_id][2] for tallies, _ in results for user_id in users)
+    total_ops = args.processes * args.threads * args.operations
+
+    credit_errors = 0
+    days_errors = 0
+    ledger_errors = 0
+    for user_id in users:
+        stored = fake.data["users"][user_id]
+        expected = args.credits + TOP_UP * top_ups[user_id] - PRICE * purchases[user_id]
+        credit_errors += abs(stored["credits"] - expected)
+
+        # Every balance change must have its ledger entry, none left parked
+        ledger = fake.data.get("ledger", {}).get(user_id, {})
+        ledger_errors += abs(stored["credits"] - args.credits - sum(entry["amount"] for entry in ledger.values()))
+        ledger_errors += len(stored.get("pending_writes", {}))
+
+        # Every successful purchase must have extended VIP by exactly DAYS
+        granted_days = (stored["expiry"] - start) / 86400 if purchases[user_id] else 0
+        days_errors += abs(round(granted_days) - DAYS * purchases[user_id])
+
+    fake.stop()
+    if mode == "legacy":
+        ledger_errors = 0
+    ok = credit_errors == 0 and days_errors == 0 and ledger_errors == 0
+    print(f"\n{'✅' if ok else '❌'} {mode:<6} {total_ops:,} ops in {elapsed:.1f}s "
+          f"({total_ops / elapsed:,.0f} ops/s), {sum(purchases.values()):,} purchases, "
+          f"{sum(top_ups.values()):,} top-ups")
+    print(f"   credits unaccounted for: {credit_errors:,}   VIP days unaccounted for: {days_errors:,}"
+          + (f"   ledger mismatches: {ledger_errors:,}" if mode == "safe" else "")
+          + (f"   ETag conflicts retried: {conflicts:,}, gave up: {gave_up:,}" if mode == "safe" else ""))
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="hot users all operations hit")
+    parser.add_argument("--credits", type=int, default=500, help="starting balance")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=16, help="threads per process")
+    parser.add_argument("--operations", type=int, default=100, help="operations per thread")
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    if not args.skip_legacy:
+        run("legacy", args)
+    ok = run("safe", args)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+Benchmark database.py primitives against a local fake RTDB server
+"""
+
+import argparse
+import statistics
+import time
+
+import requests
+
+import database
+from fake_rtdb import FakeRTDB
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def report(label, samples):
+    ms = [s * 1000 for s in samples]
+    print(
+        f"{label:<28} mean {statistics.mean(ms):7.2f} ms   "
+        f"p50 {percentile(ms, 50):7.2f} ms   p95 {percentile(ms, 95):7.2f} ms"
+    )
+
+
+def bench_unpooled(fake, calls):
+    """Old behaviour: every call opens a fresh connection"""
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        requests.get(f"{fake.url}/users/1.json", timeout=10).json()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_pooled(calls):
+    """New behaviour: calls share the keep-alive session"""
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        database.get("users/1")
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--connect-delay", type=float, default=0.02,
+                        help="simulated TCP+TLS handshake cost per new connection (s)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated server latency per request (s)")
+    args = parser.parse_args()
+
+    fake = FakeRTDB(
+        data={"users": {"1": {"name": "Bench", "credits": 100, "vip": False}}},
+        latency=args.latency,
+        connect_delay=args.connect_delay
+    ).start()
+    database.FIREBASE_DB = fake.url
+    database.close_session()
+
+    try:
+        print(f"📊 {args.calls} GET calls, handshake {args.connect_delay * 1000:.0f} ms\n")
+
+        before = dict(fake.stats)
+        report("unpooled (before)", bench_unpooled(fake, args.calls))
+        print(f"{'':<28} connections opened: {fake.stats['connections'] - before['connections']}")
+
+        before = dict(fake.stats)
+        report("pooled session (after)", bench_pooled(args.calls))
+        print(f"{'':<28} connections opened: {fake.stats['connections'] - before['connections']}")
+    finally:
+        database.close_session()
+        fake.stop()
+
+
+if __name__ == "__main__":
+    main()
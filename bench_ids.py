@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark and collision stress test for the record id generator (ids.py)
+"""
+
+import argparse
+import multiprocessing
+import threading
+import time
+
+from ids import IdGenerator, id_timestamp, new_id
+
+
+def legacy_id():
+    return str(int(time.time() * 1000))
+
+
+def throughput(func, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - start)
+
+
+def threaded_ids(generator, threads, per_thread):
+    """Generate ids from many threads; returns one list per thread"""
+    results = [[] for _ in range(threads)]
+    barrier = threading.Barrier(threads)
+
+    def worker(out):
+        barrier.wait()
+        for _ in range(per_thread):
+            out.append(generator())
+
+    workers = [threading.Thread(target=worker, args=(out,)) for out in results]
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return results
+
+
+def process_ids(count):
+    return [new_id() for _ in range(count)]
+
+
+def check(label, batches):
+    """Uniqueness across batches, strict ordering within each batch"""
+    all_ids = [record_id for batch in batches for record_id in batch]
+    duplicates = len(all_ids) - len(frozenset(all_ids))
+    unordered = sum(
+        1 for batch in batches for first, second in zip(batch, batch[1:]) if first >= second
+    )
+    ok = duplicates == 0 and unordered == 0
+    print(f"  {'✅' if ok else '❌'} {label:<34} {len(all_ids):>9,} ids   "
+          f"{duplicates:,} duplicates   {unordered:,} out of order")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--processes", type=int, default=4)
+    args = parser.parse_args()
+
+    print("📊 Throughput (single thread)")
+    print(f"  new_id()        {throughput(new_id, args.count):12,.0f} ids/s")
+    print(f"  legacy ms id    {throughput(legacy_id, args.count):12,.0f} ids/s")
+
+    print("\n🔨 Collision stress")
+    per_thread = args.count // args.threads
+    ok = check(f"new_id, {args.threads} threads", threaded_ids(new_id, args.threads, per_thread))
+
+    with multiprocessing.Pool(args.processes) as pool:
+        batches = pool.map(process_ids, [args.count // args.processes] * args.processes)
+    ok = check(f"new_id, {args.processes} processes", batches) and ok
+
+    # A clock stuck on one millisecond (or stepping back) must still give increasing ids
+    frozen = IdGenerator(clock=lambda: 1760000000.0)
+    ok = check("frozen clock", [[frozen.new_id() for _ in range(args.count)]]) and ok
+    backwards = iter(range(args.count, 0, -1))
+    stepping = IdGenerator(clock=lambda: next(backwards) / 1000)
+    ok = check("clock going backwards", [[stepping.new_id() for _ in range(args.count)]]) and ok
+
+    sample = new_id()
+    drift = abs(id_timestamp(sample) - time.time() * 1000)
+    print(f"  {'✅' if drift < 1000 else '❌'} timestamp round trip              {sample} ({drift:.0f} ms)")
+    ok = ok and drift < 1000
+
+    legacy = threaded_ids(legacy_id, args.threads, per_thread)
+    flat = [record_id for batch in legacy for record_id in batch]
+    print(f"  ℹ️ legacy ms ids, {args.threads} threads       {len(flat):>9,} ids   "
+          f"{len(flat) - len(frozenset(flat)):,} duplicates")
+
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
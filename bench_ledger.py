@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Benchmark credit balance reads from the ledger as history grows
+
+For each history size a user's ledger is filled with entries spread
+over the past year, then the balance is read by scanning the whole
+ledger and by snapshot plus tail, for a few snapshot intervals. The
+tail holds half an interval of unsnapshotted entries (the average
+between compactions).
+"""
+
+import argparse
+import statistics
+import time
+
+import database
+from fake_rtdb import FakeRTDB
+from ids import IdGenerator
+
+USER_ID = "6000000000"
+YEAR = 365 * 86400
+
+
+def ledger_data(entries):
+    """(ledger entries, balance) for one user, oldest first, all settled"""
+    start = time.time() - YEAR
+    clock = iter(start + YEAR * number / entries for number in range(entries))
+    generator = IdGenerator(clock=lambda: next(clock))
+
+    ledger = {}
+    balance = 0
+    for number in range(entries):
+        amount = 50 if number % 3 else -30
+        balance += amount
+        ledger[generator.new_id()] = {"amount": amount, "kind": "payment" if amount > 0 else "vip",
+                                      "created": int(start)}
+    return ledger, balance
+
+
+def measure(read, reps, received):
+    """Median latency (ms) and response bytes of one read"""
+    timings = []
+    for _ in range(reps):
+        received.clear()
+        start = time.perf_counter()
+        value = read()
+        timings.append(time.perf_counter() - start)
+    return value, statistics.median(timings) * 1000, sum(received)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,1000,10000", help="ledger entries per run")
+    parser.add_argument("--intervals", default="10,50,200", help="snapshot intervals (LEDGER_SNAPSHOT_EVERY)")
+    parser.add_argument("--reps", type=int, default=20)
+    args = parser.parse_args()
+
+    received = []
+    database.get_session().hooks["response"].append(lambda response, **kwargs: received.append(len(response.content)))
+
+    print(f"{'entries':>8} {'method':<22} {'balance':>9} {'latency':>10} {'bytes':>10}")
+    for size in map(int, args.sizes.split(",")):
+        ledger, expected = ledger_data(size)
+        fake = FakeRTDB({"ledger": {USER_ID: ledger}}).start()
+        database.FIREBASE_DB = fake.url
+
+        def full_scan():
+            entries = database.get(f"ledger/{USER_ID}") or {}
+            return sum(entry["amount"] for entry in entries.values())
+
+        balance, latency, size_bytes = measure(full_scan, args.reps, received)
+        ok = "✅" if balance == expected else "❌"
+        print(f"{size:>8,} {'full scan':<22} {balance:>9,} {latency:>8.2f}ms {size_bytes:>10,} {ok}")
+
+        for interval in map(int, args.intervals.split(",")):
+            database.LEDGER_SNAPSHOT_EVERY = interval
+            fake.data.pop("ledger_snapshots", None)
+            database.snapshot_ledger(USER_ID)
+
+            # Half an interval of fresh entries after the snapshot
+            tail = interval // 2
+            batch = database.WriteBatch()
+            for _ in range(tail):
+                database.ledger_entry(batch, USER_ID, 10, "payment")
+            batch.commit()
+
+            balance, latency, size_bytes = measure(lambda: database.ledger_balance(USER_ID), args.reps, received)
+            ok = "✅" if balance == expected + 10 * tail else "❌"
+            print(f"{size:>8,} {f'snapshot every {interval}':<22} {balance:>9,} {latency:>8.2f}ms "
+                  f"{size_bytes:>10,} {ok}")
+
+            # Drop the fresh tail so the next interval starts from the same history
+            batch = database.WriteBatch()
+            for txid in sorted(fake.data["ledger"][USER_ID])[size:]:
+                batch.delete(f"ledger/{USER_ID}/{txid}")
+            batch.commit()
+
+        fake.stop()
+        print()
+
+
+if __name__ == "__main__":
+    main()
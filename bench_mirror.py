@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Check that live mirrors follow a local fake RTDB through every kind of write
+
+Starts database.start_mirrors on users and payment_requests against the
+fake RTDB's streaming endpoint, then writes through database.py (batches,
+server-side increments, conditional writes, deletes) and through plain
+REST put/patch/delete requests. After each step it waits for the stream
+events and checks that the mirror is fresh() and that read_tree, query
+and list_keys served from it match the backend read directly, without a
+request. Finally a stopped mirror must turn stale and reads must go back
+to the backend. Exits 1 if a check fails.
+"""
+
+import argparse
+import sys
+import time
+
+import requests
+
+import database
+from fake_rtdb import FakeRTDB
+
+PATHS = ("users", "payment_requests")
+
+
+def synthetic_data(users):
+    data = {"users": {}, "payment_requests": {}}
+    for number in range(users):
+        user_id = str(8000000000 + number)
+        data["users"][user_id] = {"name": f"User {number}", "credits": number % 300, "vip": False,
+                                  "updated": 1700000000 + number}
+        data["payment_requests"][f"p{number:09d}"] = {"user_id": user_id, "amount": 50,
+                                                       "status": "pending" if number % 3 else "approved"}
+    return data
+
+
+def check(label, ok, failures):
+    print(f"  {'✅' if ok else '❌'} {label}")
+    if not ok:
+        failures.append(label)
+
+
+def wait_in_sync(timeout=5):
+    """Wait until every mirror holds what the backend holds; True if they do"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(database.mirrors[path].get() == database.backend.get(path) for path in PATHS):
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def mirror_reads():
+    """read name -> (read through database.py, same read straight from the backend)"""
+    backend = database.backend
+    return {
+        "read_tree users": (lambda: database.read_tree("users"), lambda: backend.get("users")),
+        "read_tree one user": (lambda: database.read_tree("users/8000000001"),
+                               lambda: backend.get("users/8000000001")),
+        "query credits >= 100": (lambda: database.query("users", "credits", start_at=100, limit_to_first=5),
+                                 lambda: backend.query("users", "credits", start_at=100, limit_to_first=5)),
+        "query updated, last 3": (lambda: database.query("users", "updated", limit_to_last=3),
+                                  lambda: backend.query("users", "updated", limit_to_last=3)),
+        "query pending payments": (
+            lambda: database.query("payment_requests", "status", equal_to="pending"),
+            lambda: backend.query("payment_requests", "status", equal_to="pending")
+        ),
+        "list_keys users": (lambda: database.list_keys("users"),
+                            lambda: sorted(backend.get("users", shallow=True) or {}, key=database.key_rank)),
+    }
+
+
+def check_step(label, fake, failures):
+    """After a write: mirrors caught up, fresh, and serving reads that match the backend"""
+    synced = wait_in_sync()
+    fresh = all(database.mirrors[path].fresh() for path in PATHS)
+
+    wrong = []
+    before = fake.stats["requests"]
+    mirrored = {name: through() for name, (through, _) in mirror_reads().items()}
+    served = fake.stats["requests"] - before
+    for name, (_, direct) in mirror_reads().items():
+        if mirrored[name] != direct():
+            wrong.append(name)
+
+    check(f"{label}: in sync, fresh, reads match with {served} requests"
+          + (f" (differs: {', '.join(wrong)})" if wrong else ""),
+          synced and fresh and not wrong and served == 0, failures)
+
+
+def steps(fake):
+    """label -> write, run in order"""
+    base = fake.url
+    user_id = "8000000001"
+
+    return [
+        ("create_user (multi-location PATCH at the root)",
+         lambda: database.create_user("8100000000", {"name": "New User", "username": "new"})),
+        ("update_user", lambda: database.update_user(user_id, {"name": "Renamed"})),
+        ("add_credits (server-side increment)", lambda: database.add_credits(user_id, 25)),
+        ("purchase_vip (conditional PUT of the record)", lambda: database.purchase_vip(user_id, 30, 10)),
+        ("add_payment_request", lambda: database.add_payment_request(user_id, 70, "kpay")),
+        ("approve_payment", lambda: database.approve_payment("p000000002", "1")),
+        ("REST put of one field", lambda: requests.put(f"{base}/users/{user_id}/credits.json", json=999)),
+        ("REST patch of a record", lambda: requests.patch(f"{base}/users/8000000002.json",
+                                                          json={"credits": 1, "vip": True})),
+        ("REST patch with nested paths", lambda: requests.patch(f"{base}/users.json",
+                                                                json={"8000000003/credits": 5,
+                                                                      "8000000004": {"name": "Whole"}})),
+        ("REST delete of a record", lambda: requests.delete(f"{base}/users/8000000005.json")),
+        ("database.delete of a field", lambda: database.delete(f"users/{user_id}/vip")),
+        ("put of the whole mirrored tree", lambda: database.set("payment_requests", {
+            "p1": {"user_id": user_id, "amount": 10, "status": "pending"}})),
+        ("root PATCH deleting a record and adding one", lambda: database.update("", {
+            "users/8000000006": None, "users/8100000001": {"name": "Root", "credits": 7}})),
+        ("delete of the whole mirrored tree", lambda: database.delete("payment_requests")),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    args = parser.parse_args()
+
+    fake = FakeRTDB(synthetic_data(args.users)).start()
+    previous = database.use_backend(database.FirebaseBackend(fake.url))
+    failures = []
+
+    try:
+        database.start_mirrors(PATHS)
+        ready = all(database.mirrors[path].wait_until_fresh() for path in PATHS)
+        check("mirrors loaded and fresh", ready, failures)
+        check_step("initial load", fake, failures)
+
+        for label, write in steps(fake):
+            write()
+            check_step(label, fake, failures)
+
+        events = sum(database.mirrors[path].stats["events"] for path in PATHS)
+        print(f"\n  {events} stream events applied")
+
+        mirror = database.mirrors["users"]
+        mirror.stop()
+        before = fake.stats["requests"]
+        value = database.read_tree("users")
+        check("stopped mirror is stale and reads go to the backend",
+              not mirror.fresh() and fake.stats["requests"] > before and value == database.backend.get("users"),
+              failures)
+    finally:
+        database.stop_mirrors()
+        database.use_backend(previous)
+        fake.stop()
+
+    for failure in failures:
+        print(f"❌ {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""
+Replay synthetic Telegram updates through bot.py end to end
+
+Virtual users walk realistic flows (/start, add_money -> credit_N ->
+send_screenshot -> photo, buy_vip -> vip_Nmonth, /token, /sendtoken and
+the admin's /approve) and push each update through the real dispatcher
+and handlers. The Bot API is a local fake Telegram server and storage is
+the in-memory, SQLite or fake-RTDB backend, so the numbers show where
+bot.py itself saturates.
+
+Each virtual user sends its next update as soon as the previous one is
+handled (closed loop), so --concurrency is the number of updates in
+flight. Reports handler latency (enqueue to handler return) per step,
+the Bot API calls, queued sends and storage calls each step makes, and
+the most handlers that ran at once.
+
+Hundreds of updates in flight on the worker pool, with I/O latency:
+
+    python bench_replay.py --storage firebase --db-latency 0.2 \
+        --api-latency 0.3 --workers 512 --concurrency 64,256,512
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+from telegram.utils.request import Request
+
+import bot
+import database
+import metrics
+import tracing
+from bench_database import percentile
+from fake_rtdb import FakeRTDB
+from fake_telegram import FakeTelegram
+from sender import SendScheduler
+from storage import Backend, MemoryBackend, SQLiteBackend
+
+USER_BASE = 9000000000
+
+# flow name -> default weight in the mix
+MIX = {"start": 20, "top_up": 20, "buy_vip": 25, "token": 10, "sendtoken": 15, "approve": 10}
+
+
+# ========================
+# ATTRIBUTION
+# ========================
+current = threading.local()
+
+
+def current_step():
+    return getattr(current, "step", "other")
+
+
+class CountingBackend(Backend):
+    """Passes every call through and counts it against the running step"""
+
+    def __init__(self, inner, counts):
+        self.inner = inner
+        self.counts = counts
+
+    def _count(self):
+        self.counts[current_step()] += 1
+
+    def get(self, path, shallow=False):
+        self._count()
+        return self.inner.get(path, shallow=shallow)
+
+    def set(self, path, value):
+        self._count()
+        return self.inner.set(path, value)
+
+    def update(self, path, data):
+        self._count()
+        return self.inner.update(path, data)
+
+    def delete(self, path):
+        self._count()
+        return self.inner.delete(path)
+
+    def query(self, path, **params):
+        self._count()
+        return self.inner.query(path, **params)
+
+    def read_versioned(self, path):
+        self._count()
+        return self.inner.read_versioned(path)
+
+    def write_if(self, path, value, expected_etag):
+        self._count()
+        return self.inner.write_if(path, value, expected_etag)
+
+    def close(self):
+        self.inner.close()
+
+
+class CountingOutbox(SendScheduler):
+    """SendScheduler that counts sends queued by each step"""
+
+    def __init__(self, *args, counts, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counts = counts
+
+    def send(self, method, chat_id, priority=None, **kwargs):
+        self.counts[current_step()] += 1
+        return super().send(method, chat_id, priority, **kwargs)
+
+
+def count_api_calls(api, counts):
+    """Count the Bot API calls a handler makes inline (not via the outbox)"""
+    post = api._post
+
+    def counted(endpoint, *args, **kwargs):
+        if threading.current_thread().name.startswith("sender"):
+            counts["outbox"] += 1
+        else:
+            counts[current_step()] += 1
+        return post(endpoint, *args, **kwargs)
+
+    api._post = counted
+
+
+# ========================
+# UPDATES
+# ========================
+class Updates:
+    """Builds Update objects the way Telegram sends them"""
+
+    def __init__(self, api):
+        self.api = api
+        self.lock = threading.Lock()
+        self.update_id = 0
+        self.message_id = 0
+
+    def _ids(self):
+        with self.lock:
+            self.update_id += 1
+            self.message_id += 1
+            return self.update_id, self.message_id
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User {user_id % 100000}",
+                "username": f"user{user_id}"}
+
+    def _message(self, user_id, message_id, **fields):
+        return {"message_id": message_id, "date": int(time.time()), "from": self._user(user_id),
+                "chat": {"id": user_id, "type": "private"}, **fields}
+
+    def text(self, user_id, text):
+        update_id, message_id = self._ids()
+        fields = {"text": text}
+        if text.startswith("/"):
+            fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return Update.de_json({"update_id": update_id, "message": self._message(user_id, message_id, **fields)},
+                              self.api)
+
+    def photo(self, user_id):
+        update_id, message_id = self._ids()
+        sizes = [{"file_id": f"photo-{message_id}-{size}", "file_unique_id": f"u{message_id}{size}",
+                  "width": size, "height": size, "file_size": size * 40} for size in (90, 320, 1280)]
+        return Update.de_json({"update_id": update_id, "message": self._message(user_id, message_id, photo=sizes)},
+                              self.api)
+
+    def button(self, user_id, data):
+        update_id, message_id = self._ids()
+        query = {"id": str(update_id), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+                 "message": self._message(1, message_id, text="menu")}
+        query["message"]["chat"] = {"id": user_id, "type": "private"}
+        return Update.de_json({"update_id": update_id, "callback_query": query}, self.api)
+
+
+def flow(name, user_id, updates, rng):
+    """[(step label, Update)] for one pass through a flow"""
+    if name == "start":
+        return [("/start", updates.text(user_id, "/start"))]
+    if name == "top_up":
+        amount = rng.choice(("50", "100", "200", "500"))
+        return [("add_money", updates.button(user_id, "add_money")),
+                ("credit_N", updates.button(user_id, f"credit_{amount}")),
+                ("send_screenshot", updates.button(user_id, "send_screenshot")),
+                ("photo", updates.photo(user_id))]
+    if name == "buy_vip":
+        months = rng.choice(("1month", "2month", "3month", "6month"))
+        return [("buy_vip", updates.button(user_id, "buy_vip")),
+                ("vip_Nmonth", updates.button(user_id, f"vip_{months}"))]
+    if name == "token":
+        return [("/token", updates.text(user_id, f"/token TOKEN{rng.randrange(10 ** 6)} 30 {rng.choice((50, 100))}"))]
+    if name == "sendtoken":
+        return [("/sendtoken", updates.text(user_id, f"/sendtoken VPN{rng.randrange(10 ** 6)}"))]
+    if name == "approve":
+        return [("/approve", updates.text(int(bot.ADMIN_ID), f"/approve {user_id} {rng.choice((50, 100, 200))}"))]
+    raise ValueError(f"unknown flow {name}")
+
+
+# ========================
+# HARNESS
+# ========================
+class Harness:
+    """Dispatcher with timed handlers; put() feeds an update and waits for it"""
+
+    HANDLERS = ("start", "button_handler", "handle_message", "admin_approve")
+
+    def __init__(self, api, workers):
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.handler_times = defaultdict(list)
+        self.errors = Counter()
+        self.running = 0
+        self.peak_running = 0
+
+        self.dispatcher = Dispatcher(api, Queue(), workers=workers, use_context=True)
+        originals = {name: getattr(bot, name) for name in self.HANDLERS}
+        for name, handler in originals.items():
+            setattr(bot, name, self._timed(handler))
+        try:
+            bot.add_handlers(self.dispatcher)
+        finally:
+            for name, handler in originals.items():
+                setattr(bot, name, handler)
+
+        self.thread = threading.Thread(target=self.dispatcher.start, name="dispatcher", daemon=True)
+
+    def _timed(self, handler):
+        def timed(update, context):
+            with self.lock:
+                step, enqueued, done = self.pending.pop(update.update_id)
+            current.step = step
+            with self.lock:
+                self.running += 1
+                self.peak_running = max(self.peak_running, self.running)
+            start = time.perf_counter()
+            try:
+                return handler(update, context)
+            except Exception:
+                self.errors[step] += 1
+                raise
+            finally:
+                end = time.perf_counter()
+                current.step = None
+                with self.lock:
+                    self.running -= 1
+                    self.handler_times[step].append(end - start)
+                    self.latencies[step].append(end - enqueued)
+                done.set()
+
+        return timed
+
+    def start(self):
+        self.thread.start()
+        while not self.dispatcher.running:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.dispatcher.stop()
+        self.thread.join(10)
+
+    def put(self, step, update, timeout=30):
+        done = threading.Event()
+        with self.lock:
+            self.pending[update.update_id] = (step, time.perf_counter(), done)
+        self.dispatcher.update_queue.put(update)
+        if not done.wait(timeout):
+            with self.lock:
+                self.pending.pop(update.update_id, None)
+                self.errors[step] += 1
+
+    def reset(self):
+        with self.lock:
+            self.latencies.clear()
+            self.handler_times.clear()
+            self.errors.clear()
+            self.peak_running = self.running
+
+
+def virtual_user(index, concurrency, users, harness, updates, mix, deadline, seed):
+    """Closed loop over this user's share of the user ids"""
+    rng = random.Random(seed * 1000 + index)
+    own_ids = [USER_BASE + number for number in range(index, users, concurrency)] or [USER_BASE + index]
+    names, weights = list(mix), list(mix.values())
+
+    while time.monotonic() < deadline:
+        user_id = rng.choice(own_ids)
+        for step, update in flow(rng.choices(names, weights)[0], user_id, updates, rng):
+            harness.put(step, update)
+
+
+# ========================
+# STORAGE
+# ========================
+def seed_data(users):
+    """Half the users exist already, with enough credits for some VIP buys"""
+    seeded = MemoryBackend()
+    previous = database.use_backend(seeded)
+    try:
+        for number in range(0, users, 2):
+            database.create_user(USER_BASE + number, {"name": f"User {number}", "username": f"user{number}",
+                                                      "credits": (number * 37) % 300, "vip": False})
+        return seeded.get("") or {}
+    finally:
+        database.use_backend(previous)
+
+
+def open_storage(kind, latency, data):
+    """(backend, cleanup) loaded with data"""
+    if kind == "memory":
+        backend = MemoryBackend(data)
+        return backend, backend.close
+    if kind == "sqlite":
+        directory = tempfile.mkdtemp(prefix="replay-")
+        backend = SQLiteBackend(os.path.join(directory, "replay.sqlite3"))
+        backend.set("", data)
+        return backend, backend.close
+    if kind == "firebase":
+        fake = FakeRTDB(data, latency=latency).start()
+        backend = database.FirebaseBackend(fake.url)
+        return backend, fake.stop
+    raise ValueError(f"unknown storage {kind}")
+
+
+def parse_mix(text):
+    mix = dict(MIX)
+    for part in filter(None, (text or "").split(",")):
+        name, _, weight = part.partition("=")
+        if name not in MIX:
+            raise SystemExit(f"unknown flow {name!r}; flows are {', '.join(MIX)}")
+        mix[name] = float(weight)
+    return {name: weight for name, weight in mix.items() if weight > 0}
+
+
+# ========================
+# REPORT
+# ========================
+def summarize(harness, elapsed, storage_calls, api_calls, queued):
+    steps = {}
+    for step, samples in sorted(harness.latencies.items()):
+        ms = [s * 1000 for s in samples]
+        count = len(samples)
+        steps[step] = {
+            "updates": count,
+            "p50_ms": percentile(ms, 50), "p95_ms": percentile(ms, 95), "p99_ms": percentile(ms, 99),
+            "handler_p50_ms": percentile([s * 1000 for s in harness.handler_times[step]], 50),
+            "storage_per_update": storage_calls[step] / count,
+            "api_per_update": api_calls[step] / count,
+            "queued_sends_per_update": queued[step] / count,
+            "errors": harness.errors[step],
+        }
+
+    total = sum(step["updates"] for step in steps.values())
+    everything = [s * 1000 for samples in harness.latencies.values() for s in samples]
+    overall = {
+        "updates": total,
+        "updates_per_s": total / elapsed if elapsed else 0,
+        "p50_ms": percentile(everything, 50) if everything else 0,
+        "p95_ms": percentile(everything, 95) if everything else 0,
+        "p99_ms": percentile(everything, 99) if everything else 0,
+        "storage_per_update": sum(storage_calls[step] for step in steps) / total if total else 0,
+        "api_per_update": sum(api_calls[step] for step in steps) / total if total else 0,
+        "queued_sends_per_update": sum(queued[step] for step in steps) / total if total else 0,
+        "peak_in_flight": harness.peak_running,
+        "errors": sum(harness.errors.values()),
+    }
+    return {"overall": overall, "steps": steps}
+
+
+def print_level(concurrency, result):
+    overall = result["overall"]
+    print(f"\nconcurrency {concurrency}: {overall['updates']:,} updates, {overall['updates_per_s']:,.0f}/s, "
+          f"p50 {overall['p50_ms']:.1f} ms, p95 {overall['p95_ms']:.1f} ms, p99 {overall['p99_ms']:.1f} ms, "
+          f"{overall['peak_in_flight']} handlers at once at peak"
+          + (f", {overall['errors']} errors" if overall["errors"] else ""))
+    print(f"  {'step':<16} {'n':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'handler':>8} "
+          f"{'storage':>8} {'api':>6} {'queued':>7}")
+    for step, row in result["steps"].items():
+        print(f"  {step:<16} {row['updates']:>7,} {row['p50_ms']:>6.1f}ms {row['p95_ms']:>6.1f}ms "
+              f"{row['p99_ms']:>6.1f}ms {row['handler_p50_ms']:>6.1f}ms {row['storage_per_update']:>8.1f} "
+              f"{row['api_per_update']:>6.1f} {row['queued_sends_per_update']:>7.1f}"
+              + (f"  {row['errors']} errors" if row["errors"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,8,32", help="virtual users in flight; a list sweeps levels")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--users", type=int, default=1000, help="distinct Telegram users")
+    parser.add_argument("--workers", type=int, default=bot.BOT_WORKERS, help="dispatcher worker threads")
+    parser.add_argument("--storage", choices=("memory", "sqlite", "firebase"), default="memory")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="seconds per fake RTDB request")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="seconds per fake Bot API request")
+    parser.add_argument("--mix", help="flow weights, e.g. start=20,top_up=20,buy_vip=25 (defaults: %s)"
+                        % ",".join(f"{name}={weight}" for name, weight in MIX.items()))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-metrics", action="store_true", help="switch metrics recording off (to see its cost)")
+    parser.add_argument("--stats", action="store_true", help="print the admin /stats report at the end")
+    parser.add_argument("--trace-file", help="write traces of slow updates here (see python tracing.py)")
+    parser.add_argument("--trace-slow-ms", type=float, default=bot.TRACE_SLOW_MS)
+    parser.add_argument("--output", help="write the results as JSON")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    metrics.registry.enabled = not args.no_metrics
+    tracing.configure(args.trace_file, slow_ms=args.trace_slow_ms)
+    mix = parse_mix(args.mix)
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    # One keep-alive connection per worker, as bot.py sizes the pool from BOT_WORKERS
+    database.HTTP_POOL_SIZE = args.workers
+    database.close_session()
+
+    storage_calls, api_calls, queued = Counter(), Counter(), Counter()
+    backend, close_storage = open_storage(args.storage, args.db_latency, seed_data(args.users))
+    previous = database.use_backend(CountingBackend(backend, storage_calls))
+
+    fake = FakeTelegram(latency=args.api_latency, global_rate=10 ** 9, chat_rate=10 ** 9).start()
+    api = Bot("123:fake", base_url=fake.base_url, request=Request(con_pool_size=args.workers + 16))
+    count_api_calls(api, api_calls)
+    bot.instrument_bot(api)
+    bot.outbox = CountingOutbox(api, global_rate=10 ** 6, chat_rate=10 ** 6, admin_chat=bot.ADMIN_ID,
+                                counts=queued).start()
+
+    harness = Harness(api, args.workers).start()
+    updates = Updates(api)
+    results = {}
+    print(f"{args.storage} storage, {args.users:,} users, {args.workers} workers, {args.duration:g}s per level, "
+          f"mix {', '.join(f'{name}={weight:g}' for name, weight in mix.items())}")
+
+    try:
+        for concurrency in levels:
+            harness.reset()
+            for counts in (storage_calls, api_calls, queued):
+                counts.clear()
+
+            deadline = time.monotonic() + args.duration
+            start = time.perf_counter()
+            threads = [threading.Thread(target=virtual_user, daemon=True,
+                                        args=(index, concurrency, args.users, harness, updates, mix, deadline,
+                                              args.seed))
+                       for index in range(concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            results[concurrency] = summarize(harness, elapsed, storage_calls, api_calls, queued)
+            print_level(concurrency, results[concurrency])
+    finally:
+        harness.stop()
+        bot.outbox.stop()
+        fake.stop()
+        database.use_backend(previous)
+        close_storage()
+
+    if args.stats:
+        print("\n" + metrics.registry.report())
+    print(f"\noutbox sends {api_calls['outbox']:,} in the last level; fake Telegram saw {fake.stats['requests']:,} "
+          f"requests in total")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"meta": {**vars(args), "mix": mix}, "levels": results}, f, indent=2)
+        print(f"wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark search_users / get_user_by_username against a local fake RTDB
+
+Seeds synthetic users with their username and search indexes (written by
+database.rebuild_user_indexes), serves them from a fake Firebase REST
+server and times the real database functions, with the HTTP requests and
+bytes each call costs. A full scan of the users tree is the baseline.
+"""
+
+import argparse
+import random
+import time
+
+import database
+from bench_suite import Traffic
+from database import SEARCH_LIMIT, SEARCH_NGRAM, _matches
+from fake_rtdb import FakeRTDB
+from storage import MemoryBackend
+
+SYLLABLES = ["aung", "kyaw", "zaw", "min", "thu", "hla", "myo", "win", "htet", "naing",
+             "soe", "tun", "khin", "su", "ei", "phyo", "wai", "yan", "lin", "ko"]
+
+
+def synthetic_users(count, seed=1):
+    rng = random.Random(seed)
+    users = {}
+    for i in range(count):
+        first = rng.choice(SYLLABLES).title()
+        last = rng.choice(SYLLABLES).title()
+        user_id = str(5000000000 + i * 7919)
+        users[user_id] = {
+            "name": f"{first} {last}",
+            "username": f"{first.lower()}{last.lower()}{rng.randint(0, 99999)}",
+            "credits": rng.randint(0, 500),
+            "vip": False
+        }
+    return users
+
+
+def seed(users):
+    """Database contents with indexes, built through database.py on a memory backend"""
+    previous = database.use_backend(MemoryBackend())
+    try:
+        database.backend.data["users"] = users
+        database.rebuild_user_indexes()
+        return database.backend.data
+    finally:
+        database.use_backend(previous)
+
+
+def scan_search(term, limit=None):
+    """Baseline: download every user and filter locally"""
+    users = database.read_tree("users") or {}
+    matches = sorted(user_id for user_id, user_data in users.items() if _matches(user_id, user_data, term))
+    return {user_id: users[user_id] for user_id in matches[:limit]}
+
+
+def measure(traffic, func, *args, repeat=5):
+    """(best seconds, requests, bytes received, result) over repeat calls"""
+    best = None
+    for _ in range(repeat):
+        database.user_cache.clear()
+        traffic.reset()
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, traffic.requests, traffic.received, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="10000,100000")
+    parser.add_argument("--terms", default="kyaw win,htet,phyowai1,50000")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per fake RTDB request")
+    args = parser.parse_args()
+
+    terms = [term for term in args.terms.split(",") if len(term) >= SEARCH_NGRAM]
+    ok = True
+
+    for scale in (int(value) for value in args.scales.split(",")):
+        users = synthetic_users(scale)
+        start = time.perf_counter()
+        data = seed(users)
+        build = time.perf_counter() - start
+
+        fake = FakeRTDB(data, latency=args.latency).start()
+        previous = database.use_backend(database.FirebaseBackend(fake.url))
+        traffic = Traffic()
+
+        try:
+            print(f"\n📊 {scale:,} users  (index build {build:.1f}s, {len(data['search_index']):,} n-grams)")
+
+            sample = random.Random(2).choice(list(users.values()))["username"]
+            lookup_time, requests, received, found = measure(traffic, database.get_user_by_username, sample)
+            ok = ok and [user.get("username") for user in found.values()] == [sample]
+            print(f"  get_user_by_username  {lookup_time * 1000:8.2f} ms  {requests:>3} requests  "
+                  f"{received / 1024:10.1f} KB")
+
+            # Every match (the default), then a page of SEARCH_LIMIT as the admin search shows
+            for term in terms:
+                for limit in (None, SEARCH_LIMIT):
+                    scan_time, scan_requests, scan_received, expected = measure(
+                        traffic, scan_search, term, limit, repeat=3)
+                    index_time, requests, received, result = measure(traffic, database.search_users, term, limit)
+                    match = sorted(result) == sorted(expected)
+                    ok = ok and match
+                    print(f"  search {term!r:<12} {'all' if limit is None else limit:>3}  scan "
+                          f"{scan_time * 1000:9.2f} ms {scan_requests:>3} req {scan_received / 1024:10.1f} KB   "
+                          f"search_users {index_time * 1000:8.2f} ms {requests:>4} req {received / 1024:8.1f} KB   "
+                          f"{len(result):,} results" + ("" if match else "  ❌ differs from scan"))
+        finally:
+            database.use_backend(previous)
+            fake.stop()
+
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+Benchmark outbound sends against a fake Bot API that enforces Telegram's flood limits
+
+Simulates a burst after a payment announcement: every user gets a
+confirmation and the admin gets a notification per user, sent either
+inline from handler threads (old behaviour) or through SendScheduler.
+"""
+
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+from fake_telegram import FakeTelegram
+from sender import SendScheduler
+
+ADMIN_CHAT = 999
+
+
+def burst(users):
+    """(chat_id, text) pairs in arrival order: confirmation + admin notice per user"""
+    sends = []
+    for user_id in range(1, users + 1):
+        sends.append((user_id, f"✅ Screenshot လက်ခံရရှိပါပြီ ({user_id})"))
+        sends.append((ADMIN_CHAT, f"📸 ငွေလွှဲ Screenshot from `{user_id}`"))
+    return sends
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def report(label, fake, elapsed, latencies, failed):
+    print(f"\n📊 {label}")
+    print(f"  wall time {elapsed:6.2f} s   api requests {fake.stats['requests']}   "
+          f"delivered {fake.stats['sent']}   429s {fake.stats['rate_limited']}   failed sends {failed}")
+    for kind, samples in latencies.items():
+        if samples:
+            print(f"  {kind:<6} latency  p50 {percentile(samples, 50) * 1000:8.1f} ms   "
+                  f"p95 {percentile(samples, 95) * 1000:8.1f} ms   ({len(samples)} delivered)")
+
+
+def make_bot(fake, pool):
+    return Bot("123:fake", base_url=fake.base_url, request=Request(con_pool_size=pool))
+
+
+def run_inline(sends, latency, threads):
+    """Handlers call bot.send_message directly"""
+    fake = FakeTelegram(latency=latency).start()
+    bot = make_bot(fake, threads)
+    latencies = {"admin": [], "user": []}
+    failed = []
+
+    def send(chat_id, text):
+        start = time.perf_counter()
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+            latencies["admin" if chat_id == ADMIN_CHAT else "user"].append(time.perf_counter() - start)
+        except Exception:
+            failed.append(chat_id)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        for chat_id, text in sends:
+            pool.submit(send, chat_id, text)
+    elapsed = time.perf_counter() - start
+
+    report(f"inline sends ({threads} handler threads)", fake, elapsed, latencies, len(failed))
+    fake.stop()
+
+
+def run_scheduled(sends, latency, workers, rate):
+    """Handlers enqueue on SendScheduler and return"""
+    fake = FakeTelegram(latency=latency).start()
+    scheduler = SendScheduler(make_bot(fake, workers), global_rate=rate, admin_chat=ADMIN_CHAT,
+                              workers=workers).start()
+    latencies = {"admin": [], "user": []}
+    lock = threading.Lock()
+
+    def done(kind, start):
+        def callback(future):
+            if future.exception() is None:
+                with lock:
+                    latencies[kind].append(time.perf_counter() - start)
+        return callback
+
+    start = time.perf_counter()
+    enqueue = time.perf_counter()
+    for chat_id, text in sends:
+        future = scheduler.send_message(chat_id, text)
+        future.add_done_callback(done("admin" if chat_id == ADMIN_CHAT else "user", time.perf_counter()))
+    enqueue = time.perf_counter() - enqueue
+    scheduler.flush()
+    elapsed = time.perf_counter() - start
+
+    metrics = scheduler.metrics()
+    report(f"SendScheduler ({rate}/s global, 1/s per chat)", fake, elapsed, latencies, metrics["failed"])
+    print(f"  enqueue {enqueue / len(sends) * 1e6:.1f} µs per send   "
+          f"{metrics['coalesced']} admin notices coalesced   {metrics['retried']} retried")
+    scheduler.stop()
+    fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=150)
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated Bot API latency (s)")
+    parser.add_argument("--threads", type=int, default=32, help="handler threads for inline sends")
+    parser.add_argument("--workers", type=int, default=8, help="scheduler sender threads")
+    parser.add_argument("--rate", type=int, default=25, help="scheduler global sends per second")
+    args = parser.parse_args()
+
+    sends = burst(args.users)
+    print(f"📨 {len(sends)} sends ({args.users} users + {args.users} admin notices), "
+          f"{args.latency * 1000:.0f} ms API latency")
+    run_inline(sends, args.latency, args.threads)
+    run_scheduled(sends, args.latency, args.workers, args.rate)
+
+    # Per-chat spacing guarantee, independent of timing noise above
+    fake = FakeTelegram().start()
+    scheduler = SendScheduler(make_bot(fake, 4), admin_chat=ADMIN_CHAT).start()
+    for number in range(3):
+        scheduler.send_message(7, f"user message {number}")
+    scheduler.stop()
+    gaps = [b["at"] - a["at"] for a, b in zip(fake.messages, fake.messages[1:])]
+    print(f"\n⏱️ same-chat gaps: {', '.join(f'{gap:.2f}s' for gap in gaps)} "
+          f"(min {min(gaps, default=0):.2f}s, limit 1.00s)")
+    fake.stop()
+
+    # A 429 holds every chat for retry_after, so a scheduler set faster than the
+    # server's limit backs off instead of retrying into more 429s
+    fake = FakeTelegram(global_rate=5).start()
+    scheduler = SendScheduler(make_bot(fake, 8), global_rate=100, workers=8).start()
+    for chat_id in range(1, 31):
+        scheduler.send_message(chat_id, "flood test")
+    scheduler.stop(timeout=30)
+    print(f"🚦 30 sends to a 5/s server from a 100/s scheduler: {fake.stats['sent']} delivered, "
+          f"{fake.stats['rate_limited']} 429s, {scheduler.metrics()['retried']} retried")
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Check and benchmark single-flight reads against a local fake RTDB
+
+Bursts of threads read the same paths at the same instant (the admin's
+record, payment_requests, a pending-payments query, the user keys), with
+single-flight off and on, and compare the requests the fake RTDB served.
+Also checks that every caller gets the right value as its own copy, that
+a read after a write always sees the write, and that a failed read fails
+every caller that shared it. Exits 1 if a check fails.
+"""
+
+import argparse
+import sys
+import threading
+import time
+
+import database
+from fake_rtdb import FakeRTDB
+from storage import MemoryBackend
+
+ADMIN = "7541964031"
+
+
+def synthetic_data(payments):
+    data = {"users": {ADMIN: {"name": "Admin", "credits": 0, "vip": True}}, "payment_requests": {}}
+    for number in range(payments):
+        user_id = str(8000000000 + number)
+        status = "pending" if number % 5 == 0 else "approved"
+        payment_id = f"p{number:09d}"
+        data["users"][user_id] = {"name": f"User {number}", "credits": number % 500, "vip": False}
+        data["payment_requests"][payment_id] = {"user_id": user_id, "amount": 50, "status": status,
+                                                "status_key": f"{status}:{payment_id}"}
+    return data
+
+
+def reads():
+    """name -> read that dispatcher workers issue together"""
+    return {
+        "admin record": lambda: database.get(f"users/{ADMIN}"),
+        "payment_requests": lambda: database.get("payment_requests"),
+        "pending payments": lambda: database.query("payment_requests", "status", equal_to="pending"),
+        "user keys": lambda: database.list_keys("users"),
+    }
+
+
+def burst(read, threads):
+    """Run read on threads at once; (results, errors, seconds)"""
+    barrier = threading.Barrier(threads)
+    results = [None] * threads
+    errors = [None] * threads
+
+    def worker(index):
+        barrier.wait()
+        try:
+            results[index] = read()
+        except Exception as e:
+            errors[index] = e
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return results, errors, time.perf_counter() - start
+
+
+def check(label, ok, failures):
+    print(f"  {'✅' if ok else '❌'} {label}")
+    if not ok:
+        failures.append(label)
+
+
+def benchmark(fake, threads, rounds, failures):
+    print(f"{threads} threads x {rounds} bursts per read, {fake.latency * 1000:.0f} ms per request\n")
+    print(f"{'read':<20} {'requests off':>13} {'requests on':>12} {'burst off':>10} {'burst on':>9}")
+
+    for label, read in reads().items():
+        expected = read()
+        row = {}
+        for enabled in (False, True):
+            database.SINGLE_FLIGHT = enabled
+            before = fake.stats["requests"]
+            elapsed = 0
+            for _ in range(rounds):
+                results, errors, seconds = burst(read, threads)
+                elapsed += seconds
+                if any(errors) or any(result != expected for result in results):
+                    failures.append(f"{label}: wrong result (single-flight {'on' if enabled else 'off'})")
+            row[enabled] = (fake.stats["requests"] - before, elapsed / rounds * 1000)
+
+        print(f"{label:<20} {row[False][0]:>13,} {row[True][0]:>12,} {row[False][1]:>7.1f} ms {row[True][1]:>6.1f} ms")
+
+    print(f"\nsingle-flight counters: {database.get_single_flight_stats()}\n")
+
+
+def check_copies(threads, failures):
+    database.SINGLE_FLIGHT = True
+    expected = database.get(f"users/{ADMIN}")
+
+    def read_and_modify():
+        value = database.get(f"users/{ADMIN}")
+        time.sleep(0.01)
+        snapshot = dict(value)
+        value["credits"] = -1
+        return snapshot
+
+    results, errors, _ = burst(read_and_modify, threads)
+    check("every caller gets its own copy", not any(errors) and all(r == expected for r in results), failures)
+
+
+def check_read_after_write(threads, writes, failures):
+    database.SINGLE_FLIGHT = True
+    path = f"users/{ADMIN}/credits"
+    stop = threading.Event()
+    stale = []
+
+    def reader():
+        while not stop.is_set():
+            database.get(f"users/{ADMIN}")
+            database.get(path)
+
+    def writer():
+        for value in range(1, writes + 1):
+            database.set(path, value)
+            seen = database.get(path)
+            if seen != value:
+                stale.append((value, seen))
+
+    readers = [threading.Thread(target=reader, daemon=True) for _ in range(threads)]
+    for thread in readers:
+        thread.start()
+    writer()
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    check(f"reads after {writes} writes under concurrent readers see the write"
+          + (f" (stale: {stale[:3]})" if stale else ""), not stale, failures)
+
+
+class FailingBackend(MemoryBackend):
+    """Reads fail after a delay, long enough for a burst to pile up"""
+
+    def __init__(self):
+        super().__init__()
+        self.reads = 0
+
+    def get(self, path, shallow=False):
+        self.reads += 1
+        time.sleep(0.05)
+        raise RuntimeError("backend down")
+
+
+def check_errors(threads, failures):
+    database.SINGLE_FLIGHT = True
+    failing = FailingBackend()
+    previous = database.use_backend(failing)
+    try:
+        _, errors, _ = burst(lambda: database.get("payment_requests"), threads)
+    finally:
+        database.use_backend(previous)
+    check(f"a failed read fails all {threads} callers ({failing.reads} backend call)",
+          all(isinstance(error, RuntimeError) for error in errors) and failing.reads < threads, failures)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--payments", type=int, default=2000)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per fake RTDB request")
+    parser.add_argument("--writes", type=int, default=200, help="writes in the read-after-write check")
+    args = parser.parse_args()
+
+    fake = FakeRTDB(synthetic_data(args.payments), latency=args.latency).start()
+    previous = database.use_backend(database.FirebaseBackend(fake.url))
+    failures = []
+
+    try:
+        benchmark(fake, args.threads, args.rounds, failures)
+        check_copies(args.threads, failures)
+        check_read_after_write(args.threads // 4 or 1, args.writes, failures)
+        check_errors(args.threads, failures)
+    finally:
+        database.use_backend(previous)
+        fake.stop()
+
+    for failure in failures:
+        print(f"❌ {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Benchmark the storage backends on admin queries, cleanups and dashboards
+
+Loads the same synthetic dataset into the Firebase backend (a local fake
+RTDB over HTTP), the in-memory backend and the SQLite backend, then times
+the admin paths on each and checks they all return the same answers.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+import database
+from fake_rtdb import FakeRTDB
+from ids import IdGenerator
+from storage import MemoryBackend, SQLiteBackend
+
+DAY = 86400
+
+
+def synthetic_data(users):
+    """Users with payments (1 in 10 pending), token requests and admin logs"""
+    now = int(time.time())
+    start = now - 60 * DAY
+    clock = iter(start + 60 * DAY * number / users for number in range(users))
+    generator = IdGenerator(clock=lambda: next(clock))
+
+    data = {"users": {}, "payment_requests": {}, "pending_tokens": {}, "admin_logs": {}}
+    for number in range(users):
+        user_id = str(8000000000 + number)
+        record_id = generator.new_id()
+        created = int(start + 60 * DAY * number / users)
+        status = "pending" if number % 10 == 0 else "approved"
+
+        data["users"][user_id] = {"name": f"User {number}", "username": f"user{number}", "credits": number % 500,
+                                  "vip": number % 3 == 0, "expiry": 0, "created_at": created, "updated": created}
+        data["payment_requests"][record_id] = {"user_id": user_id, "amount": 50, "payment_method": "kpay",
+                                               "status": status, "status_key": f"{status}:{record_id}",
+                                               "created": created, "updated": created, "payment_id": record_id}
+        data["pending_tokens"][record_id] = {"user_id": user_id, "token": "TOKEN", "days": 30, "price": 100,
+                                             "status": "pending" if number % 4 == 0 else "approved",
+                                             "created": created}
+        data["admin_logs"].setdefault(database.day_bucket(created), {})[record_id] = {
+            "action": "approve_payment", "user_id": user_id, "timestamp": created
+        }
+    return data
+
+
+def operations(sample_user):
+    """name -> call; every call only reads, so each can repeat"""
+    return {
+        "user record": lambda: database.get(f"users/{sample_user}"),
+        "pending payments page": lambda: list(database.get_pending_payments_page(limit=20)["items"]),
+        "all pending payments": lambda: len(database.get_pending_payments()),
+        "token requests by user": lambda: list(database.get_user_requests(sample_user)),
+        "old token requests": lambda: len(database.query(
+            "pending_tokens", "created", end_at=int(time.time()) - 30 * DAY
+        )),
+        "users page": lambda: list(database.get_user_page(limit=50)["items"]),
+        "expired log buckets": lambda: database.expired_buckets("admin_logs", 30),
+        "dashboard (full scan)": lambda: database.compute_dashboard_stats()[0],
+    }
+
+
+def measure(call, reps):
+    """(result, median ms)"""
+    timings = []
+    for _ in range(reps):
+        start = time.perf_counter()
+        result = call()
+        timings.append(time.perf_counter() - start)
+    return result, statistics.median(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--reps", type=int, default=5)
+    args = parser.parse_args()
+
+    data = synthetic_data(args.users)
+    sample_user = str(8000000000 + args.users // 2)
+    directory = tempfile.mkdtemp(prefix="storage-")
+
+    fake = FakeRTDB().start()
+    backends = {
+        "firebase (local)": database.FirebaseBackend(fake.url),
+        "memory": MemoryBackend(),
+        "sqlite": SQLiteBackend(os.path.join(directory, "bench.sqlite3")),
+    }
+
+    results = {}
+    timings = {}
+    for name, backend in backends.items():
+        database.use_backend(backend)
+        start = time.perf_counter()
+        database.set("", data)
+        load = time.perf_counter() - start
+
+        for label, call in operations(sample_user).items():
+            database.user_cache.clear()
+            results[name, label], timings[name, label] = measure(call, args.reps)
+        timings[name, "load"] = load * 1000
+
+    names = list(backends)
+    print(f"{args.users:,} users, median of {args.reps} runs\n")
+    print(f"{'operation':<24}" + "".join(f"{name:>18}" for name in names))
+    print(f"{'load dataset':<24}" + "".join(f"{timings[name, 'load']:>15.1f} ms" for name in names))
+    for label in operations(sample_user):
+        same = all(results[name, label] == results[names[0], label] for name in names)
+        print(f"{label:<24}" + "".join(f"{timings[name, label]:>15.2f} ms" for name in names)
+              + ("  ✅" if same else "  ❌ results differ"))
+
+    for backend in backends.values():
+        backend.close()
+    fake.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,497 @@
+#!/usr/bin/env python3
+"""
+Benchmark every public database.py function against a local fake RTDB
+
+Seeds synthetic users, payments, tokens, token requests, logs and
+notifications (history spread over the past 200 days) at each scale,
+serves them from a fake Firebase REST server with optional injected
+latency, then times each function: throughput, latency percentiles, HTTP
+requests and bytes sent/received per call.
+
+Results are written as JSON (--output) so runs can be compared between
+commits:
+
+    python bench_suite.py --output before.json
+    git checkout my-branch
+    python bench_suite.py --output after.json --compare before.json
+"""
+
+import argparse
+import copy
+import inspect
+import json
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from functools import partial
+
+import database
+import ids
+from bench_database import percentile
+from database import WriteBatch
+from fake_rtdb import FakeRTDB
+from storage import MemoryBackend
+
+DAY = 86400
+HISTORY_DAYS = 200
+USER_BASE = 8000000000
+ADMIN_ID = 7000000000
+
+# Functions that configure the process rather than touch data
+SKIPPED = {
+    "get_session": "HTTP transport setup",
+    "close_session": "HTTP transport setup",
+    "start_mirrors": "starts background streams",
+    "stop_mirrors": "stops background streams",
+    "open_backend": "backend configuration",
+    "use_backend": "backend configuration",
+}
+
+# Slow full-tree functions: fewer repetitions
+HEAVY = {
+    "export_all_data", "compute_dashboard_stats", "reconcile_dashboard_stats", "reconcile_ledger",
+    "rebuild_user_indexes", "rebuild_vip_expiry_index", "run_all_cleanup", "cleanup_expired_vip",
+    "cleanup_old_requests", "cleanup_old_notifications", "cleanup_old_activity_logs", "cleanup_old_admin_logs",
+    "trim_recent_lists", "bulk_add_credits", "bulk_set_vip",
+}
+
+# Functions that delete seeded history: every call starts from the seeded data
+RESET = {
+    "run_all_cleanup", "cleanup_expired_vip", "cleanup_old_requests", "cleanup_old_notifications",
+    "cleanup_old_activity_logs", "cleanup_old_admin_logs", "trim_recent_lists",
+}
+
+
+# ========================
+# SYNTHETIC DATA
+# ========================
+@contextmanager
+def clock_at(timestamp):
+    """Run database writes as if it were timestamp (record stamps and ids)"""
+    real_time = time.time
+    offset = real_time() - timestamp
+    time.time = lambda: real_time() - offset
+    ids._generator.clock = time.time
+    try:
+        yield
+    finally:
+        time.time = real_time
+        ids._generator.clock = real_time
+
+
+def seed(users):
+    """Database contents for users, written through database.py on a memory backend"""
+    previous = database.use_backend(MemoryBackend())
+    start = time.time() - HISTORY_DAYS * DAY
+    try:
+        for number in range(users):
+            user_id = str(USER_BASE + number)
+            with clock_at(start + HISTORY_DAYS * DAY * number / users):
+                database.create_user(user_id, {
+                    "name": f"User {number}", "username": f"user{number}", "credits": 100 + number % 400
+                })
+                payment_id = database.add_payment_request(user_id, 50, "kpay", f"Transfer {number}")
+                if number % 10 > 1:
+                    database.approve_payment(payment_id, ADMIN_ID)
+                elif number % 10 == 1:
+                    database.reject_payment(payment_id, ADMIN_ID)
+                if number % 3 == 0:
+                    database.purchase_vip(user_id, 30, 50)
+                if number % 5 == 0:
+                    database.add_vpn_token(user_id, f"TOKEN{number}")
+                    request_id = database.create_request(user_id, f"TOKEN{number}", 30, 100)
+                    if number % 2:
+                        database.approve_request(request_id, ADMIN_ID)
+                database.log_user_activity(user_id, "start")
+                database.add_notification(user_id, "info", "Welcome")
+        return database.backend.data
+    finally:
+        database.use_backend(previous)
+
+
+# ========================
+# BENCHMARKS
+# ========================
+class Fixture:
+    """Arguments for benchmark calls (setup work here is not timed)"""
+
+    def __init__(self, users, rng):
+        self.users = [str(USER_BASE + number) for number in range(users)]
+        self.rng = rng
+        self.created = 0
+
+    def user(self):
+        return self.rng.choice(self.users)
+
+    def new_user(self):
+        self.created += 1
+        return str(USER_BASE * 10 + self.created)
+
+    def username(self):
+        return f"user{int(self.user()) - USER_BASE}"
+
+    def payment(self):
+        return database.add_payment_request(self.user(), 50, "kpay", "Bench transfer")
+
+    def request(self):
+        return database.create_request(self.user(), "BENCHTOKEN", 30, 100)
+
+    def token(self):
+        return database.add_vpn_token(self.user(), "BENCHTOKEN")
+
+    def notification(self):
+        user_id = self.user()
+        return user_id, database.add_notification(user_id, "info", "Bench")
+
+    def vip_user(self):
+        user_id = self.user()
+        database.add_vip(user_id, 1)
+        return user_id, database.get(f"users/{user_id}/expiry")
+
+    def broadcast(self):
+        return database.create_broadcast(ADMIN_ID, "Bench broadcast")
+
+    def some_users(self, count=50):
+        return self.rng.sample(self.users, count)
+
+
+def benchmarks(f):
+    """Function name -> setup returning the call to time"""
+    now = int(time.time())
+    return {
+        # Primitives and queries
+        "get": lambda: partial(database.get, f"users/{f.user()}"),
+        "set": lambda: partial(database.set, f"bench/{ids.new_id()}", {"value": 1}),
+        "update": lambda: partial(database.update, f"users/{f.user()}", {"last_active": now}),
+        "delete": lambda: partial(database.delete, f"bench/{ids.new_id()}"),
+        "read_tree": lambda: partial(database.read_tree, f"users/{f.user()}"),
+        "list_keys": lambda: partial(database.list_keys, "admin_logs"),
+        "query": lambda: partial(database.query, "payment_requests", "status", equal_to="pending"),
+        "query_page": lambda: partial(database.query_page, "users", "$key", limit=50),
+        "query_status_page": lambda: partial(database.query_status_page, "payment_requests", "approved"),
+        "transaction": lambda: partial(database.transaction, f"users/{f.user()}/credits", lambda credits: credits),
+        "claim_status": lambda: partial(
+            database.claim_status, f"payment_requests/{f.payment()}", "pending", "pending"
+        ),
+        "guarded_write": lambda: (lambda user_id: partial(
+            database.guarded_write, f"users/{user_id}",
+            lambda user_data, batch: database.touch(batch, f"users/{user_id}") or user_data
+        ))(f.user()),
+        "flush_pending_writes": lambda: partial(database.flush_pending_writes, f"users/{f.user()}"),
+        "apply_pending_writes": lambda: partial(
+            database.apply_pending_writes, WriteBatch(), f"users/{f.user()}",
+            {ids.new_id(): {"w0": {"path": "stats/counters/total_users", "increment": 1}}}
+        ),
+
+        # Pure helpers and batch builders
+        "increment": lambda: partial(database.increment, 1),
+        "path_prefix": lambda: partial(database.path_prefix, f"users/{f.user()}/credits"),
+        "day_bucket": lambda: partial(database.day_bucket),
+        "id_bucket": lambda: partial(database.id_bucket, ids.new_id()),
+        "is_bucket": lambda: partial(database.is_bucket, "2026-10-18"),
+        "admin_log_path": lambda: partial(database.admin_log_path, ids.new_id()),
+        "expired_buckets": lambda: partial(database.expired_buckets, "admin_logs", 30),
+        "index_record_day": lambda: partial(
+            database.index_record_day, WriteBatch(), "notifications", f.user(), ids.new_id()
+        ),
+        "status_key": lambda: partial(database.status_key, "pending", ids.new_id()),
+        "expiry_key": lambda: partial(database.expiry_key, now, f.user()),
+        "index_key": lambda: partial(database.index_key, "Some.User#1"),
+        "ngrams": lambda: partial(database.ngrams, "someusername"),
+        "user_ngrams": lambda: partial(database.user_ngrams, f.user(), {"name": "Some User", "username": "some"}),
+        "user_lock": lambda: partial(database.user_lock, f.user()),
+        "user_locks": lambda: partial(database.user_locks, f.some_users(10)),
+        "touch": lambda: partial(database.touch, WriteBatch(), f"users/{f.user()}"),
+        "count": lambda: partial(database.count, WriteBatch(), total_users=1, total_credits=10),
+        "push_recent": lambda: partial(database.push_recent, WriteBatch(), "users", f.user(), {"created": now}),
+        "ledger_entry": lambda: partial(database.ledger_entry, WriteBatch(), f.user(), 10, "credit"),
+        "search_entry": lambda: partial(database.search_entry, {"name": "Some User", "username": "some"}),
+        "index_user": lambda: partial(
+            database.index_user, WriteBatch(), f.user(), None, {"name": "Some User", "username": "some"}
+        ),
+        "index_vip_expiry": lambda: partial(database.index_vip_expiry, WriteBatch(), f.user(), None, now),
+        "queue_vip": lambda: partial(database.queue_vip, WriteBatch(), f.user(), {}, 30),
+
+        # Users
+        "create_user": lambda: partial(database.create_user, f.new_user(), {"name": "New User", "username": "new"}),
+        "get_user": lambda: partial(database.get_user, f.user()),
+        "update_user": lambda: partial(database.update_user, f.user(), {"name": "Renamed User"}),
+        "get_user_by_username": lambda: partial(database.get_user_by_username, f.username()),
+        "search_users": lambda: partial(database.search_users, "user12"),
+        "get_user_page": lambda: partial(database.get_user_page),
+        "get_vip_page": lambda: partial(database.get_vip_page),
+        "get_user_stats": lambda: partial(database.get_user_stats, f.user()),
+        "get_user_summary": lambda: partial(database.get_user_summary, f.user()),
+        "export_user_data": lambda: partial(database.export_user_data, f.user()),
+        "validate_user_id": lambda: partial(database.validate_user_id, f.user()),
+        "get_cache_stats": lambda: partial(database.get_cache_stats),
+        "get_single_flight_stats": lambda: partial(database.get_single_flight_stats),
+        "rebuild_user_indexes": lambda: partial(database.rebuild_user_indexes),
+
+        # Credits and ledger
+        "add_credits": lambda: partial(database.add_credits, f.user(), 10),
+        "cut_credits": lambda: partial(database.cut_credits, f.user(), 1),
+        "bulk_add_credits": lambda: partial(
+            database.bulk_add_credits, {user_id: 10 for user_id in f.some_users()}, ADMIN_ID
+        ),
+        "ledger_balance": lambda: partial(database.ledger_balance, f.user()),
+        "balance_at": lambda: partial(database.balance_at, f.user()),
+        "latest_snapshot": lambda: partial(database.latest_snapshot, f.user()),
+        "stream_ledger": lambda: (lambda user_id: lambda: list(database.stream_ledger(user_id)))(f.user()),
+        "snapshot_ledger": lambda: partial(database.snapshot_ledger, f.user()),
+        "get_credit_history": lambda: partial(database.get_credit_history, f.user()),
+        "ledger_statement": lambda: partial(
+            database.ledger_statement, f.user(), *map(int, database.day_bucket().split("-")[:2])
+        ),
+        "reconcile_ledger": lambda: partial(database.reconcile_ledger),
+
+        # VIP
+        "add_vip": lambda: partial(database.add_vip, f.user(), 30),
+        "purchase_vip": lambda: partial(database.purchase_vip, f.user(), 30, 1),
+        "get_vip_status": lambda: partial(database.get_vip_status, f.user()),
+        "bulk_set_vip": lambda: partial(database.bulk_set_vip, {user_id: 30 for user_id in f.some_users()}, ADMIN_ID),
+        "get_expiring": lambda: partial(database.get_expiring, now + 7 * DAY),
+        "expire_vip": lambda: partial(database.expire_vip, *f.vip_user()),
+        "warn_vip_expiry": lambda: partial(database.warn_vip_expiry, *f.vip_user()),
+        "cleanup_expired_vip": lambda: partial(database.cleanup_expired_vip),
+        "rebuild_vip_expiry_index": lambda: partial(database.rebuild_vip_expiry_index),
+
+        # Payments
+        "add_payment_request": lambda: partial(database.add_payment_request, f.user(), 50, "kpay", "Bench transfer"),
+        "get_payment_request": lambda: partial(database.get_payment_request, f.payment()),
+        "approve_payment": lambda: partial(database.approve_payment, f.payment(), ADMIN_ID),
+        "reject_payment": lambda: partial(database.reject_payment, f.payment(), ADMIN_ID),
+        "get_pending_payments": lambda: partial(database.get_pending_payments),
+        "get_pending_payments_page": lambda: partial(database.get_pending_payments_page),
+        "get_user_payments": lambda: partial(database.get_user_payments, f.user()),
+        "validate_payment_id": lambda: partial(database.validate_payment_id, f.payment()),
+
+        # Tokens and token requests
+        "add_vpn_token": lambda: partial(database.add_vpn_token, f.user(), "BENCHTOKEN"),
+        "get_vpn_token": lambda: partial(database.get_vpn_token, f.token()),
+        "mark_token_processed": lambda: partial(database.mark_token_processed, f.token(), ADMIN_ID),
+        "get_pending_tokens": lambda: partial(database.get_pending_tokens),
+        "get_pending_tokens_page": lambda: partial(database.get_pending_tokens_page),
+        "get_user_tokens": lambda: partial(database.get_user_tokens, f.user()),
+        "validate_token_id": lambda: partial(database.validate_token_id, f.token()),
+        "create_request": lambda: partial(database.create_request, f.user(), "BENCHTOKEN", 30, 100),
+        "get_request": lambda: partial(database.get_request, f.request()),
+        "approve_request": lambda: partial(database.approve_request, f.request(), ADMIN_ID),
+        "get_user_requests": lambda: partial(database.get_user_requests, f.user()),
+        "validate_request_id": lambda: partial(database.validate_request_id, f.request()),
+        "cleanup_old_requests": lambda: partial(database.cleanup_old_requests),
+
+        # Logs and notifications
+        "log_user_activity": lambda: partial(database.log_user_activity, f.user(), "bench"),
+        "get_user_activity": lambda: partial(database.get_user_activity, f.user()),
+        "add_notification": lambda: partial(database.add_notification, f.user(), "info", "Bench"),
+        "get_user_notifications": lambda: partial(database.get_user_notifications, f.user()),
+        "mark_notification_read": lambda: partial(database.mark_notification_read, *f.notification()),
+        "cleanup_old_notifications": lambda: partial(database.cleanup_old_notifications),
+        "cleanup_old_activity_logs": lambda: partial(database.cleanup_old_activity_logs),
+        "cleanup_old_admin_logs": lambda: partial(database.cleanup_old_admin_logs),
+
+        # Dashboard and admin tools
+        "get_admin_dashboard": lambda: partial(database.get_admin_dashboard),
+        "compute_dashboard_stats": lambda: partial(database.compute_dashboard_stats),
+        "reconcile_dashboard_stats": lambda: partial(database.reconcile_dashboard_stats),
+        "trim_recent_lists": lambda: partial(database.trim_recent_lists),
+        "run_all_cleanup": lambda: partial(database.run_all_cleanup),
+        "export_all_data": lambda: partial(database.export_all_data),
+
+        # Broadcasts
+        "create_broadcast": lambda: partial(database.create_broadcast, ADMIN_ID, "Bench broadcast"),
+        "get_broadcast": lambda: partial(database.get_broadcast, f.broadcast()),
+        "checkpoint_broadcast": lambda: partial(database.checkpoint_broadcast, f.broadcast(), {"sent": 1}),
+        "finish_broadcast": lambda: partial(database.finish_broadcast, f.broadcast(), {"sent": 1}),
+        "get_active_broadcasts": lambda: partial(database.get_active_broadcasts),
+
+        # Test helpers
+        "create_test_user": lambda: partial(database.create_test_user, f.new_user()),
+        "create_test_payment": lambda: partial(database.create_test_payment, f.user()),
+        "create_test_request": lambda: partial(database.create_test_request, f.user()),
+        "create_test_token": lambda: partial(database.create_test_token, f.user()),
+    }
+
+
+def public_functions():
+    return sorted(
+        name for name, function in inspect.getmembers(database, inspect.isfunction)
+        if not name.startswith("_") and function.__module__ == "database"
+    )
+
+
+# ========================
+# MEASURING
+# ========================
+class Traffic:
+    """HTTP requests and bytes seen by the shared database session"""
+
+    def __init__(self):
+        self.requests = self.sent = self.received = 0
+        database.get_session().hooks["response"].append(self._count)
+
+    def _count(self, response, **kwargs):
+        body = response.request.body or b""
+        self.requests += 1
+        self.sent += len(body.encode() if isinstance(body, str) else body)
+        self.received += len(response.content)
+
+    def reset(self):
+        self.requests = self.sent = self.received = 0
+
+
+def run_benchmark(setup, reps, traffic, before_call=None):
+    """Stats for reps timed calls (setup and before_call are not timed)"""
+    timings = []
+    requests = sent = received = 0
+
+    for _ in range(reps):
+        if before_call is not None:
+            before_call()
+        call = setup()
+        database.user_cache.clear()
+        traffic.reset()
+
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+
+        requests += traffic.requests
+        sent += traffic.sent
+        received += traffic.received
+
+    ms = [timing * 1000 for timing in timings]
+    return {
+        "calls": reps,
+        "ops_per_sec": reps / sum(timings),
+        "mean_ms": sum(ms) / reps,
+        "p50_ms": percentile(ms, 50),
+        "p95_ms": percentile(ms, 95),
+        "p99_ms": percentile(ms, 99),
+        "requests_per_call": requests / reps,
+        "bytes_sent_per_call": sent / reps,
+        "bytes_received_per_call": received / reps,
+    }
+
+
+def run_scale(users, args, traffic, pattern):
+    print(f"\n⏳ seeding {users:,} users...", flush=True)
+    data = seed(users)
+    fake = FakeRTDB(copy.deepcopy(data)).start()
+    database.use_backend(database.FirebaseBackend(fake.url))
+    fake.latency = args.latency
+
+    fixture = Fixture(users, random.Random(args.seed))
+    results = {}
+    print(f"{'function':<28} {'ops/s':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'reqs':>6} {'sent':>9} {'received':>10}")
+
+    for name, setup in benchmarks(fixture).items():
+        if not pattern.search(name):
+            continue
+
+        def restore():
+            fake.data = copy.deepcopy(data)
+
+        reps = min(args.reps, args.heavy_reps) if name in HEAVY else args.reps
+        stats = results[name] = run_benchmark(setup, reps, traffic, restore if name in RESET else None)
+        print(f"{name:<28} {stats['ops_per_sec']:>9,.1f} {stats['p50_ms']:>7.2f}ms {stats['p95_ms']:>7.2f}ms "
+              f"{stats['p99_ms']:>7.2f}ms {stats['requests_per_call']:>6.1f} {stats['bytes_sent_per_call']:>9,.0f} "
+              f"{stats['bytes_received_per_call']:>10,.0f}", flush=True)
+
+    fake.stop()
+    return results
+
+
+# ========================
+# COMPARING RUNS
+# ========================
+def compare(old, new, threshold):
+    """Print p50 and bytes ratios new/old; returns the regressions"""
+    regressions = []
+    print(f"\n📊 compared with {old['meta'].get('commit') or 'previous run'} (regression: > {threshold:.2f}x)")
+    print(f"{'scale':>8} {'function':<28} {'p50 old':>10} {'p50 new':>10} {'ratio':>7} {'bytes ratio':>12}")
+
+    for scale, functions in new["results"].items():
+        for name, stats in functions.items():
+            before = old["results"].get(scale, {}).get(name)
+            if before is None:
+                continue
+            ratio = stats["p50_ms"] / before["p50_ms"] if before["p50_ms"] else 1.0
+            old_bytes = before["bytes_sent_per_call"] + before["bytes_received_per_call"]
+            new_bytes = stats["bytes_sent_per_call"] + stats["bytes_received_per_call"]
+            bytes_ratio = new_bytes / old_bytes if old_bytes else (1.0 if not new_bytes else float("inf"))
+
+            flag = ""
+            if ratio > threshold or bytes_ratio > threshold:
+                flag = " ❌"
+                regressions.append((scale, name))
+            elif ratio < 1 / threshold:
+                flag = " ✅"
+            print(f"{scale:>8} {name:<28} {before['p50_ms']:>8.2f}ms {stats['p50_ms']:>8.2f}ms "
+                  f"{ratio:>6.2f}x {bytes_ratio:>11.2f}x{flag}")
+
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1000,10000", help="seeded users per run")
+    parser.add_argument("--latency", type=float, default=0.0, help="injected server latency per request (s)")
+    parser.add_argument("--reps", type=int, default=20, help="calls per function")
+    parser.add_argument("--heavy-reps", type=int, default=3, help="calls per full-tree function")
+    parser.add_argument("--only", default="", help="regex: benchmark only matching functions")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=1.25, help="slowdown ratio counted as a regression")
+    args = parser.parse_args()
+
+    names = public_functions()
+    covered = set(benchmarks(Fixture(1, random.Random())))
+    missing = [name for name in names if name not in covered and name not in SKIPPED]
+    if missing:
+        print(f"⚠️ no benchmark for: {', '.join(missing)}")
+
+    traffic = Traffic()
+    pattern = re.compile(args.only)
+    results = {str(users): run_scale(users, args, traffic, pattern) for users in map(int, args.scales.split(","))}
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created": int(time.time()),
+            "python": platform.python_version(),
+            "latency": args.latency,
+            "reps": args.reps,
+            "heavy_reps": args.heavy_reps,
+            "skipped": SKIPPED,
+            "missing": missing,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,14 +3,24 @@
 KSP VIP VPN - Complete Auto System
 """
 
+import functools
 import logging
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import time
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters
 import json
+import metrics
+import tracing
 from database import (
-    get_user, create_user, add_credits, cut_credits, add_vip,
-    get_vip_status, add_payment_request, create_request, approve_request
+    get_user, create_user, add_credits, purchase_vip,
+    get_vip_status, add_payment_request, create_request, approve_request,
+    start_mirrors, create_broadcast, get_active_broadcasts, get_broadcast
 )
+from broadcast import cancel_broadcast, progress, resume_broadcasts, runners, start_broadcast
+from metrics import MetricsServer
+from sender import SendScheduler
+from vip_scheduler import ExpiryScheduler
+from webhook import WebhookServer
 
 # Setup
 logging.basicConfig(level=logging.INFO)
@@ -25,9 +35,41 @@ with open("config.json") as f:
 BOT_TOKEN = config["BOT_TOKEN"]
 ADMIN_ID = config["ADMIN_ID"]
 
+# Handlers run on this many worker threads, so slow database/API calls of one
+# update don't hold up the others (keep HTTP_POOL_SIZE at least this large)
+BOT_WORKERS = config.get("BOT_WORKERS", 64)
+
+# Webhook mode (used when WEBHOOK_URL is set, e.g. "https://bot.example.com")
+WEBHOOK_URL = config.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = config.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = config.get("WEBHOOK_PORT", 8443)
+WEBHOOK_PATH = config.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = config.get("WEBHOOK_SECRET")
+WEBHOOK_QUEUE_SIZE = config.get("WEBHOOK_QUEUE_SIZE", 1000)
+
+# Outbound sends (Telegram allows ~30 msgs/s overall, 1 msg/s per chat)
+SEND_RATE = config.get("SEND_RATE", 25)
+SEND_WORKERS = config.get("SEND_WORKERS", 8)
+
+# Prometheus text endpoint at http://METRICS_LISTEN:METRICS_PORT/metrics (off unless set)
+METRICS_PORT = config.get("METRICS_PORT")
+METRICS_LISTEN = config.get("METRICS_LISTEN", "127.0.0.1")
+
+# Updates slower than TRACE_SLOW_MS are traced to TRACE_FILE (null turns tracing off);
+# summarize with: python tracing.py traces.jsonl
+TRACE_FILE = config.get("TRACE_FILE", "traces.jsonl")
+TRACE_SLOW_MS = config.get("TRACE_SLOW_MS", 1000)
+TRACE_SAMPLE = config.get("TRACE_SAMPLE", 1.0)
+
 # User states for conversation
 user_states = {}
 
+# Rate-limited send queue, started in main(); handlers enqueue and return
+outbox = None
+
+# Turns VIP off (and tells the user) when subscriptions end, started in main()
+vip_expiry = None
+
 # ========================
 # INLINE KEYBOARDS
 # ========================
@@ -60,9 +102,63 @@ def vip_packages_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+# ========================
+# METRICS
+# ========================
+# Buttons labelled by name; the rest collapse so labels stay few
+BUTTON_BRANCHES = {'main_menu', 'add_money', 'buy_vip', 'check_balance', 'submit_token', 'send_screenshot'}
+
+def button_branch(update, context):
+    """Metric label of a button: credit_100 -> credit_N, vip_2month -> vip_Nmonth"""
+    data = update.callback_query.data or ''
+    if data.startswith('credit_'):
+        return {"branch": "credit_N"}
+    if data.startswith('vip_'):
+        return {"branch": "vip_Nmonth"}
+    return {"branch": data if data in BUTTON_BRANCHES else "other"}
+
+def message_branch(update, context):
+    """Metric label of a message: photo, /token, /sendtoken or text"""
+    message = update.message
+    if message.photo:
+        return {"branch": "photo"}
+    text = message.text or ''
+    if text.startswith('/sendtoken'):
+        return {"branch": "sendtoken"}
+    if text.startswith('/token'):
+        return {"branch": "token"}
+    return {"branch": "text"}
+
+def instrumented(name, branch=None):
+    """Trace each update through the handler and time it into handler_seconds"""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(update, context):
+            labels = branch(update, context) if branch else {"branch": ""}
+            user = update.effective_user
+            trace_name = f"{name}:{labels['branch']}" if labels["branch"] else name
+            with tracing.trace(trace_name, update_id=update.update_id, user_id=user.id if user else None):
+                with metrics.timer("handler_seconds", handler=name, **labels):
+                    return handler(update, context)
+        return wrapper
+    return decorate
+
+def instrument_bot(api):
+    """Time every Bot API call made through api into telegram_seconds and the current trace"""
+    post = api._post
+    
+    def timed_post(endpoint, data=None, *args, **kwargs):
+        with metrics.timer("telegram_seconds", method=endpoint):
+            with tracing.span("telegram", endpoint) as span:
+                return span.received(post(endpoint, span.sent(data), *args, **kwargs))
+    
+    api._post = timed_post
+    return api
+
 # ========================
 # COMMAND HANDLERS
 # ========================
+@instrumented("start")
 def start(update, context):
     """Start command"""
     user = update.effective_user
@@ -93,6 +189,7 @@ def start(update, context):
 # ========================
 # BUTTON HANDLERS
 # ========================
+@instrumented("button_handler", button_branch)
 def button_handler(update, context):
     """Handle inline buttons"""
     query = update.callback_query
@@ -100,10 +197,10 @@ def button_handler(update, context):
     data = query.data
     
     # Ensure user exists
-    if not get_user(user_id):
-        create_user(user_id, {"name": query.from_user.first_name})
+    user_data = get_user(user_id)
+    if not user_data:
+        user_data = create_user(user_id, {"name": query.from_user.first_name})
     
-    user_data = get_user(user_id) or {}
     credits = user_data.get('credits', 0)
     
     if data == 'main_menu':
@@ -224,16 +321,15 @@ def button_handler(update, context):
             '6month': {"days": 180, "credits": 200, "name": "6 လ VIP"}
         }
         
-        package_id = data
+        package_id = data.replace('vip_', '')
         package = packages.get(package_id)
         
         if package:
-            if credits >= package['credits']:
-                # Activate VIP
-                add_vip(user_id, package['days'])
-                cut_credits(user_id, package['credits'])
-                
-                new_credits = credits - package['credits']
+            # Check, debit and activate VIP in one conditional write
+            result = purchase_vip(user_id, package['days'], package['credits'], ref=package_id)
+            
+            if result['success']:
+                new_credits = result['new_balance']
                 
                 query.edit_message_text(
                     f"🎉 *VIP အောင်မြင်စွာဖွင့်လိုက်ပါပြီ!*\n\n"
@@ -247,7 +343,7 @@ def button_handler(update, context):
                 )
                 
                 # Ask for token
-                context.bot.send_message(
+                outbox.send_message(
                     chat_id=user_id,
                     text="🔑 *VPN Token တောင်းခံခြင်း*\n\n"
                          "ကျေးဇူးပြု၍ VPN app ထဲမှ token ကို အောက်ပါအတိုင်းပို့ပါ:\n\n"
@@ -257,7 +353,17 @@ def button_handler(update, context):
                     parse_mode='Markdown'
                 )
                 
+            elif result['message'] != 'insufficient_credits':
+                # Lost to concurrent writes (or no user record): nothing was charged
+                query.edit_message_text(
+                    "❌ မှားယွင်းမှု ဖြစ်ပွားပါသည်။ ခဏအကြာတွင် ပြန်ကြိုးစားပါ။",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🔙 နောက်သို့", callback_data='buy_vip')]
+                    ])
+                )
+            
             else:
+                credits = (get_user(user_id) or {}).get('credits', 0)
                 needed = package['credits'] - credits
                 query.edit_message_text(
                     f"❌ *ငွေမလုံလောက်ပါ*\n\n"
@@ -287,6 +393,7 @@ def button_handler(update, context):
 # ========================
 # MESSAGE HANDLERS
 # ========================
+@instrumented("handle_message", message_branch)
 def handle_message(update, context):
     """Handle messages and photos"""
     user_id = update.effective_user.id
@@ -303,7 +410,7 @@ def handle_message(update, context):
         )
         
         # Forward photo to admin
-        context.bot.send_photo(
+        outbox.send_photo(
             chat_id=ADMIN_ID,
             photo=message.photo[-1].file_id,
             caption=caption,
@@ -347,7 +454,7 @@ def handle_message(update, context):
                     f"*အတည်ပြုရန်:* `/approve {req_id}`"
                 )
                 
-                context.bot.send_message(
+                outbox.send_message(
                     chat_id=ADMIN_ID,
                     text=admin_msg,
                     parse_mode='Markdown'
@@ -380,7 +487,7 @@ def handle_message(update, context):
                 f"*မှတ်ချက်:* User သည် VIP ဝယ်ယူပြီးဖြစ်သည်။"
             )
             
-            context.bot.send_message(
+            outbox.send_message(
                 chat_id=ADMIN_ID,
                 text=admin_msg,
                 parse_mode='Markdown'
@@ -398,6 +505,7 @@ def handle_message(update, context):
 # ========================
 # ADMIN COMMANDS
 # ========================
+@instrumented("admin_approve")
 def admin_approve(update, context):
     """Admin approve payment or token"""
     user_id = update.effective_user.id
@@ -415,10 +523,10 @@ def admin_approve(update, context):
         credits = int(context.args[1])
         
         # Add credits
-        new_balance = add_credits(target_user, credits)
+        new_balance = add_credits(target_user, credits, kind="admin", ref=user_id)
         
         # Notify user
-        context.bot.send_message(
+        outbox.send_message(
             chat_id=target_user,
             text=f"✅ *ငွေဖြည့်သွင်းပြီးပါပြီ*\n\n"
                  f"💰 ဖြည့်သွင်းငွေ: {credits} credits\n"
@@ -436,26 +544,168 @@ def admin_approve(update, context):
     except Exception as e:
         update.message.reply_text(f"❌ မှားယွင်းမှု: {str(e)}")
 
+def broadcast_text(broadcast_id, summary, finished=False):
+    """Admin progress message for a broadcast"""
+    lines = [
+        f"{'🏁' if finished else '📣'} *Broadcast* `{broadcast_id}`\n",
+        f"✅ ပို့ပြီး: {summary['sent']} / {summary['total']} ({summary['percent']}%)",
+        f"🚫 Block ထားသူ: {summary['blocked']}",
+        f"❌ မအောင်မြင်: {summary['failed']}"
+    ]
+    if not finished and summary.get("rate"):
+        minutes, seconds = divmod(summary["eta_seconds"], 60)
+        lines.append(f"⚡ {summary['rate']} msg/s  ⏳ ETA {minutes}m {seconds}s")
+    return "\n".join(lines)
+
+def report_broadcast(broadcast_id, summary, finished):
+    outbox.send_message(chat_id=ADMIN_ID, text=broadcast_text(broadcast_id, summary, finished), parse_mode='Markdown')
+
+@instrumented("admin_broadcast")
+def admin_broadcast(update, context):
+    """Admin broadcast: /broadcast all|vip TEXT, /broadcast status, /broadcast cancel ID"""
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        update.message.reply_text("❌ Admin များသာလုပ်ဆောင်နိုင်ပါသည်")
+        return
+    
+    parts = update.message.text.split(maxsplit=2)
+    action = parts[1] if len(parts) > 1 else ""
+    
+    if action == "status":
+        active = get_active_broadcasts()
+        if not active:
+            update.message.reply_text("📭 လက်ရှိ broadcast မရှိပါ")
+        for broadcast_id, broadcast_data in active.items():
+            runner = runners.get(broadcast_id)
+            summary = runner.summary() if runner else progress(broadcast_data)
+            update.message.reply_text(broadcast_text(broadcast_id, summary), parse_mode='Markdown')
+    
+    elif action == "cancel" and len(parts) == 3:
+        if not get_broadcast(parts[2]):
+            update.message.reply_text("❌ Broadcast မတွေ့ပါ")
+            return
+        cancel_broadcast(parts[2])
+        update.message.reply_text(f"🛑 Broadcast `{parts[2]}` ကို ရပ်လိုက်ပါပြီ", parse_mode='Markdown')
+    
+    elif action in ("all", "vip") and len(parts) == 3:
+        broadcast_id = create_broadcast(ADMIN_ID, parts[2], audience=action)
+        start_broadcast(outbox, broadcast_id, on_progress=report_broadcast)
+        update.message.reply_text(
+            f"📣 Broadcast `{broadcast_id}` စတင်ပါပြီ\n\n"
+            f"အခြေအနေကြည့်ရန်: `/broadcast status`",
+            parse_mode='Markdown'
+        )
+    
+    else:
+        update.message.reply_text(
+            "အသုံးပြုနည်း:\n"
+            "`/broadcast all MESSAGE`\n"
+            "`/broadcast vip MESSAGE`\n"
+            "`/broadcast status`\n"
+            "`/broadcast cancel ID`",
+            parse_mode='Markdown'
+        )
+
+@instrumented("admin_stats")
+def admin_stats(update, context):
+    """Admin metrics: handler, storage and Bot API latencies, cache and queues"""
+    if str(update.effective_user.id) != str(ADMIN_ID):
+        update.message.reply_text("❌ Admin များသာလုပ်ဆောင်နိုင်ပါသည်")
+        return
+    
+    report = metrics.registry.report()
+    if len(report) > 3800:
+        report = report[:3800].rsplit("\n", 1)[0] + "\n..."
+    update.message.reply_text(f"📈 *Bot metrics*\n```\n{report}\n```", parse_mode='Markdown')
+
 # ========================
 # MAIN FUNCTION
 # ========================
+def add_handlers(dp, run_async=True):
+    """Register all handlers on a dispatcher"""
+    # Command handlers
+    dp.add_handler(CommandHandler("start", start, run_async=run_async))
+    dp.add_handler(CommandHandler("approve", admin_approve, run_async=run_async))
+    dp.add_handler(CommandHandler("broadcast", admin_broadcast, run_async=run_async))
+    dp.add_handler(CommandHandler("stats", admin_stats, run_async=run_async))
+    
+    # Button handler
+    dp.add_handler(CallbackQueryHandler(button_handler, run_async=run_async))
+    
+    # Message handler
+    dp.add_handler(MessageHandler(Filters.text | Filters.photo, handle_message, run_async=run_async))
+
+def run_webhook(updater):
+    """Serve updates from the webhook queue until interrupted"""
+    dp = updater.dispatcher
+    
+    # Webhook workers run the handlers themselves, so the bounded queue is
+    # the only place updates wait
+    server = WebhookServer(
+        lambda data: dp.process_update(Update.de_json(data, dp.bot)),
+        host=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        path=WEBHOOK_PATH,
+        queue_size=WEBHOOK_QUEUE_SIZE,
+        workers=BOT_WORKERS,
+        secret_token=WEBHOOK_SECRET
+    ).start()
+    metrics.gauge("webhook", server.metrics)
+    
+    updater.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        max_connections=100
+    )
+    print(f"🔗 Webhook listening on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    
+    try:
+        while True:
+            time.sleep(60)
+            logging.info("Webhook queue: %s", server.metrics())
+    except KeyboardInterrupt:
+        server.stop()
+
 def main():
     """Start bot"""
+    global outbox, vip_expiry
+    
     try:
-        updater = Updater(BOT_TOKEN, use_context=True)
-        dp = updater.dispatcher
+        tracing.configure(TRACE_FILE, slow_ms=TRACE_SLOW_MS, sample=TRACE_SAMPLE)
+        updater = Updater(BOT_TOKEN, use_context=True, workers=BOT_WORKERS)
+        instrument_bot(updater.bot)
+        outbox = SendScheduler(
+            updater.bot,
+            global_rate=SEND_RATE,
+            admin_chat=ADMIN_ID,
+            workers=SEND_WORKERS
+        ).start()
+        
+        # Queue depths for /stats and the metrics endpoint
+        metrics.gauge("updates_queued", updater.dispatcher.update_queue.qsize)
+        metrics.gauge("outbox", outbox.metrics)
+        if METRICS_PORT:
+            metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT).start()
+            print(f"📈 Metrics at {metrics_server.url}")
+        
+        # Pick up broadcasts interrupted by a restart
+        for runner in resume_broadcasts(outbox, on_progress=report_broadcast):
+            print(f"📣 Resuming broadcast {runner.broadcast_id}")
+        add_handlers(updater.dispatcher, run_async=not WEBHOOK_URL)
+        vip_expiry = ExpiryScheduler(outbox).start()
         
-        # Command handlers
-        dp.add_handler(CommandHandler("start", start))
-        dp.add_handler(CommandHandler("approve", admin_approve))
+        # Live mirrors of hot trees (MIRROR_PATHS in config.json)
+        mirrors = start_mirrors()
+        if mirrors:
+            print(f"🪞 Mirroring: {', '.join(mirrors)}")
         
-        # Button handler
-        dp.add_handler(CallbackQueryHandler(button_handler))
+        print(f"✅ Bot setup complete ({BOT_WORKERS} workers)")
         
-        # Message handler
-        dp.add_handler(MessageHandler(Filters.text | Filters.photo, handle_message))
+        if WEBHOOK_URL:
+            run_webhook(updater)
+            vip_expiry.stop()
+            outbox.stop()
+            return
         
-        print("✅ Bot setup complete")
         print("🔄 Starting polling...")
         
         updater.start_polling()
@@ -466,11 +716,14 @@ def main():
         print("✨ Features:")
         print("  • ငွေဖြည့်သွင်းစနစ်")
         print("  • VIP ဝယ်ယူစနစ်")
+        print("  • VIP သက်တမ်းကုန် အလိုအလျောက်စစ်ဆေးစနစ်")
         print("  • Token တင်သွင်းစနစ်")
         print("  • Admin ထိန်းချုပ်စနစ်")
         print("=" * 60)
         
         updater.idle()
+        vip_expiry.stop()
+        outbox.stop()
         
     except Exception as e:
         print(f"❌ Error: {e}")
@@ -0,0 +1,203 @@
+"""
+Broadcast engine: message all (or VIP) users through the rate-limited send queue
+
+Recipients are read one page at a time (VIP broadcasts page over the VIP
+expiry index instead of every user), and progress is checkpointed on
+broadcasts/{id} after every page, so a restart resumes from the last
+finished page (at most one page may be sent twice).
+"""
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+from database import (
+    BROADCAST_COUNTS, checkpoint_broadcast, finish_broadcast, get_active_broadcasts, get_broadcast,
+    get_user_page, get_vip_page
+)
+from sender import BULK
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 200
+
+# Sends of a page still not answered this long after it was queued count as failed
+SEND_TIMEOUT = 300
+
+# Running broadcasts in this process, by id
+runners = {}
+
+
+def is_blocked_error(error):
+    """True for send errors that mean the user can't be reached at all"""
+    text = str(error).lower()
+    return (
+        type(error).__name__ in ("Unauthorized", "Forbidden")
+        or "blocked" in text or "chat not found" in text or "deactivated" in text
+    )
+
+
+def wants(broadcast_data, user_data):
+    """Whether a user is in the broadcast's audience"""
+    if broadcast_data.get("audience") == "vip":
+        return bool(user_data.get("vip")) and user_data.get("expiry", 0) > time.time()
+    return True
+
+
+def progress(broadcast_data, rate=None):
+    """Summary with completion and ETA (rate in messages per second)"""
+    done = sum(broadcast_data.get(name, 0) for name in ("sent", "failed", "blocked"))
+    total = max(broadcast_data.get("total", 0), done)
+    summary = {
+        "done": done,
+        "total": total,
+        "percent": round(done * 100 / total, 1) if total else 100.0,
+        **{name: broadcast_data.get(name, 0) for name in BROADCAST_COUNTS}
+    }
+    if rate:
+        summary["rate"] = round(rate, 1)
+        summary["eta_seconds"] = int((total - done) / rate)
+    return summary
+
+
+class BroadcastRunner:
+    """Background thread that sends one broadcast, page by page"""
+
+    def __init__(self, outbox, broadcast_id, page_size=PAGE_SIZE, on_progress=None, progress_every=60,
+                 send_timeout=SEND_TIMEOUT):
+        self.outbox = outbox
+        self.broadcast_id = broadcast_id
+        self.page_size = page_size
+        self.send_timeout = send_timeout
+        self.on_progress = on_progress
+        self.progress_every = progress_every
+
+        self.stopping = threading.Event()
+        self.thread = None
+        self.data = None
+        self.rate = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"broadcast-{self.broadcast_id}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """Stop after the current page (the broadcast stays resumable)"""
+        self.stopping.set()
+
+    def summary(self):
+        return progress(self.data or {}, self.rate)
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception:
+            logger.exception("Broadcast %s failed", self.broadcast_id)
+        finally:
+            runners.pop(self.broadcast_id, None)
+
+    def _page(self, cursor):
+        """(recipients by user id, cursor after the page, whether it was the last page)"""
+        if self.data.get("audience") == "vip":
+            page = get_vip_page(self.page_size, cursor)
+            recipients = {
+                entry["user_id"]: {"vip": True, "expiry": entry.get("expiry", 0)}
+                for entry in page["items"].values() if isinstance(entry, dict) and "user_id" in entry
+            }
+        else:
+            page = get_user_page(self.page_size, cursor)
+            recipients = page["items"]
+
+        if page["items"]:
+            cursor = list(page["items"])[-1]
+        return recipients, cursor, page["next_cursor"] is None
+
+    def run(self):
+        self.data = get_broadcast(self.broadcast_id)
+        if not self.data or self.data.get("status") != "running":
+            return
+
+        counts = {name: self.data.get(name, 0) for name in BROADCAST_COUNTS}
+        cursor = self.data.get("cursor")
+        started = time.monotonic()
+        last_report = started
+        sent_at_start = counts["sent"] + counts["failed"] + counts["blocked"]
+
+        while not self.stopping.is_set():
+            recipients, cursor, finished = self._page(cursor)
+            futures = []
+
+            for user_id, user_data in recipients.items():
+                if not isinstance(user_data, dict) or not wants(self.data, user_data):
+                    counts["skipped"] += 1
+                    continue
+                futures.append(self.outbox.send_message(
+                    user_id,
+                    self.data["text"],
+                    priority=BULK,
+                    **({"parse_mode": self.data["parse_mode"]} if self.data.get("parse_mode") else {})
+                ))
+
+            # Blocked users fail fast; only flood waits are retried by the sender
+            deadline = time.monotonic() + self.send_timeout
+            for future in futures:
+                try:
+                    error = future.exception(timeout=max(0, deadline - time.monotonic()))
+                except concurrent.futures.TimeoutError as e:
+                    error = e
+                if error is None:
+                    counts["sent"] += 1
+                elif is_blocked_error(error):
+                    counts["blocked"] += 1
+                else:
+                    counts["failed"] += 1
+
+            fields = {**counts, "cursor": cursor}
+            if not finished:
+                checkpoint_broadcast(self.broadcast_id, fields)
+            elif finish_broadcast(self.broadcast_id, fields):
+                fields["status"] = "done"
+            else:
+                # Cancelled while the last page went out: keep the counts, not the status
+                checkpoint_broadcast(self.broadcast_id, fields)
+                fields["status"] = (get_broadcast(self.broadcast_id) or {}).get("status", "cancelled")
+            self.data.update(fields)
+
+            elapsed = time.monotonic() - started
+            done = counts["sent"] + counts["failed"] + counts["blocked"]
+            self.rate = (done - sent_at_start) / elapsed if elapsed > 0 else None
+
+            if self.on_progress and (finished or time.monotonic() - last_report >= self.progress_every):
+                last_report = time.monotonic()
+                self.on_progress(self.broadcast_id, self.summary(), finished)
+
+            if finished:
+                return
+
+
+# ========================
+# CONTROL
+# ========================
+def start_broadcast(outbox, broadcast_id, on_progress=None, **kwargs):
+    """Start (or resume) a broadcast in the background"""
+    if broadcast_id in runners:
+        return runners[broadcast_id]
+
+    runner = BroadcastRunner(outbox, broadcast_id, on_progress=on_progress, **kwargs)
+    runners[broadcast_id] = runner
+    return runner.start()
+
+
+def resume_broadcasts(outbox, on_progress=None):
+    """Resume every broadcast left running by a previous process"""
+    return [start_broadcast(outbox, broadcast_id, on_progress) for broadcast_id in get_active_broadcasts()]
+
+
+def cancel_broadcast(broadcast_id):
+    """Stop a broadcast for good"""
+    runner = runners.get(broadcast_id)
+    if runner is not None:
+        runner.stop()
+    checkpoint_broadcast(broadcast_id, {"status": "cancelled"})
@@ -1,9 +1,1790 @@
+"""
+KSP VIP VPN - Firebase Realtime Database helpers
+"""
+
+import copy
+import itertools
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+import tracing
+from ids import id_floor, id_timestamp, new_id
+from mirror import TreeMirror
+from rtdb_tree import key_rank, order_value, query_node, sort_key
+from storage import Backend, MemoryBackend, PreconditionFailed, SQLiteBackend
+
+with open("config.json") as f:
+    config = json.load(f)
+
+FIREBASE_DB = config.get("FIREBASE_DB", "").rstrip("/")
+
+# Where data lives: "firebase" (FIREBASE_DB), a Firebase URL, "sqlite",
+# "sqlite:PATH" or "memory" (see storage.py)
+STORAGE_BACKEND = config.get("STORAGE_BACKEND", "firebase")
+SQLITE_PATH = config.get("SQLITE_PATH", "kspvpn.sqlite3")
+
+# HTTP transport settings (all optional in config.json)
+# One pooled connection per bot worker thread, so workers never queue for a socket
+HTTP_POOL_SIZE = config.get("HTTP_POOL_SIZE", config.get("BOT_WORKERS", 64))
+HTTP_CONNECT_TIMEOUT = config.get("HTTP_CONNECT_TIMEOUT", 5)
+HTTP_READ_TIMEOUT = config.get("HTTP_READ_TIMEOUT", 15)
+HTTP_RETRIES = config.get("HTTP_RETRIES", 3)
+HTTP_BACKOFF = config.get("HTTP_BACKOFF", 0.25)
+HTTP_BACKOFF_MAX = config.get("HTTP_BACKOFF_MAX", 4.0)
+
+# Live mirrors of hot trees, e.g. ["users", "payment_requests", "vpn_tokens"]
+MIRROR_PATHS = config.get("MIRROR_PATHS", [])
+MIRROR_STALE_AFTER = config.get("MIRROR_STALE_AFTER", 60)
+
+# Conditional-write (ETag) transaction retries on conflict
+TRANSACTION_RETRIES = config.get("TRANSACTION_RETRIES", 25)
+# Writes parked by a guarded write are applied by others only after this long
+PENDING_WRITES_SETTLE_SECONDS = config.get("PENDING_WRITES_SETTLE_SECONDS", 60)
+
+# User record cache settings
+USER_CACHE_SIZE = config.get("USER_CACHE_SIZE", 5000)
+USER_CACHE_TTL = config.get("USER_CACHE_TTL", 60)
+
+# Concurrent identical reads share one backend call
+SINGLE_FLIGHT = config.get("SINGLE_FLIGHT", True)
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+# =========================
+# HTTP TRANSPORT
+# =========================
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Shared keep-alive session used by every database call"""
+    global _session
+    
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=HTTP_POOL_SIZE,
+                    pool_block=True
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    
+    return _session
+
+
+def close_session():
+    """Close pooled connections (next call opens a new pool)"""
+    global _session
+    
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def _backoff(attempt):
+    """Full-jitter exponential backoff delay for a retry attempt"""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF * (2 ** attempt)))
+
+
+def _request(method, path, retries=None, base_url=None, **kwargs):
+    """Send one request to base_url (default FIREBASE_DB), retrying transient failures"""
+    url = f"{base_url or FIREBASE_DB}/{quote(path.strip('/'), safe='/')}.json"
+    timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+    retries = HTTP_RETRIES if retries is None else retries
+    
+    for attempt in range(retries + 1):
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                response.raise_for_status()
+                return response
+        
+        time.sleep(_backoff(attempt))
+
+
+# =========================
+# STORAGE BACKEND
+# =========================
+class FirebaseBackend(Backend):
+    """Firebase RTDB over the REST API (url defaults to FIREBASE_DB)"""
+    
+    def __init__(self, url=None):
+        self._url = url.rstrip("/") if url else None
+    
+    @property
+    def url(self):
+        return self._url or FIREBASE_DB
+    
+    def get(self, path, shallow=False):
+        params = {"shallow": "true"} if shallow else None
+        return _request("GET", path, base_url=self.url, params=params).json()
+    
+    def set(self, path, value):
+        _request("PUT", path, base_url=self.url, json=value)
+    
+    def update(self, path, data):
+        _request("PATCH", path, base_url=self.url, json=data)
+    
+    def delete(self, path):
+        _request("DELETE", path, base_url=self.url)
+    
+    def query(self, path, order_by="$key", equal_to=None, start_at=None, end_at=None,
+              limit_to_first=None, limit_to_last=None):
+        params = {"orderBy": json.dumps(order_by)}
+        
+        for name, value in (("equalTo", equal_to), ("startAt", start_at), ("endAt", end_at)):
+            if value is not None:
+                params[name] = json.dumps(value)
+        
+        if limit_to_first is not None:
+            params["limitToFirst"] = int(limit_to_first)
+        if limit_to_last is not None:
+            params["limitToLast"] = int(limit_to_last)
+        
+        return _request("GET", path, base_url=self.url, params=params).json() or {}
+    
+    def read_versioned(self, path):
+        response = _request("GET", path, base_url=self.url, headers={"X-Firebase-ETag": "true"})
+        return response.json(), response.headers.get("ETag")
+    
+    def write_if(self, path, value, expected_etag):
+        # Not retried on transport errors: a lost response may hide a write
+        # that landed, and the caller would apply its change twice
+        try:
+            _request("PUT", path, retries=0, base_url=self.url, json=value, headers={"if-match": expected_etag})
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 412:
+                raise
+            raise PreconditionFailed(e.response.json(), e.response.headers.get("ETag")) from e
+
+
+def open_backend(spec):
+    """Backend for "firebase", a Firebase URL, "sqlite", "sqlite:PATH", "memory" or a Backend"""
+    if isinstance(spec, Backend):
+        return spec
+    if spec == "firebase":
+        return FirebaseBackend()
+    if spec.startswith(("http://", "https://")):
+        return FirebaseBackend(spec)
+    if spec == "sqlite":
+        return SQLiteBackend(SQLITE_PATH)
+    if spec.startswith("sqlite:"):
+        return SQLiteBackend(spec[len("sqlite:"):])
+    if spec == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown storage backend: {spec}")
+
+
+backend = open_backend(STORAGE_BACKEND)
+
+
+def use_backend(new_backend):
+    """Switch every database call to new_backend (a Backend or spec), returns the previous one"""
+    global backend
+    
+    previous, backend = backend, open_backend(new_backend)
+    user_cache.clear()
+    return previous
+
+
+# =========================
+# BASIC DATABASE PRIMITIVES
+# =========================
+def increment(delta):
+    """Server value that atomically adds delta to the stored number"""
+    return {".sv": {"increment": delta}}
+
+
+def path_prefix(path, data=None):
+    """Top-level tree of path for metrics; a root update is labelled by its trees"""
+    path = path.strip("/")
+    if path:
+        return path.split("/", 1)[0]
+    if isinstance(data, dict) and data:
+        trees = sorted({key.strip("/").split("/", 1)[0] for key in data})
+        return "+".join(trees) if len(trees) <= 3 else "batch"
+    return "(root)"
+
+
+@contextmanager
+def _timed(op, path, data=None):
+    """Time one backend call into storage_seconds and a span of the current trace"""
+    prefix = path_prefix(path, data)
+    with metrics.timer("storage_seconds", op=op, prefix=prefix):
+        with tracing.span("storage", f"{op} {prefix}", path=path) as span:
+            yield span
+
+
+def get(path):
+    """Read value at path (None if missing)"""
+    def read():
+        with _timed("get", path) as span:
+            return span.received(backend.get(path))
+    
+    return _shared_read(read, "get", path)
+
+
+def set(path, data):
+    """Write value at path (replaces existing value)"""
+    try:
+        with _timed("set", path) as span:
+            backend.set(path, span.sent(data))
+    finally:
+        _wrote(path)
+    return data
+
+
+def update(path, data):
+    """Update children of path (keys may be nested paths)"""
+    try:
+        with _timed("update", path, data) as span:
+            backend.update(path, span.sent(data))
+    finally:
+        _wrote(path, data)
+    return data
+
+
+def delete(path):
+    """Delete value at path"""
+    try:
+        with _timed("delete", path):
+            backend.delete(path)
+    finally:
+        _wrote(path)
+    return True
+
+
+# =========================
+# SINGLE-FLIGHT READS
+# =========================
+# Dispatcher workers often read the same path at once (the admin's record,
+# payment_requests during a review burst). The first caller runs the read
+# and the others wait for its result instead of sending the same request.
+class _Flight:
+    __slots__ = ("done", "result", "error", "waiters")
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share one execution and its result
+    
+    Every caller gets its own copy of the result, so callers may modify it.
+    Results are JSON values (as read from storage): followers copy them from
+    a JSON snapshot, which is several times faster than deepcopy.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.calls = 0
+        self.shared = 0
+    
+    def do(self, key, function):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = _Flight()
+                self.calls += 1
+            else:
+                flight.waiters += 1
+                self.shared += 1
+        
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return json.loads(flight.result)
+        
+        try:
+            result = function()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+                waiters = flight.waiters
+            if flight.error is None and waiters:
+                # Followers copy from a snapshot, the leader's caller owns result
+                flight.result = json.dumps(result)
+            flight.done.set()
+        
+        return result
+    
+    def stats(self):
+        with self.lock:
+            requested = self.calls + self.shared
+            return {
+                "backend_calls": self.calls,
+                "shared": self.shared,
+                "in_flight": len(self.flights),
+                "saved_rate": self.shared / requested if requested else 0.0
+            }
+
+
+reads = SingleFlight()
+
+# Last write (a number from _write_counter) per top-level tree; "/" is a
+# write to the whole database and "" any write. A read only joins flights
+# that started after the latest write it could see.
+_write_counter = itertools.count(1)
+_write_generations = {}
+
+
+def _wrote(path, data=None):
+    """Note a finished (or failed, it may have landed) write to path"""
+    generation = next(_write_counter)
+    path = path.strip("/")
+    if path:
+        trees = [path.split("/", 1)[0]]
+    elif isinstance(data, dict):
+        trees = {key.strip("/").split("/", 1)[0] for key in data}
+    else:
+        trees = ["/"]
+    
+    for tree in trees:
+        _write_generations[tree] = generation
+    _write_generations[""] = generation
+
+
+def _generation(path):
+    path = path.strip("/")
+    if not path:
+        return _write_generations.get("", 0)
+    return max(_write_generations.get(path.split("/", 1)[0], 0), _write_generations.get("/", 0))
+
+
+def _shared_read(read, op, path, *params):
+    """read() once for all concurrent callers of the same op, path and params"""
+    if not SINGLE_FLIGHT:
+        return read()
+    return reads.do((op, path, params, _generation(path)), read)
+
+
+def get_single_flight_stats():
+    """Backend reads made vs. shared with a concurrent identical read"""
+    return reads.stats()
+
+
+# =========================
+# LIVE MIRRORS
+# =========================
+mirrors = {}
+
+
+def start_mirrors(paths=None):
+    """Start streaming mirrors for paths (defaults to MIRROR_PATHS)
+    
+    Only Firebase needs them; the local backends already answer at memory
+    or disk speed.
+    """
+    if not isinstance(backend, FirebaseBackend):
+        return mirrors
+    
+    for path in paths if paths is not None else MIRROR_PATHS:
+        path = path.strip("/")
+        if path not in mirrors:
+            mirrors[path] = TreeMirror(
+                requests.Session(),
+                backend.url,
+                path,
+                stale_after=MIRROR_STALE_AFTER
+            ).start()
+    
+    return mirrors
+
+
+def stop_mirrors():
+    """Stop all streaming mirrors"""
+    for mirror in mirrors.values():
+        mirror.stop()
+    mirrors.clear()
+
+
+def _fresh_mirror(path):
+    """Fresh mirror covering path, or None"""
+    path = path.strip("/")
+    for mirror_path, mirror in mirrors.items():
+        if (path == mirror_path or path.startswith(mirror_path + "/")) and mirror.fresh():
+            metrics.inc("mirror_reads_total", tree=mirror_path)
+            return mirror
+    return None
+
+
+def _mirror_subpath(mirror, path):
+    return path.strip("/")[len(mirror.path):]
+
+
+def read_tree(path):
+    """Read value at path, from a live mirror when one is fresh"""
+    mirror = _fresh_mirror(path)
+    if mirror is not None:
+        return mirror.get(_mirror_subpath(mirror, path))
+    return get(path)
+
+
+# =========================
+# QUERIES
+# =========================
+def query(path, order_by="$key", equal_to=None, start_at=None, end_at=None,
+          limit_to_first=None, limit_to_last=None):
+    """Indexed query on the children of path, filtered by the backend
+    
+    Returns a dict in query order. order_by may be "$key", "$value" or a
+    child path; child paths need a matching .indexOn in database.rules.json.
+    Served locally when a fresh mirror covers path.
+    """
+    mirror = _fresh_mirror(path)
+    if mirror is not None:
+        return query_node(
+            mirror.get(_mirror_subpath(mirror, path)),
+            order_by, equal_to, start_at, end_at, limit_to_first, limit_to_last
+        )
+    
+    def read():
+        with _timed("query", path) as span:
+            return span.received(
+                backend.query(path, order_by, equal_to, start_at, end_at, limit_to_first, limit_to_last)
+            )
+    
+    results = _shared_read(read, "query", path, order_by, equal_to, start_at, end_at, limit_to_first, limit_to_last)
+    
+    # The REST API does not keep query order in the JSON response
+    ordered = sorted(results.items(), key=lambda item: sort_key(item[0], item[1], order_by))
+    return dict(ordered)
+
+
+def query_page(path, order_by, start_at=None, end_at=None, limit=20, cursor=None):
+    """One page of an ordered range query
+    
+    Values of order_by must be unique (e.g. "$key" or "status_key").
+    Pass the returned next_cursor back in to get the following page.
+    """
+    if cursor is not None:
+        start_at = cursor
+    
+    # startAt is inclusive, so fetch one extra row and skip the cursor itself
+    extra = 1 if cursor is not None else 0
+    results = query(path, order_by, start_at=start_at, end_at=end_at, limit_to_first=limit + extra)
+    
+    items = [
+        (key, value) for key, value in results.items()
+        if cursor is None or order_value(key, value, order_by) != cursor
+    ][:limit]
+    
+    next_cursor = None
+    if len(items) == limit:
+        key, value = items[-1]
+        next_cursor = order_value(key, value, order_by)
+    
+    return {"items": dict(items), "next_cursor": next_cursor}
+
+
+def status_key(status, record_id):
+    """Composite status/id field used to page through one status queue"""
+    return f"{status}:{record_id}"
+
+
+def query_status_page(path, status, limit=20, cursor=None):
+    """Page through the children of path with the given status, oldest first"""
+    return query_page(
+        path,
+        "status_key",
+        start_at=status_key(status, ""),
+        end_at=status_key(status, "\uf8ff"),
+        limit=limit,
+        cursor=cursor
+    )
+
+
+def list_keys(path):
+    """Child keys of path in key order, without downloading their values (shallow read)"""
+    mirror = _fresh_mirror(path)
+    if mirror is not None:
+        node = mirror.get(_mirror_subpath(mirror, path))
+    else:
+        def read():
+            with _timed("list_keys", path) as span:
+                return span.received(backend.get(path, shallow=True))
+        
+        node = _shared_read(read, "list_keys", path)
+    
+    return sorted(node, key=key_rank) if isinstance(node, dict) else []
+
+
+# =========================
+# TIME BUCKETS
+# =========================
+# Admin logs live under day buckets (e.g. admin_logs/2026-10-18/{id}) so
+# retention deletes whole days instead of individual records. Per-user
+# logs and notifications are keyed {uid}/{id} instead, so a user's recent
+# records are one key-range query (ids sort by creation time); a day index
+# {tree}_days/{day}/{uid}/{id} tells retention what to delete.
+BUCKET_FORMAT = "%Y-%m-%d"
+
+
+def day_bucket(timestamp=None):
+    """UTC day bucket for a unix timestamp (default: now)"""
+    if timestamp is None:
+        timestamp = time.time()
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime(BUCKET_FORMAT)
+
+
+def id_bucket(record_id):
+    """Day bucket of a record from the creation time encoded in its id"""
+    return day_bucket(id_timestamp(record_id) / 1000)
+
+
+def is_bucket(key):
+    """True if key is a day bucket name"""
+    try:
+        datetime.strptime(key, BUCKET_FORMAT)
+        return True
+    except ValueError:
+        return False
+
+
+def index_record_day(batch, tree, user_id, record_id):
+    """Queue the day index entry of a per-user record"""
+    batch.set(f"{tree}_days/{id_bucket(record_id)}/{user_id}/{record_id}", True)
+
+
+def expired_buckets(path, days):
+    """Day buckets under path that are entirely older than days"""
+    cutoff = day_bucket(time.time() - days * 24 * 60 * 60)
+    return [key for key in list_keys(path) if is_bucket(key) and key < cutoff]
+
+
+def admin_log_path(log_id):
+    return f"admin_logs/{id_bucket(log_id)}/{log_id}"
+
+
+# =========================
+# WRITE BATCH
+# =========================
+class WriteBatch:
+    """Collect path -> value writes and commit them as one multi-location PATCH
+    
+    Firebase applies a multi-location update atomically: either every path
+    is written or none is.
+    """
+    
+    def __init__(self):
+        self.updates = {}
+        self.callbacks = []
+    
+    def __len__(self):
+        return len(self.updates)
+    
+    def set(self, path, value):
+        """Queue a write of value at path (None deletes)"""
+        path = path.strip("/")
+        
+        # Firebase rejects updates where one path is an ancestor of another,
+        # so fold overlapping writes together
+        for queued in list(self.updates):
+            if path.startswith(queued + "/"):
+                parent = self.updates[queued]
+                parent = copy.deepcopy(parent) if isinstance(parent, dict) else {}
+                node = parent
+                parts = path[len(queued) + 1:].split("/")
+                for part in parts[:-1]:
+                    if not isinstance(node.get(part), dict):
+                        node[part] = {}
+                    node = node[part]
+                node[parts[-1]] = value
+                self.updates[queued] = parent
+                return self
+            elif queued.startswith(path + "/"):
+                self.updates.pop(queued)
+        
+        self.updates[path] = value
+        return self
+    
+    def update(self, path, data):
+        """Queue writes of each key in data below path"""
+        for key, value in data.items():
+            self.set(f"{path}/{key}", value)
+        return self
+    
+    def delete(self, path):
+        """Queue a delete of path"""
+        return self.set(path, None)
+    
+    def increment(self, path, delta):
+        """Queue an atomic server-side increment of the number at path"""
+        queued = self.updates.get(path.strip("/"))
+        if isinstance(queued, dict) and "increment" in queued.get(".sv", {}):
+            delta += queued[".sv"]["increment"]
+        return self.set(path, increment(delta))
+    
+    def after_commit(self, callback):
+        """Run callback once the batch has been written successfully"""
+        self.callbacks.append(callback)
+        return self
+    
+    def commit(self):
+        """Send all queued writes in a single request"""
+        updates, self.updates = self.updates, {}
+        callbacks, self.callbacks = self.callbacks, []
+        
+        if updates:
+            update("", updates)
+        
+        for callback in callbacks:
+            callback()
+        
+        return updates
+
+
+def touch(batch, path):
+    """Stamp the record at path as updated now (incremental backups select on it)"""
+    batch.set(f"{path}/updated", int(time.time()))
+
+
+# =========================
+# TRANSACTIONS
+# =========================
+class TransactionAborted(Exception):
+    """Raised by a transaction function to give up without writing"""
+
+
+class TransactionConflict(Exception):
+    """A transaction kept losing to concurrent writers"""
+
+
+transaction_stats = {"commits": 0, "conflicts": 0, "aborts": 0}
+
+# Balance changes of one user are serialized in-process, so workers queue
+# here instead of retrying against each other's writes
+USER_LOCK_STRIPES = 256
+_user_locks = [threading.RLock() for _ in range(USER_LOCK_STRIPES)]
+
+
+def user_lock(user_id):
+    """In-process lock for one user's balance changes"""
+    return _user_locks[hash(str(user_id)) % USER_LOCK_STRIPES]
+
+
+@contextmanager
+def user_locks(user_ids):
+    """user_lock of several users, taken in stripe order so two callers can't deadlock"""
+    stripes = sorted({hash(str(user_id)) % USER_LOCK_STRIPES for user_id in user_ids})
+    with ExitStack() as stack:
+        for stripe in stripes:
+            stack.enter_context(_user_locks[stripe])
+        yield
+
+
+def transaction(path, update_fn, retries=None):
+    """Replace the value at path with update_fn(current value), atomically
+    
+    Conditional write with ETag/If-Match: if anyone wrote path since it was
+    read, the backend refuses the write (Firebase: 412) with the fresh value
+    and update_fn runs again on that. update_fn may raise TransactionAborted.
+    Returns the value written.
+    """
+    retries = TRANSACTION_RETRIES if retries is None else retries
+    with _timed("read_versioned", path) as span:
+        current, etag = backend.read_versioned(path)
+        span.received(current)
+    
+    for _ in range(retries + 1):
+        try:
+            new_value = update_fn(copy.deepcopy(current))
+        except TransactionAborted:
+            transaction_stats["aborts"] += 1
+            raise
+        
+        try:
+            try:
+                with _timed("write_if", path) as span:
+                    backend.write_if(path, span.sent(new_value), etag)
+            finally:
+                _wrote(path)
+            transaction_stats["commits"] += 1
+            return new_value
+        except PreconditionFailed as e:
+            transaction_stats["conflicts"] += 1
+            current, etag = e.value, e.etag
+        
+        # The 412 already carried the fresh value, so retry almost at once;
+        # backing off longer only lets newer writers overtake
+        time.sleep(random.uniform(0, 0.005))
+    
+    raise TransactionConflict(path)
+
+
+def claim_status(path, expected, new_status, fields=None, batch=None):
+    """Move the record at path from status expected to new_status, atomically
+    
+    Raises TransactionAborted ("not_found" / "already_processed") if the
+    record is missing or no longer in the expected status. With batch, its
+    writes are committed together with the change (see guarded_write).
+    Returns the record as it was before the change.
+    """
+    old = {}
+    
+    def flip(record, _):
+        if not isinstance(record, dict):
+            raise TransactionAborted("not_found")
+        if record.get("status") != expected:
+            raise TransactionAborted("already_processed")
+        old.update(record)
+        return {**record, **(fields or {}), "status": new_status, "updated": int(time.time())}
+    
+    guarded_write(path, flip, batch)
+    old.pop("pending_writes", None)
+    return old
+
+
+# =========================
+# GUARDED WRITES
+# =========================
+# A conditional write covers one path, and Firebase can't make a
+# multi-location PATCH conditional. The writes that must go with one (a
+# balance change and its ledger entry, a payment claim and its credit) are
+# stored in the guarded record by that same write, under
+# pending_writes/{id}, then applied and removed in one PATCH. If the
+# process dies in between, they are still there for flush_pending_writes.
+def _pack_writes(updates):
+    """Batch updates as a storable node (paths can't be keys, increments must not resolve yet)"""
+    packed = {}
+    for number, (path, value) in enumerate(updates.items()):
+        if isinstance(value, dict) and "increment" in value.get(".sv", {}):
+            packed[f"w{number}"] = {"path": path, "increment": value[".sv"]["increment"]}
+        else:
+            packed[f"w{number}"] = {"path": path, "value": value}
+    return packed
+
+
+def apply_pending_writes(batch, path, pending):
+    """Queue the writes parked under path/pending_writes on batch, and their removal"""
+    for intent_id, writes in sorted(pending.items()):
+        for write in (writes or {}).values():
+            if "increment" in write:
+                batch.increment(write["path"], write["increment"])
+            else:
+                batch.set(write["path"], write.get("value"))
+        batch.delete(f"{path}/pending_writes/{intent_id}")
+
+
+def _settled(pending):
+    """Parked writes old enough that no guarded write is still applying them"""
+    settled = id_floor((time.time() - PENDING_WRITES_SETTLE_SECONDS) * 1000)
+    return {intent_id: writes for intent_id, writes in (pending or {}).items() if intent_id < settled}
+
+
+def guarded_write(path, update_fn, batch=None):
+    """transaction() on the record at path that commits batch with it, all or nothing
+    
+    update_fn(record, batch) returns the new record and may queue more
+    writes on batch. Everything queued is parked in the record by the
+    conditional write and applied right after, so the caller doesn't
+    commit batch itself. Returns the new record.
+    """
+    batch = batch if batch is not None else WriteBatch()
+    queued = dict(batch.updates)
+    intent_id = new_id()
+    
+    def write(record):
+        attempt = WriteBatch()
+        attempt.updates = dict(queued)
+        record = update_fn(record, attempt)
+        if attempt.updates:
+            pending = {**(record.get("pending_writes") or {}), intent_id: _pack_writes(attempt.updates)}
+            record = {**record, "pending_writes": pending}
+        return record
+    
+    record = dict(transaction(path, write))
+    pending = record.pop("pending_writes", None) or {}
+    
+    # Ours, plus any a crashed writer left behind
+    mine = {intent_id: pending[intent_id]} if intent_id in pending else {}
+    batch.updates = {}
+    apply_pending_writes(batch, path, {**_settled(pending), **mine})
+    batch.commit()
+    
+    return record
+
+
+# Every tree holding records guarded_write (or claim_status) is used on
+GUARDED_TREES = ("users", "payment_requests", "pending_tokens", "vpn_tokens", "broadcasts")
+
+
+def flush_pending_writes(path, pending=None):
+    """Apply writes a guarded write on path parked but never applied, returns how many batches"""
+    if pending is None:
+        pending = get(f"{path}/pending_writes") or {}
+    
+    stale = _settled(pending)
+    batch = WriteBatch()
+    apply_pending_writes(batch, path, stale)
+    batch.commit()
+    return len(stale)
+
+
+# =========================
+# DASHBOARD COUNTERS
+# =========================
+# Aggregates kept up to date by the write paths below, so the dashboard
+# is one read of "stats" instead of downloading every tree.
+COUNTERS = (
+    "total_users", "vip_users", "total_credits",
+    "total_payments", "pending_payments", "approved_payments", "payment_amount",
+    "pending_tokens", "pending_requests"
+)
+
+RECENT_LIMIT = 10
+
+
+def count(batch, **deltas):
+    """Queue counter changes on batch (e.g. count(batch, total_users=1))"""
+    for name, delta in deltas.items():
+        if delta:
+            batch.increment(f"stats/counters/{name}", delta)
+
+
+def push_recent(batch, name, item_id, item):
+    """Queue an entry for one of the recent_* dashboard lists"""
+    batch.set(f"stats/recent_{name}/{item_id}", item)
+
+
+def _payment_deltas(old_status, new_status, amount):
+    """Counter changes for a payment moving between statuses"""
+    deltas = {"pending_payments": 0, "approved_payments": 0, "payment_amount": 0}
+    
+    for status, sign in ((old_status, -1), (new_status, 1)):
+        if status == "pending":
+            deltas["pending_payments"] += sign
+        elif status == "approved":
+            deltas["approved_payments"] += sign
+            deltas["payment_amount"] += sign * int(amount)
+    
+    return deltas
+
+
+# =========================
+# USER CACHE
+# =========================
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after ttl seconds"""
+    
+    def __init__(self, maxsize=1000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        """Return (found, value); value is a copy the caller may modify"""
+        with self.lock:
+            entry = self.data.get(key)
+            
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    del self.data[key]
+                self.misses += 1
+                return False, None
+            
+            self.data.move_to_end(key)
+            self.hits += 1
+            return True, copy.deepcopy(entry[1])
+    
+    def put(self, key, value):
+        """Store value, evicting the least recently used entry if full"""
+        with self.lock:
+            self.data[key] = (time.monotonic() + self.ttl, copy.deepcopy(value))
+            self.data.move_to_end(key)
+            
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+    
+    def update(self, key, fields):
+        """Merge fields into a cached dict value (no-op if not cached)"""
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return
+            if isinstance(entry[1], dict) and not any("/" in field for field in fields):
+                entry[1].update(copy.deepcopy(fields))
+            else:
+                del self.data[key]
+    
+    def invalidate(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+    
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+metrics.gauge("user_cache", user_cache.stats)
+metrics.gauge("single_flight", reads.stats)
+metrics.gauge("transactions", lambda: dict(transaction_stats))
+
+
+def _cache_user_fields(batch, user_id, fields):
+    """Write fields through to the cached user once batch commits"""
+    batch.after_commit(lambda: user_cache.update(str(user_id), fields))
+
+
+def get_cache_stats():
+    """Hit/miss/eviction counters of the user cache"""
+    return user_cache.stats()
+
+
+# =========================
+# USER SYSTEM
+# =========================
+def get_user(user_id):
+    """Get user by ID (served from the user cache when fresh)"""
+    key = str(user_id)
+    found, user_data = user_cache.get(key)
+    
+    if not found:
+        user_data = read_tree(f"users/{key}")
+        user_cache.put(key, user_data)
+    
+    return user_data
+
+
+def create_user(user_id, data):
+    """Create new user, returns the stored record (the existing one if the user already exists)
+    
+    A conditional create: two handlers racing on a first /start can't
+    overwrite each other's record or count the user twice.
+    """
+    now = int(time.time())
+    
+    user_data = {
+        "name": "Unknown",
+        "username": "",
+        "credits": 0,
+        "vip": False,
+        "expiry": 0,
+        "created_at": now,
+        "last_active": now,
+        "updated": now,
+        **{key: value for key, value in data.items() if value is not None}
+    }
+    
+    def create(record, batch):
+        if record is not None:
+            raise TransactionAborted("exists")
+        
+        if user_data["credits"]:
+            ledger_entry(batch, user_id, user_data["credits"], "opening")
+        if user_data["vip"]:
+            index_vip_expiry(batch, user_id, None, user_data["expiry"])
+        
+        count(
+            batch,
+            total_users=1,
+            vip_users=1 if user_data["vip"] else 0,
+            total_credits=int(user_data["credits"])
+        )
+        push_recent(batch, "users", user_id, {
+            "user_id": str(user_id),
+            "name": user_data["name"],
+            "credits": user_data["credits"],
+            "vip": user_data["vip"],
+            "created": now
+        })
+        index_user(batch, user_id, None, user_data)
+        return user_data
+    
+    try:
+        with user_lock(user_id):
+            guarded_write(f"users/{user_id}", create)
+    except (TransactionAborted, TransactionConflict):
+        # Created by someone else first
+        existing = get(f"users/{user_id}")
+        if not isinstance(existing, dict):
+            raise
+        existing.pop("pending_writes", None)
+        user_data = existing
+    
+    user_cache.put(str(user_id), user_data)
+    
+    return user_data
+
+
+def update_user(user_id, data):
+    """Update user fields (use add_credits / add_vip for balance and VIP)"""
+    batch = WriteBatch()
+    batch.update(f"users/{user_id}", {**data, "updated": int(time.time())})
+    
+    if "name" in data or "username" in data:
+        old_data = get_user(user_id) or {}
+        index_user(batch, user_id, old_data, {**old_data, **data})
+    
+    _cache_user_fields(batch, user_id, data)
+    batch.commit()
+    
+    return data
+
+
+# =========================
+# USER INDEXES
+# =========================
+# username_index/{username}      -> user_id            (exact lookup)
+# search_index/{ngram}/{user_id} -> {name, username}   (substring search)
+SEARCH_NGRAM = 3
+# Cap for callers that show a page of results (search_users returns all by default)
+SEARCH_LIMIT = 20
+# Up to this many results are fetched one by one; more read the users tree once
+SEARCH_FETCH_EACH = 50
+
+# Characters Firebase does not allow in keys
+_KEY_ESCAPES = {ch: f"%{ord(ch):02X}" for ch in "%.$#[]/"}
+
+
+def index_key(text):
+    """Encode text so it can be used as a Firebase key"""
+    return "".join(
+        _KEY_ESCAPES.get(ch) or (f"%{ord(ch):02X}" if ord(ch) < 32 or ord(ch) == 127 else ch)
+        for ch in text
+    )
+
+
+def ngrams(text, n=SEARCH_NGRAM):
+    """All length-n substrings of text"""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def user_ngrams(user_id, user_data):
+    """N-grams indexed for a user (name, username and id, lowercased)"""
+    grams = frozenset()
+    for text in (user_data.get("name"), user_data.get("username"), str(user_id)):
+        grams |= ngrams((text or "").lower())
+    return grams
+
+
+def search_entry(user_data):
+    """What a search_index entry holds: enough to confirm a match without reading the user"""
+    return {"name": user_data.get("name") or "", "username": user_data.get("username") or ""}
+
+
+def index_user(batch, user_id, old_data, new_data):
+    """Queue username/search index changes for a user on batch"""
+    old_data = old_data or {}
+    old_username = (old_data.get("username") or "").lower()
+    new_username = (new_data.get("username") or "").lower()
+    
+    if old_username != new_username:
+        if old_username:
+            batch.delete(f"username_index/{index_key(old_username)}")
+        if new_username:
+            batch.set(f"username_index/{index_key(new_username)}", str(user_id))
+    
+    old_grams = user_ngrams(user_id, old_data) if old_data else frozenset()
+    new_grams = user_ngrams(user_id, new_data)
+    entry = search_entry(new_data)
+    
+    # Every entry holds the name and username, so a change rewrites them all
+    unchanged = bool(old_data) and search_entry(old_data) == entry
+    
+    for gram in old_grams - new_grams:
+        batch.delete(f"search_index/{index_key(gram)}/{user_id}")
+    for gram in (new_grams - old_grams if unchanged else new_grams):
+        batch.set(f"search_index/{index_key(gram)}/{user_id}", entry)
+
+
+def rebuild_user_indexes(chunk_size=500):
+    """Rebuild username_index and search_index from the users tree"""
+    users = read_tree("users") or {}
+    usernames = {}
+    postings = {}
+    
+    for user_id, user_data in users.items():
+        username = (user_data.get("username") or "").lower()
+        if username:
+            usernames[index_key(username)] = str(user_id)
+        for gram in user_ngrams(user_id, user_data):
+            postings.setdefault(index_key(gram), {})[str(user_id)] = search_entry(user_data)
+    
+    delete("username_index")
+    delete("search_index")
+    
+    # Write in chunks to keep each request a reasonable size
+    batch = WriteBatch()
+    for key, user_id in usernames.items():
+        batch.set(f"username_index/{key}", user_id)
+        if len(batch) >= chunk_size:
+            batch.commit()
+    for gram, user_ids in postings.items():
+        batch.set(f"search_index/{gram}", user_ids)
+        if len(batch) >= chunk_size:
+            batch.commit()
+    batch.commit()
+    
+    return {"users": len(users), "usernames": len(usernames), "ngrams": len(postings)}
+
+
+# =========================
+# CREDIT LEDGER
+# =========================
+# Every balance change is appended to ledger/{uid}/{txid}. Snapshots at
+# ledger_snapshots/{uid}/{txid} hold the balance up to and including txid,
+# so a balance read is the newest snapshot plus the entries after it.
+LEDGER_SNAPSHOT_EVERY = config.get("LEDGER_SNAPSHOT_EVERY", 50)
+# Entries younger than this are never folded into a snapshot, so a write
+# still in flight from another process can't land behind one
+LEDGER_SETTLE_SECONDS = config.get("LEDGER_SETTLE_SECONDS", 60)
+LEDGER_PAGE_SIZE = 500
+
+
+def ledger_entry(batch, user_id, amount, kind, ref=None):
+    """Queue a ledger entry on batch, returns its txid"""
+    txid = new_id()
+    entry = {"amount": int(amount), "kind": kind, "created": int(time.time())}
+    if ref is not None:
+        entry["ref"] = str(ref)
+    batch.set(f"ledger/{user_id}/{txid}", entry)
+    return txid
+
+
+def latest_snapshot(user_id, before=None):
+    """Newest balance snapshot (older than txid before, if given), or None"""
+    snapshots = query(f"ledger_snapshots/{user_id}", "$key", end_at=before, limit_to_last=2)
+    
+    for txid in reversed(list(snapshots)):
+        if before is None or txid < before:
+            return {"txid": txid, **snapshots[txid]}
+    return None
+
+
+def stream_ledger(user_id, after=None, before=None, page_size=LEDGER_PAGE_SIZE):
+    """Yield (txid, entry) oldest first between two txids (both exclusive), a page at a time"""
+    cursor = None
+    
+    while True:
+        page = query_page(f"ledger/{user_id}", "$key", start_at=after, end_at=before,
+                          limit=page_size, cursor=cursor)
+        for txid, entry in page["items"].items():
+            if txid != after and (before is None or txid < before):
+                yield txid, entry
+    
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return
+
+
+def balance_at(user_id, before=None):
+    """Balance from the ledger just before txid before (now if None)"""
+    snapshot = latest_snapshot(user_id, before)
+    balance = snapshot["balance"] if snapshot else 0
+    after = snapshot["txid"] if snapshot else None
+    return balance + sum(int(entry.get("amount", 0)) for _, entry in stream_ledger(user_id, after, before))
+
+
+def ledger_balance(user_id):
+    """Current balance from the ledger, compacting a long tail into a snapshot"""
+    snapshot = latest_snapshot(user_id)
+    balance = snapshot["balance"] if snapshot else 0
+    tail = list(stream_ledger(user_id, after=snapshot["txid"] if snapshot else None))
+    
+    if len(tail) >= LEDGER_SNAPSHOT_EVERY:
+        snapshot_ledger(user_id, snapshot, tail)
+    
+    return balance + sum(int(entry.get("amount", 0)) for _, entry in tail)
+
+
+def snapshot_ledger(user_id, snapshot=None, tail=None):
+    """Fold settled entries after the newest snapshot into a new one, returns its txid or None"""
+    if tail is None:
+        snapshot = latest_snapshot(user_id)
+        tail = stream_ledger(user_id, after=snapshot["txid"] if snapshot else None)
+    
+    settled = id_floor((time.time() - LEDGER_SETTLE_SECONDS) * 1000)
+    balance = snapshot["balance"] if snapshot else 0
+    entries = snapshot["entries"] if snapshot else 0
+    last_txid = None
+    
+    for txid, entry in tail:
+        if txid >= settled:
+            break
+        balance += int(entry.get("amount", 0))
+        entries += 1
+        last_txid = txid
+    
+    if last_txid is None:
+        return None
+    
+    set(f"ledger_snapshots/{user_id}/{last_txid}", {
+        "balance": balance,
+        "entries": entries,
+        "created": int(time.time())
+    })
+    return last_txid
+
+
+def get_credit_history(user_id, limit=50):
+    """User's latest ledger entries, newest first"""
+    entries = query(f"ledger/{user_id}", "$key", limit_to_last=limit)
+    return [{"txid": txid, **entry} for txid, entry in reversed(list(entries.items()))]
+
+
+def ledger_statement(user_id, year, month):
+    """Monthly statement (UTC): opening/closing balance, totals per kind and entries"""
+    start = datetime(year, month, 1, tzinfo=timezone.utc)
+    end = datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    start_id = id_floor(start.timestamp() * 1000)
+    end_id = id_floor(end.timestamp() * 1000)
+    
+    opening = balance_at(user_id, start_id)
+    closing = opening
+    totals = {}
+    entries = []
+    
+    for txid, entry in stream_ledger(user_id, after=start_id, before=end_id):
+        amount = int(entry.get("amount", 0))
+        closing += amount
+        totals[entry.get("kind", "unknown")] = totals.get(entry.get("kind", "unknown"), 0) + amount
+        entries.append({"txid": txid, **entry, "balance": closing})
+    
+    return {
+        "user_id": str(user_id),
+        "month": start.strftime("%Y-%m"),
+        "opening": opening,
+        "closing": closing,
+        "credited": sum(entry["amount"] for entry in entries if entry["amount"] > 0),
+        "debited": -sum(entry["amount"] for entry in entries if entry["amount"] < 0),
+        "totals": totals,
+        "entries": entries
+    }
+
+
+def reconcile_ledger(fix=False, page_size=200):
+    """Check ledger balances against users/{uid}/credits and approved payments against ledger entries
+    
+    Streams users and payments a page at a time. Records in any of
+    GUARDED_TREES with writes still parked by a guarded write are listed
+    (and with fix, those writes are applied) instead of checked. With fix,
+    balance drift is closed with an
+    "adjustment" entry ("opening" for users with no ledger yet);
+    users/{uid}/credits is never changed.
+    """
+    report = {"users": 0, "drift": [], "payments": 0, "missing_payments": [], "pending_writes": []}
+    batch = WriteBatch()
+    first_txids = {}
+    
+    cursor = None
+    while True:
+        page = get_user_page(page_size, cursor)
+        for user_id, user_data in page["items"].items():
+            if not isinstance(user_data, dict):
+                continue
+            report["users"] += 1
+    
+            first = query(f"ledger/{user_id}", "$key", limit_to_first=1)
+            first_txids[user_id] = next(iter(first), None)
+    
+            if user_data.get("pending_writes"):
+                report["pending_writes"].append(f"users/{user_id}")
+                if fix:
+                    flush_pending_writes(f"users/{user_id}", user_data["pending_writes"])
+                    user_cache.invalidate(str(user_id))
+                continue
+    
+            credits = int(user_data.get("credits", 0))
+            balance = ledger_balance(user_id)
+            if credits != balance:
+                report["drift"].append({"user_id": user_id, "credits": credits, "ledger": balance})
+                if fix:
+                    ledger_entry(batch, user_id, credits - balance, "adjustment" if first else "opening")
+    
+        if len(batch) >= page_size:
+            batch.commit()
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    
+    # Claims on requests, tokens and broadcasts park writes too (credits,
+    # ledger entries, counters), whatever status they moved the record to
+    for tree in GUARDED_TREES[1:]:
+        cursor = None
+        while True:
+            page = query_page(tree, "$key", limit=page_size, cursor=cursor)
+            for record_id, record in page["items"].items():
+                if isinstance(record, dict) and record.get("pending_writes"):
+                    report["pending_writes"].append(f"{tree}/{record_id}")
+                    if fix:
+                        flush_pending_writes(f"{tree}/{record_id}", record["pending_writes"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+    
+    # Payments approved before a user's first ledger entry are in its opening balance
+    cursor = None
+    while True:
+        page = query_status_page("payment_requests", "approved", page_size, cursor)
+        for pid, payment in page["items"].items():
+            user_id = str(payment.get("user_id"))
+            if payment.get("pending_writes"):
+                # Listed above; with fix they were applied before this page was read
+                continue
+    
+            first_txid = first_txids.get(user_id)
+            if first_txid is None or int(payment.get("approved_at", 0)) < id_timestamp(first_txid) // 1000:
+                continue
+    
+            report["payments"] += 1
+            if not query(f"ledger/{user_id}", "ref", equal_to=pid, limit_to_first=1):
+                report["missing_payments"].append({"payment_id": pid, "user_id": user_id,
+                                                   "amount": payment.get("amount", 0)})
+    
+        cursor = page["next_cursor"]
+        if cursor is None:
+            break
+    
+    if fix:
+        batch.commit()
+    report["fixed"] = len(report["drift"]) if fix else 0
+    
+    return report
+
+
+def add_credits(user_id, amount, batch=None, kind="credit", ref=None):
+    """Add credits to an existing user, returns new balance
+    
+    The balance is a server-side increment in the same PATCH as its ledger
+    entry and counters. With batch, everything is queued on it for the
+    caller to commit and None is returned (read the balance after the
+    commit). Raises TransactionAborted("not_found") for an unknown user.
+    """
+    amount = int(amount)
+    
+    # An increment on a missing user would create a bare, uncounted record
+    if not isinstance(get_user(user_id), dict):
+        raise TransactionAborted("not_found")
+    
+    own_batch = batch is None
+    if own_batch:
+        batch = WriteBatch()
+    
+    batch.increment(f"users/{user_id}/credits", amount)
+    ledger_entry(batch, user_id, amount, kind, ref)
+    touch(batch, f"users/{user_id}")
+    count(batch, total_credits=amount)
+    batch.after_commit(lambda: user_cache.invalidate(str(user_id)))
+    
+    if not own_batch:
+        return None
+    
+    batch.commit()
+    return int(get(f"users/{user_id}/credits") or 0)
+
+
+def cut_credits(user_id, amount, batch=None, kind="debit", ref=None):
+    """Remove credits from user (never below zero), returns new balance
+    
+    One conditional write changes the balance and carries its ledger entry
+    and counters, plus batch's writes if given (see guarded_write).
+    """
+    amount = int(amount)
+    
+    def cut(user_data, batch):
+        user_data = user_data if isinstance(user_data, dict) else {}
+        credits = int(user_data.get("credits", 0))
+        new_balance = max(0, credits - amount)
+        if new_balance == credits:
+            return user_data
+        
+        ledger_entry(batch, user_id, new_balance - credits, kind, ref)
+        count(batch, total_credits=new_balance - credits)
+        return {**user_data, "credits": new_balance, "updated": int(time.time())}
+    
+    with user_lock(user_id):
+        user_data = guarded_write(f"users/{user_id}", cut, batch)
+    user_cache.put(str(user_id), user_data)
+    
+    return int(user_data.get("credits", 0))
+
+
+# =========================
+# VIP SYSTEM
+# =========================
+# Expiry index: vip_expiry/{expiry:010d}:{uid} -> {"user_id", "expiry"}, so
+# the subscriptions ending next are a key range query, not a users scan
+VIP_WARN_DAYS = config.get("VIP_WARN_DAYS", 3)
+
+VIP_EXPIRING_MESSAGE = "⏰ သင့် VIP သည် {days} ရက်အတွင်း သက်တမ်းကုန်ပါမည်။ ဆက်လက်အသုံးပြုရန် VIP ထပ်ဝယ်ပါ။"
+VIP_EXPIRED_MESSAGE = "⌛ သင့် VIP သက်တမ်းကုန်သွားပါပြီ။ ဆက်လက်အသုံးပြုရန် VIP ထပ်ဝယ်ပါ။"
+
+
+def expiry_key(expiry, user_id):
+    """Key of a user's entry in the VIP expiry index (sorts by time)"""
+    return f"{int(expiry):010d}:{user_id}"
+
+
+def index_vip_expiry(batch, user_id, old_expiry, new_expiry):
+    """Move a user's entry in the VIP expiry index"""
+    if int(old_expiry or 0) == int(new_expiry or 0):
+        return
+    if old_expiry:
+        batch.delete(f"vip_expiry/{expiry_key(old_expiry, user_id)}")
+    if new_expiry:
+        batch.set(f"vip_expiry/{expiry_key(new_expiry, user_id)}", {
+            "user_id": str(user_id),
+            "expiry": int(new_expiry)
+        })
+
+
+def get_expiring(until, limit=500, cursor=None):
+    """Page of expiry index entries due by until (timestamp), soonest first"""
+    return query_page("vip_expiry", "$key", end_at=expiry_key(until, "\uf8ff"), limit=limit, cursor=cursor)
+
+
+def add_vip(user_id, days, batch=None):
+    """Extend user's VIP by days, returns new expiry timestamp
+    
+    The expiry index and counter move in the same conditional write, with
+    batch's writes if given (see guarded_write).
+    """
+    def extend(user_data, batch):
+        user_data = user_data if isinstance(user_data, dict) else {}
+        now = int(time.time())
+        expiry = max(now, int(user_data.get("expiry", 0))) + int(days) * 24 * 60 * 60
+        index_vip_expiry(batch, user_id, user_data.get("expiry"), expiry)
+        count(batch, vip_users=0 if user_data.get("vip") else 1)
+        return {**user_data, "vip": True, "expiry": expiry, "updated": now}
+    
+    with user_lock(user_id):
+        user_data = guarded_write(f"users/{user_id}", extend, batch)
+    user_cache.put(str(user_id), user_data)
+    
+    return user_data["expiry"]
+
+
+def queue_vip(batch, user_id, user_data, days):
+    """Queue extending VIP by days on batch, from user_data as read; returns the new expiry
+    
+    Unlike add_vip this is not a conditional write: the caller holds
+    user_lock from the read until batch commits.
+    """
+    now = int(time.time())
+    expiry = max(now, int(user_data.get("expiry", 0))) + int(days) * 24 * 60 * 60
+    batch.update(f"users/{user_id}", {"vip": True, "expiry": expiry, "updated": now})
+    index_vip_expiry(batch, user_id, user_data.get("expiry"), expiry)
+    count(batch, vip_users=0 if user_data.get("vip") else 1)
+    batch.after_commit(lambda: user_cache.invalidate(str(user_id)))
+    return expiry
+
+
+def purchase_vip(user_id, days, price, ref=None):
+    """Buy VIP with credits: check, debit, extend and log in one conditional write"""
+    price = int(price)
+    
+    def charge(user_data, batch):
+        if not user_data:
+            raise TransactionAborted("not_found")
+        credits = int(user_data.get("credits", 0))
+        if credits < price:
+            raise TransactionAborted("insufficient_credits")
+        
+        now = int(time.time())
+        expiry = max(now, int(user_data.get("expiry", 0))) + int(days) * 24 * 60 * 60
+        ledger_entry(batch, user_id, -price, "vip", ref)
+        index_vip_expiry(batch, user_id, user_data.get("expiry"), expiry)
+        count(batch, total_credits=-price, vip_users=0 if user_data.get("vip") else 1)
+        return {**user_data, "credits": credits - price, "vip": True, "expiry": expiry, "updated": now}
+    
+    try:
+        with user_lock(user_id):
+            user_data = guarded_write(f"users/{user_id}", charge)
+    except TransactionAborted as e:
+        return {"success": False, "message": str(e)}
+    except TransactionConflict:
+        return {"success": False, "message": "conflict"}
+    
+    user_cache.put(str(user_id), user_data)
+    
+    return {
+        "success": True,
+        "message": "purchased",
+        "new_balance": user_data["credits"],
+        "expiry": user_data["expiry"]
+    }
+
+
+def get_vip_status(user_id):
+    """Get user's VIP status"""
+    user_data = get_user(user_id) or {}
+    expiry = int(user_data.get("expiry", 0))
+    now = int(time.time())
+    
+    if user_data.get("vip") and expiry > now:
+        return {
+            "vip": True,
+            "expiry": expiry,
+            "days_left": (expiry - now) // (24 * 60 * 60)
+        }
+    
+    return {"vip": False, "expiry": expiry, "days_left": 0}
+
+
+def expire_vip(user_id, expiry):
+    """Turn off VIP if it has really ended and notify the user; returns True if turned off
+    
+    The index entry for expiry is removed either way (a renewal already
+    indexed the new expiry), except on TransactionConflict, which is
+    raised with the entry kept so the expiry is retried.
+    """
+    def end(user_data, batch):
+        if not isinstance(user_data, dict) or not user_data.get("vip"):
+            raise TransactionAborted("not_vip")
+        if int(user_data.get("expiry", 0)) > time.time():
+            raise TransactionAborted("renewed")
+        
+        count(batch, vip_users=-1)
+        add_notification(user_id, "vip_expired", VIP_EXPIRED_MESSAGE, {"expiry": int(expiry)}, batch=batch)
+        return {**user_data, "vip": False, "updated": int(time.time())}
+    
+    batch = WriteBatch()
+    batch.delete(f"vip_expiry/{expiry_key(expiry, user_id)}")
+    
+    try:
+        with user_lock(user_id):
+            guarded_write(f"users/{user_id}", end, batch)
+    except TransactionAborted:
+        batch.commit()
+        return False
+    
+    user_cache.update(str(user_id), {"vip": False})
+    
+    return True
+
+
+def warn_vip_expiry(user_id, expiry):
+    """Notify a user that VIP ends soon, once per expiry; returns the message or None
+    
+    Raises TransactionConflict if the entry kept changing (not marked, so it can be retried).
+    """
+    def mark(entry):
+        if not isinstance(entry, dict) or entry.get("warned"):
+            raise TransactionAborted("already_warned")
+        return {**entry, "warned": True}
+    
+    try:
+        transaction(f"vip_expiry/{expiry_key(expiry, user_id)}", mark)
+    except TransactionAborted:
+        return None
+    
+    days = max(1, -(-(int(expiry) - int(time.time())) // (24 * 60 * 60)))
+    message = VIP_EXPIRING_MESSAGE.format(days=days)
+    add_notification(user_id, "vip_expiring", message, {"expiry": int(expiry)})
+    return message
+
+
+def cleanup_expired_vip():
+    """Turn off VIP for users whose subscription has expired (reads only the due index entries)"""
+    now = int(time.time())
+    expired = 0
+    cursor = None
+    
+    while True:
+        page = get_expiring(now, cursor=cursor)
+        for entry in page["items"].values():
+            try:
+                expired += expire_vip(entry["user_id"], entry["expiry"])
+            except TransactionConflict:
+                # Still indexed, so the next run expires it
+                continue
+        
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return expired
+
+
+def rebuild_vip_expiry_index(chunk_size=500):
+    """Rebuild vip_expiry from the users tree (one full scan, for existing data)"""
+    users = read_tree("users") or {}
+    delete("vip_expiry")
+    
+    batch = WriteBatch()
+    indexed = 0
+    for user_id, user_data in users.items():
+        if isinstance(user_data, dict) and user_data.get("vip") and user_data.get("expiry"):
+            index_vip_expiry(batch, user_id, None, user_data["expiry"])
+            indexed += 1
+            if len(batch) >= chunk_size:
+                batch.commit()
+    batch.commit()
+    
+    return indexed
+
+
+# =========================
+# TOKEN REQUEST SYSTEM
+# =========================
+def create_request(user_id, token, days, price):
+    """Create token request (user submits token for admin approval)"""
+    req_id = new_id()
+    now = int(time.time())
+    
+    request_data = {
+        "user_id": str(user_id),
+        "token": token,
+        "days": int(days),
+        "price": int(price),
+        "status": "pending",
+        "created": now,
+        "updated": now,
+        "request_id": req_id
+    }
+    
+    batch = WriteBatch()
+    batch.set(f"pending_tokens/{req_id}", request_data)
+    count(batch, pending_requests=1)
+    batch.commit()
+    
+    return req_id
+
+
+def get_request(request_id):
+    """Get token request by ID"""
+    return get(f"pending_tokens/{request_id}")
+
+
+def get_user_requests(user_id):
+    """Get all token requests by user"""
+    return query("pending_tokens", "user_id", equal_to=str(user_id))
+
+
+def approve_request(request_id, admin_id):
+    """Approve token request: charge its price and activate VIP"""
+    request = get_request(request_id)
+    
+    if not request:
+        return {"success": False, "message": "not_found"}
+    
+    if request.get("status") != "pending":
+        return {"success": False, "message": "already_processed"}
+    
+    user_id = request.get("user_id")
+    price = int(request.get("price", 0))
+    batch = WriteBatch()
+    
+    with user_lock(user_id):
+        user_data = get(f"users/{user_id}")
+        if not isinstance(user_data, dict):
+            return {"success": False, "message": "not_found"}
+        if int(user_data.get("credits", 0)) < price:
+            return {"success": False, "message": "insufficient_credits"}
+        
+        # Charge, VIP, ledger, counters and log all ride on the claim below
+        batch.increment(f"users/{user_id}/credits", -price)
+        ledger_entry(batch, user_id, -price, "vip", request_id)
+        expiry = queue_vip(batch, user_id, user_data, request.get("days", 0))
+        count(batch, total_credits=-price, pending_requests=-1)
+        
+        log_id = new_id()
+        batch.set(admin_log_path(log_id), {
+            "action": "approve_request",
+            "admin_id": str(admin_id),
+            "user_id": str(user_id),
+            "request_id": request_id,
+            "price": price,
+            "expiry": expiry,
+            "timestamp": int(time.time())
+        })
+        
+        # One conditional write: two admins can't both charge it, and the
+        # charge never happens without the claim
+        try:
+            claim_status(f"pending_tokens/{request_id}", "pending", "approved", {
+                "approved_at": int(time.time()),
+                "approved_by": str(admin_id)
+            }, batch=batch)
+        except TransactionAborted as e:
+            return {"success": False, "message": str(e)}
+        except TransactionConflict:
+            return {"success": False, "message": "conflict"}
+    
+    new_balance = int(get(f"users/{user_id}/credits") or 0)
+    return {"success": True, "message": "approved", "new_balance": new_balance, "expiry": expiry}
+
+
+def get_user_stats(user_id):
+    """Get request and payment statistics for user"""
+    user_requests = get_user_requests(user_id)
+    payments = get_user_payments(user_id)
+    
+    return {
+        "total_requests": len(user_requests),
+        "approved_requests": sum(1 for r in user_requests.values() if r.get("status") == "approved"),
+        "pending_requests": sum(1 for r in user_requests.values() if r.get("status") == "pending"),
+        "total_payments": len(payments),
+        "approved_payments": sum(1 for p in payments.values() if p.get("status") == "approved")
+    }
+
+
+def cleanup_old_requests(days=30):
+    """Delete processed token requests older than days"""
+    cutoff = int(time.time()) - (days * 24 * 60 * 60)
+    old_requests = query("pending_tokens", "created", end_at=cutoff)
+    batch = WriteBatch()
+    
+    for request_id, request in old_requests.items():
+        if request.get("status") != "pending":
+            batch.delete(f"pending_tokens/{request_id}")
+    
+    return len(batch.commit())
+
+
 # =========================
 # PAYMENT REQUEST SYSTEM
 # =========================
 def add_payment_request(user_id, amount, payment_method, proof_text=None):
     """Add payment request"""
-    pid = str(int(time.time() * 1000))
+    pid = new_id()
+    now = int(time.time())
     
     payment_data = {
         "user_id": str(user_id),
@@ -11,16 +1792,28 @@ def add_payment_request(user_id, amount, payment_method, proof_text=None):
         "payment_method": payment_method,
         "proof": proof_text or "",
         "status": "pending",
-        "created": int(time.time()),
+        "status_key": status_key("pending", pid),
+        "created": now,
+        "updated": now,
         "payment_id": pid
     }
     
-    set(f"payment_requests/{pid}", payment_data)
+    batch = WriteBatch()
+    batch.set(f"payment_requests/{pid}", payment_data)
     
     # Also add to user's payment history
-    user_payments = get(f"user_payments/{user_id}") or {}
-    user_payments[pid] = payment_data
-    set(f"user_payments/{user_id}", user_payments)
+    batch.set(f"user_payments/{user_id}/{pid}", payment_data)
+    
+    count(batch, total_payments=1, pending_payments=1)
+    push_recent(batch, "payments", pid, {
+        "payment_id": pid,
+        "user_id": str(user_id),
+        "amount": int(amount),
+        "status": "pending",
+        "created": payment_data["created"]
+    })
+    
+    batch.commit()
     
     return pid
 
@@ -32,14 +1825,12 @@ def get_payment_request(pid):
 
 def get_pending_payments():
     """Get all pending payment requests"""
-    all_payments = get("payment_requests") or {}
-    pending = {}
-    
-    for pid, payment in all_payments.items():
-        if payment.get("status") == "pending":
-            pending[pid] = payment
-    
-    return pending
+    return query("payment_requests", "status", equal_to="pending")
+
+
+def get_pending_payments_page(limit=20, cursor=None):
+    """Get one page of the pending payment queue (oldest first)"""
+    return query_status_page("payment_requests", "pending", limit=limit, cursor=cursor)
 
 
 def get_user_payments(user_id):
@@ -61,68 +1852,97 @@ def approve_payment(pid, admin_id):
     amount = payment.get("amount", 0)
     
     if not user_id or amount <= 0:
-        set(f"payment_requests/{pid}", {"status": "invalid"})
+        batch = WriteBatch()
+        count(batch, **_payment_deltas("pending", "invalid", amount))
+        batch.set(f"stats/recent_payments/{pid}/status", "invalid")
+        try:
+            claim_status(f"payment_requests/{pid}", "pending", "invalid",
+                         {"status_key": status_key("invalid", pid)}, batch=batch)
+        except TransactionAborted as e:
+            return {"success": False, "message": str(e)}
+        except TransactionConflict:
+            return {"success": False, "message": "conflict"}
         return {"success": False, "message": "invalid"}
     
-    # Add credits to user
-    new_balance = add_credits(user_id, amount)
-    
-    # Update payment status
     approved_data = {
         "status": "approved",
+        "status_key": status_key("approved", pid),
         "approved_at": int(time.time()),
-        "approved_by": str(admin_id),
-        "user_new_balance": new_balance
+        "approved_by": str(admin_id)
     }
     
-    set(f"payment_requests/{pid}", approved_data)
+    batch = WriteBatch()
+    
+    # Add credits to user
+    try:
+        add_credits(user_id, amount, batch=batch, kind="payment", ref=pid)
+    except TransactionAborted as e:
+        return {"success": False, "message": str(e)}
     
     # Update in user's payment history
-    user_payments = get(f"user_payments/{user_id}") or {}
-    if pid in user_payments:
-        user_payments[pid].update(approved_data)
-        set(f"user_payments/{user_id}", user_payments)
+    batch.set(f"user_payments/{user_id}/{pid}", {**payment, **approved_data})
+    
+    count(batch, **_payment_deltas("pending", "approved", amount))
+    batch.set(f"stats/recent_payments/{pid}/status", "approved")
     
     # Log admin action
-    log_id = str(int(time.time() * 1000))
-    set(f"admin_logs/{log_id}", {
+    log_id = new_id()
+    batch.set(admin_log_path(log_id), {
         "action": "approve_payment",
         "admin_id": str(admin_id),
         "user_id": str(user_id),
         "payment_id": pid,
         "amount": amount,
-        "new_balance": new_balance,
         "timestamp": int(time.time())
     })
     
+    # The status flip carries everything above, so a payment is credited
+    # exactly once and never half-way
+    try:
+        claim_status(f"payment_requests/{pid}", "pending", "approved", approved_data, batch=batch)
+    except TransactionAborted as e:
+        return {"success": False, "message": str(e)}
+    except TransactionConflict:
+        return {"success": False, "message": "conflict"}
+    
+    new_balance = int(get(f"users/{user_id}/credits") or 0)
     return {"success": True, "message": "approved", "new_balance": new_balance}
 
 
 def reject_payment(pid, admin_id, reason="rejected"):
-    """Reject payment request"""
+    """Reject a pending payment request"""
     payment = get_payment_request(pid)
     
     if not payment:
         return {"success": False, "message": "not_found"}
     
-    set(f"payment_requests/{pid}", {
-        "status": reason,
+    if payment.get("status") != "pending":
+        return {"success": False, "message": "already_processed"}
+    
+    rejected_data = {
+        "status_key": status_key(reason, pid),
         "rejected_at": int(time.time()),
         "rejected_by": str(admin_id),
         "reason": reason
-    })
+    }
+    
+    batch = WriteBatch()
     
     # Update in user's payment history
     user_id = payment.get("user_id")
     if user_id:
-        user_payments = get(f"user_payments/{user_id}") or {}
-        if pid in user_payments:
-            user_payments[pid].update({
-                "status": reason,
-                "rejected_at": int(time.time()),
-                "rejected_by": str(admin_id)
-            })
-            set(f"user_payments/{user_id}", user_payments)
+        batch.set(f"user_payments/{user_id}/{pid}", {**payment, **rejected_data, "status": reason})
+    
+    count(batch, **_payment_deltas("pending", reason, payment.get("amount", 0)))
+    batch.set(f"stats/recent_payments/{pid}/status", reason)
+    
+    # Only a pending payment can be rejected; the counters go with the flip
+    try:
+        claim_status(f"payment_requests/{pid}", "pending", reason, rejected_data, batch=batch)
+    except TransactionAborted as e:
+        return {"success": False, "message": str(e)}
+    except TransactionConflict:
+        return {"success": False, "message": "conflict"}
     
     return {"success": True, "message": "rejected"}
 
@@ -132,22 +1952,34 @@ def reject_payment(pid, admin_id, reason="rejected"):
 # =========================
 def add_vpn_token(user_id, vpn_token):
     """Add VPN token sent by user after VIP purchase"""
-    token_id = str(int(time.time() * 1000))
+    token_id = new_id()
+    now = int(time.time())
     
     token_data = {
         "user_id": str(user_id),
         "vpn_token": vpn_token,
         "status": "pending",
-        "created": int(time.time()),
+        "status_key": status_key("pending", token_id),
+        "created": now,
+        "updated": now,
         "token_id": token_id
     }
     
-    set(f"vpn_tokens/{token_id}", token_data)
+    batch = WriteBatch()
+    batch.set(f"vpn_tokens/{token_id}", token_data)
     
     # Also add to user's token history
-    user_tokens = get(f"user_tokens/{user_id}") or {}
-    user_tokens[token_id] = token_data
-    set(f"user_tokens/{user_id}", user_tokens)
+    batch.set(f"user_tokens/{user_id}/{token_id}", token_data)
+    
+    count(batch, pending_tokens=1)
+    push_recent(batch, "tokens", token_id, {
+        "token_id": token_id,
+        "user_id": str(user_id),
+        "status": "pending",
+        "created": token_data["created"]
+    })
+    
+    batch.commit()
     
     return token_id
 
@@ -159,14 +1991,12 @@ def get_vpn_token(token_id):
 
 def get_pending_tokens():
     """Get all pending VPN tokens"""
-    all_tokens = get("vpn_tokens") or {}
-    pending = {}
-    
-    for token_id, token_data in all_tokens.items():
-        if token_data.get("status") == "pending":
-            pending[token_id] = token_data
-    
-    return pending
+    return query("vpn_tokens", "status", equal_to="pending")
+
+
+def get_pending_tokens_page(limit=20, cursor=None):
+    """Get one page of the pending VPN token queue (oldest first)"""
+    return query_status_page("vpn_tokens", "pending", limit=limit, cursor=cursor)
 
 
 def get_user_tokens(user_id):
@@ -175,29 +2005,35 @@ def get_user_tokens(user_id):
 
 
 def mark_token_processed(token_id, admin_id):
-    """Mark VPN token as processed"""
+    """Mark a pending VPN token as processed (False if missing or already processed)"""
     token = get_vpn_token(token_id)
     
-    if not token:
+    if not token or token.get("status") != "pending":
         return False
     
-    set(f"vpn_tokens/{token_id}", {
+    processed_data = {
         "status": "processed",
+        "status_key": status_key("processed", token_id),
         "processed_at": int(time.time()),
-        "processed_by": str(admin_id)
-    })
+        "processed_by": str(admin_id),
+        "updated": int(time.time())
+    }
+    
+    batch = WriteBatch()
     
     # Update in user's token history
     user_id = token.get("user_id")
     if user_id:
-        user_tokens = get(f"user_tokens/{user_id}") or {}
-        if token_id in user_tokens:
-            user_tokens[token_id].update({
-                "status": "processed",
-                "processed_at": int(time.time()),
-                "processed_by": str(admin_id)
-            })
-            set(f"user_tokens/{user_id}", user_tokens)
+        batch.set(f"user_tokens/{user_id}/{token_id}", {**token, **processed_data})
+    
+    count(batch, pending_tokens=-1)
+    batch.set(f"stats/recent_tokens/{token_id}/status", "processed")
+    
+    # Conditional like approve_payment, so two admins can't both count it
+    try:
+        claim_status(f"vpn_tokens/{token_id}", "pending", "processed", processed_data, batch=batch)
+    except (TransactionAborted, TransactionConflict):
+        return False
     
     return True
 
@@ -206,73 +2042,132 @@ def mark_token_processed(token_id, admin_id):
 # ADMIN DASHBOARD FUNCTIONS
 # =========================
 def get_admin_dashboard():
-    """Get data for admin dashboard"""
-    users = get("users") or {}
-    payments = get("payment_requests") or {}
-    tokens = get("vpn_tokens") or {}
-    token_requests = get("pending_tokens") or {}
-    
-    # Calculate statistics
-    stats = {
+    """Get data for admin dashboard (one read of the materialized stats)"""
+    stored = read_tree("stats") or {}
+    counters = stored.get("counters") or {}
+    
+    stats = {name: counters.get(name, 0) for name in COUNTERS}
+    
+    # Read only; trim_recent_lists (run_all_cleanup) keeps the lists bounded
+    for name in ("users", "payments", "tokens"):
+        stats[f"recent_{name}"] = _recent_list(stored, name)
+    
+    return stats
+
+
+def _recent_list(stored, name, batch=None):
+    """Newest RECENT_LIMIT entries of a recent_* list, queueing deletes of the rest on batch"""
+    entries = stored.get(f"recent_{name}") or {}
+    
+    # Entries without "created" are status updates for items already trimmed
+    ordered = sorted(
+        entries.items(),
+        key=lambda item: item[1].get("created", 0) if isinstance(item[1], dict) else 0,
+        reverse=True
+    )
+    ordered = [(item_id, item) for item_id, item in ordered
+               if isinstance(item, dict) and "created" in item]
+    
+    if batch is not None and len(entries) > RECENT_LIMIT:
+        keep = {item_id for item_id, _ in ordered[:RECENT_LIMIT]}
+        for item_id in entries:
+            if item_id not in keep:
+                batch.delete(f"stats/recent_{name}/{item_id}")
+    
+    return [item for _, item in ordered[:RECENT_LIMIT]]
+
+
+def trim_recent_lists():
+    """Trim recent_* dashboard lists back to RECENT_LIMIT entries"""
+    stored = read_tree("stats") or {}
+    batch = WriteBatch()
+    
+    for name in ("users", "payments", "tokens"):
+        _recent_list(stored, name, batch)
+    
+    return len(batch.commit())
+
+
+def compute_dashboard_stats():
+    """Recompute counters and recent lists from the full trees (slow)"""
+    users = read_tree("users") or {}
+    payments = read_tree("payment_requests") or {}
+    tokens = read_tree("vpn_tokens") or {}
+    token_requests = read_tree("pending_tokens") or {}
+    
+    counters = {
         "total_users": len(users),
         "vip_users": sum(1 for u in users.values() if u.get("vip")),
         "total_credits": sum(int(u.get("credits", 0)) for u in users.values()),
         
-        "pending_payments": sum(1 for p in payments.values() if p.get("status") == "pending"),
         "total_payments": len(payments),
+        "pending_payments": sum(1 for p in payments.values() if p.get("status") == "pending"),
+        "approved_payments": sum(1 for p in payments.values() if p.get("status") == "approved"),
         "payment_amount": sum(int(p.get("amount", 0)) for p in payments.values() if p.get("status") == "approved"),
         
         "pending_tokens": sum(1 for t in tokens.values() if t.get("status") == "pending"),
-        "pending_requests": sum(1 for tr in token_requests.values() if tr.get("status") == "pending"),
-        
-        "recent_users": [],
-        "recent_payments": [],
-        "recent_tokens": []
+        "pending_requests": sum(1 for tr in token_requests.values() if tr.get("status") == "pending")
     }
     
-    # Get recent users (last 10)
-    user_list = []
+    recent = {"users": {}, "payments": {}, "tokens": {}}
+    
     for uid, user_data in users.items():
-        user_list.append({
+        recent["users"][uid] = {
             "user_id": uid,
             "name": user_data.get("name", "Unknown"),
             "credits": user_data.get("credits", 0),
             "vip": user_data.get("vip", False),
             "created": user_data.get("created_at", 0)
-        })
-    
-    # Sort by creation time
-    user_list.sort(key=lambda x: x.get("created", 0), reverse=True)
-    stats["recent_users"] = user_list[:10]
+        }
     
-    # Get recent payments (last 10)
-    payment_list = []
     for pid, payment_data in payments.items():
-        payment_list.append({
+        recent["payments"][pid] = {
             "payment_id": pid,
             "user_id": payment_data.get("user_id"),
             "amount": payment_data.get("amount", 0),
             "status": payment_data.get("status", "pending"),
             "created": payment_data.get("created", 0)
-        })
-    
-    payment_list.sort(key=lambda x: x.get("created", 0), reverse=True)
-    stats["recent_payments"] = payment_list[:10]
+        }
     
-    # Get recent tokens (last 10)
-    token_list = []
     for tid, token_data in tokens.items():
-        token_list.append({
+        recent["tokens"][tid] = {
             "token_id": tid,
             "user_id": token_data.get("user_id"),
             "status": token_data.get("status", "pending"),
             "created": token_data.get("created", 0)
-        })
+        }
     
-    token_list.sort(key=lambda x: x.get("created", 0), reverse=True)
-    stats["recent_tokens"] = token_list[:10]
+    # Keep only the newest entries of each list
+    for name, items in recent.items():
+        newest = sorted(items, key=lambda item_id: items[item_id]["created"], reverse=True)
+        recent[name] = {item_id: items[item_id] for item_id in newest[:RECENT_LIMIT]}
     
-    return stats
+    return counters, recent
+
+
+def reconcile_dashboard_stats(fix=True):
+    """Rebuild dashboard stats from scratch, returning counters that drifted
+    
+    Writes that land while the trees are being read are not counted, so run
+    this when the bot is quiet.
+    """
+    counters, recent = compute_dashboard_stats()
+    stored = get("stats/counters") or {}
+    
+    drift = {
+        name: {"stored": stored.get(name, 0), "actual": counters[name]}
+        for name in COUNTERS
+        if stored.get(name, 0) != counters[name]
+    }
+    
+    if fix:
+        batch = WriteBatch()
+        batch.set("stats/counters", counters)
+        for name, items in recent.items():
+            batch.set(f"stats/recent_{name}", items)
+        batch.commit()
+    
+    return drift
 
 
 # =========================
@@ -280,7 +2175,7 @@ def get_admin_dashboard():
 # =========================
 def log_user_activity(user_id, activity_type, details=None):
     """Log user activity"""
-    log_id = str(int(time.time() * 1000))
+    log_id = new_id()
     
     log_data = {
         "user_id": str(user_id),
@@ -289,38 +2184,38 @@ def log_user_activity(user_id, activity_type, details=None):
         "timestamp": int(time.time())
     }
     
-    set(f"user_activity/{user_id}/{log_id}", log_data)
+    batch = WriteBatch()
+    batch.set(f"user_activity/{user_id}/{log_id}", log_data)
+    index_record_day(batch, "user_activity", user_id, log_id)
     
     # Also update user's last active time
-    update_user(user_id, {"last_active": int(time.time())})
+    batch.update(f"users/{user_id}", {"last_active": log_data["timestamp"], "updated": log_data["timestamp"]})
+    _cache_user_fields(batch, user_id, {"last_active": log_data["timestamp"]})
+    batch.commit()
     
     return log_id
 
 
+def _recent_records(path, limit=None):
+    """Records under path (time-sortable ids), newest first; one query"""
+    records = query(path, "$key", limit_to_last=limit)
+    return list(reversed(list(records.items())))
+
+
 def get_user_activity(user_id, limit=50):
-    """Get user activity logs"""
-    activities = get(f"user_activity/{user_id}") or {}
-    
-    # Convert to list and sort
-    activity_list = []
-    for log_id, log_data in activities.items():
-        activity_list.append({
-            "log_id": log_id,
-            **log_data
-        })
-    
-    # Sort by timestamp
-    activity_list.sort(key=lambda x: x.get("timestamp", 0), reverse=True)
-    
-    return activity_list[:limit]
+    """Get user activity logs (newest first)"""
+    return [
+        {"log_id": log_id, **log_data}
+        for log_id, log_data in _recent_records(f"user_activity/{user_id}", limit)
+    ]
 
 
 # =========================
 # NOTIFICATION SYSTEM
 # =========================
-def add_notification(user_id, notification_type, message, data=None):
-    """Add notification for user"""
-    notif_id = str(int(time.time() * 1000))
+def add_notification(user_id, notification_type, message, data=None, batch=None):
+    """Add notification for user (queued on batch if given)"""
+    notif_id = new_id()
     
     notif_data = {
         "user_id": str(user_id),
@@ -332,17 +2227,25 @@ def add_notification(user_id, notification_type, message, data=None):
         "notification_id": notif_id
     }
     
-    set(f"notifications/{user_id}/{notif_id}", notif_data)
+    own_batch = batch is None
+    if own_batch:
+        batch = WriteBatch()
+    
+    batch.set(f"notifications/{user_id}/{notif_id}", notif_data)
+    index_record_day(batch, "notifications", user_id, notif_id)
+    # Incremental backups copy notifications of users whose record changed
+    touch(batch, f"users/{user_id}")
+    
+    if own_batch:
+        batch.commit()
     
     return notif_id
 
 
 def get_user_notifications(user_id, unread_only=False):
-    """Get user notifications"""
-    notifications = get(f"notifications/{user_id}") or {}
-    
+    """Get user notifications (newest first)"""
     notif_list = []
-    for notif_id, notif_data in notifications.items():
+    for notif_id, notif_data in _recent_records(f"notifications/{user_id}"):
         if unread_only and notif_data.get("status") != "unread":
             continue
         
@@ -351,22 +2254,21 @@ def get_user_notifications(user_id, unread_only=False):
             **notif_data
         })
     
-    # Sort by creation time
-    notif_list.sort(key=lambda x: x.get("created", 0), reverse=True)
-    
     return notif_list
 
 
 def mark_notification_read(user_id, notification_id):
     """Mark notification as read"""
-    notification = get(f"notifications/{user_id}/{notification_id}")
+    path = f"notifications/{user_id}/{notification_id}"
     
-    if notification:
-        set(f"notifications/{user_id}/{notification_id}", {
-            **notification,
+    if get(f"{path}/status") is not None:
+        batch = WriteBatch()
+        batch.update(path, {
             "status": "read",
             "read_at": int(time.time())
         })
+        touch(batch, f"users/{user_id}")
+        batch.commit()
         return True
     
     return False
@@ -376,16 +2278,15 @@ def mark_notification_read(user_id, notification_id):
 # BULK OPERATIONS
 # =========================
 def bulk_add_credits(user_credits_dict, admin_id, reason="bulk_add"):
-    """Add credits to multiple users at once"""
+    """Add credits to multiple users at once (one request, all or nothing)"""
     results = {}
-    logs = []
+    batch = WriteBatch()
     
     for user_id, amount in user_credits_dict.items():
         try:
-            new_balance = add_credits(user_id, amount)
+            add_credits(user_id, amount, batch=batch, kind="bulk", ref=reason)
             results[str(user_id)] = {
                 "success": True,
-                "new_balance": new_balance,
                 "amount": amount
             }
             
@@ -394,18 +2295,18 @@ def bulk_add_credits(user_credits_dict, admin_id, reason="bulk_add"):
                 user_id,
                 "credits_added",
                 f"Admin မှ သင့်အကောင့်သို့ credits {amount} ထည့်ပေးပြီးပါပြီ။",
-                {"amount": amount, "new_balance": new_balance}
+                {"amount": amount},
+                batch=batch
             )
             
             # Log admin action
-            log_id = str(int(time.time() * 1000))
-            logs.append({
+            log_id = new_id()
+            batch.set(admin_log_path(log_id), {
                 "log_id": log_id,
                 "action": "bulk_add_credits",
                 "admin_id": str(admin_id),
                 "user_id": str(user_id),
                 "amount": amount,
-                "new_balance": new_balance,
                 "reason": reason,
                 "timestamp": int(time.time())
             })
@@ -417,62 +2318,142 @@ def bulk_add_credits(user_credits_dict, admin_id, reason="bulk_add"):
                 "amount": amount
             }
     
-    # Save all logs
-    for log_data in logs:
-        set(f"admin_logs/{log_data['log_id']}", log_data)
+    # Balances, ledger entries, notifications, logs and counters in one request
+    try:
+        batch.commit()
+    except Exception as e:
+        for result in results.values():
+            if result["success"]:
+                result.update(success=False, error=str(e))
     
     return results
 
 
 def bulk_set_vip(user_days_dict, admin_id, reason="bulk_set"):
-    """Set VIP for multiple users at once"""
+    """Set VIP for multiple users at once (one request, all or nothing)"""
     results = {}
-    logs = []
-    
-    for user_id, days in user_days_dict.items():
+    batch = WriteBatch()
+    
+    # Held from the reads until the commit, like a conditional write per user
+    with user_locks(user_days_dict):
+        for user_id, days in user_days_dict.items():
+            try:
+                user_data = get(f"users/{user_id}")
+                if not isinstance(user_data, dict):
+                    raise TransactionAborted("not_found")
+                
+                expiry = queue_vip(batch, user_id, user_data, days)
+                results[str(user_id)] = {
+                    "success": True,
+                    "expiry": expiry,
+                    "days": days
+                }
+                
+                # Add notification
+                add_notification(
+                    user_id,
+                    "vip_activated",
+                    f"Admin မှ သင့်အား VIP {days} ရက် ဖွင့်ပေးပြီးပါပြီ။",
+                    {"days": days, "expiry": expiry},
+                    batch=batch
+                )
+                
+                # Log admin action
+                log_id = new_id()
+                batch.set(admin_log_path(log_id), {
+                    "log_id": log_id,
+                    "action": "bulk_set_vip",
+                    "admin_id": str(admin_id),
+                    "user_id": str(user_id),
+                    "days": days,
+                    "expiry": expiry,
+                    "reason": reason,
+                    "timestamp": int(time.time())
+                })
+                
+            except Exception as e:
+                results[str(user_id)] = {
+                    "success": False,
+                    "error": str(e),
+                    "days": days
+                }
+        
+        # VIP flags, expiry index, counters, notifications and logs in one request
         try:
-            expiry = add_vip(user_id, days)
-            results[str(user_id)] = {
-                "success": True,
-                "expiry": expiry,
-                "days": days
-            }
-            
-            # Add notification
-            add_notification(
-                user_id,
-                "vip_activated",
-                f"Admin မှ သင့်အား VIP {days} ရက် ဖွင့်ပေးပြီးပါပြီ။",
-                {"days": days, "expiry": expiry}
-            )
-            
-            # Log admin action
-            log_id = str(int(time.time() * 1000))
-            logs.append({
-                "log_id": log_id,
-                "action": "bulk_set_vip",
-                "admin_id": str(admin_id),
-                "user_id": str(user_id),
-                "days": days,
-                "expiry": expiry,
-                "reason": reason,
-                "timestamp": int(time.time())
-            })
-            
+            batch.commit()
         except Exception as e:
-            results[str(user_id)] = {
-                "success": False,
-                "error": str(e),
-                "days": days
-            }
-    
-    # Save all logs
-    for log_data in logs:
-        set(f"admin_logs/{log_data['log_id']}", log_data)
+            for result in results.values():
+                if result["success"]:
+                    result.update(success=False, error=str(e))
     
     return results
 
 
+# =========================
+# BROADCASTS
+# =========================
+BROADCAST_COUNTS = ("sent", "failed", "blocked", "skipped")
+
+
+def create_broadcast(admin_id, text, audience="all", parse_mode=None):
+    """Create a broadcast to "all" or "vip" users; progress is checkpointed on it"""
+    broadcast_id = new_id()
+    counters = get("stats/counters") or {}
+    
+    broadcast_data = {
+        "broadcast_id": broadcast_id,
+        "admin_id": str(admin_id),
+        "text": text,
+        "parse_mode": parse_mode,
+        "audience": audience,
+        "status": "running",
+        "total": counters.get("vip_users" if audience == "vip" else "total_users", 0),
+        "created": int(time.time()),
+        "updated": int(time.time()),
+        **{name: 0 for name in BROADCAST_COUNTS}
+    }
+    
+    set(f"broadcasts/{broadcast_id}", {k: v for k, v in broadcast_data.items() if v is not None})
+    return broadcast_id
+
+
+def get_broadcast(broadcast_id):
+    """Get broadcast record"""
+    return get(f"broadcasts/{broadcast_id}")
+
+
+def checkpoint_broadcast(broadcast_id, fields):
+    """Save broadcast progress (cursor, counts, status)"""
+    update(f"broadcasts/{broadcast_id}", {**fields, "updated": int(time.time())})
+
+
+def finish_broadcast(broadcast_id, fields):
+    """Mark a running broadcast done with its final progress; False if it was cancelled meanwhile
+    
+    Also False if the record kept changing (TransactionConflict); it then stays as it was.
+    """
+    try:
+        claim_status(f"broadcasts/{broadcast_id}", "running", "done", {**fields, "finished": int(time.time())})
+        return True
+    except (TransactionAborted, TransactionConflict):
+        return False
+
+
+def get_active_broadcasts():
+    """Broadcasts that are still running (e.g. to resume after a restart)"""
+    return query("broadcasts", "status", equal_to="running")
+
+
+def get_user_page(limit=200, cursor=None):
+    """One page of users in key order, for walking the whole tree"""
+    return query_page("users", "$key", limit=limit, cursor=cursor)
+
+
+def get_vip_page(limit=200, cursor=None):
+    """One page of the VIP expiry index from now on ({"user_id", "expiry"} entries), for walking VIP users"""
+    return query_page("vip_expiry", "$key", start_at=expiry_key(time.time(), ""), limit=limit, cursor=cursor)
+
+
 # =========================
 # BACKUP & EXPORT
 # =========================
@@ -497,12 +2478,15 @@ def export_user_data(user_id):
 
 
 def export_all_data():
-    """Export all system data (admin only)"""
-    users = get("users") or {}
-    payments = get("payment_requests") or {}
-    tokens = get("vpn_tokens") or {}
-    token_requests = get("pending_tokens") or {}
-    admin_logs = get("admin_logs") or {}
+    """Export all system data (admin only)
+    
+    Holds everything in memory; backup.export_trees streams to disk instead.
+    """
+    users = read_tree("users") or {}
+    payments = read_tree("payment_requests") or {}
+    tokens = read_tree("vpn_tokens") or {}
+    token_requests = read_tree("pending_tokens") or {}
+    admin_logs = read_tree("admin_logs") or {}
     
     return {
         "users": users,
@@ -516,7 +2500,7 @@ def export_all_data():
             "payments": len(payments),
             "vpn_tokens": len(tokens),
             "token_requests": len(token_requests),
-            "admin_logs": len(admin_logs)
+            "admin_logs": sum(len(bucket) for bucket in admin_logs.values())
         }
     }
 
@@ -552,30 +2536,70 @@ def validate_request_id(request_id):
 # UTILITY FUNCTIONS
 # =========================
 def get_user_by_username(username):
-    """Get user by username"""
-    users = get("users") or {}
+    """Get user by username (one index lookup)"""
+    if not username:
+        return {}
     
-    for user_id, user_data in users.items():
-        if user_data.get("username") == username:
-            return {user_id: user_data}
+    user_id = get(f"username_index/{index_key(username.lower())}")
+    if not user_id:
+        return {}
+    
+    user_data = get_user(user_id)
+    if user_data and user_data.get("username") == username:
+        return {user_id: user_data}
     
     return {}
 
 
-def search_users(search_term):
-    """Search users by name or username"""
-    users = get("users") or {}
-    results = {}
-    
+def _matches(user_id, user_data, search_term):
+    return (
+        search_term in (user_data.get("name") or "").lower()
+        or search_term in (user_data.get("username") or "").lower()
+        or search_term in str(user_id)
+    )
+
+
+def search_users(search_term, limit=None):
+    """Search users by name, username or id (substring, case-insensitive); limit caps the results"""
     search_term = search_term.lower()
     
-    for user_id, user_data in users.items():
-        name = user_data.get("name", "").lower()
-        username = user_data.get("username", "").lower()
-        
-        if (search_term in name or 
-            search_term in username or 
-            search_term in str(user_id)):
+    # Terms shorter than one n-gram can't use the index
+    if len(search_term) < SEARCH_NGRAM:
+        users = read_tree("users") or {}
+        matches = [user_id for user_id, user_data in users.items() if _matches(user_id, user_data, search_term)]
+        return {user_id: users[user_id] for user_id in sorted(matches)[:limit]}
+    
+    # Every n-gram of the term must match: intersect the posting keys
+    # (shallow reads), then download only the shortest posting list
+    candidates = None
+    sizes = {}
+    for gram in sorted(ngrams(search_term)):
+        keys = list_keys(f"search_index/{index_key(gram)}")
+        sizes[gram] = len(keys)
+        candidates = frozenset(keys) if candidates is None else candidates.intersection(keys)
+        if not candidates:
+            return {}
+    
+    # N-grams can match out of order, so confirm the substring on the entries
+    rarest = min(sizes, key=sizes.get)
+    posting = get(f"search_index/{index_key(rarest)}") or {}
+    matches = [
+        user_id for user_id in sorted(candidates)
+        # Entries written before they held the name are checked on the record
+        if _matches(user_id, posting[user_id] if isinstance(posting.get(user_id), dict)
+                    else get_user(user_id) or {}, search_term)
+    ]
+    
+    # Full records only for the results returned
+    matches = matches[:limit]
+    if len(matches) > SEARCH_FETCH_EACH:
+        users = read_tree("users") or {}
+        return {user_id: users[user_id] for user_id in matches if users.get(user_id)}
+    
+    results = {}
+    for user_id in matches:
+        user_data = get_user(user_id)
+        if user_data:
             results[user_id] = user_data
     
     return results
@@ -603,52 +2627,55 @@ def get_user_summary(user_id):
 # CLEANUP FUNCTIONS (Extended)
 # =========================
 def cleanup_old_notifications(days=30):
-    """Clean up old notifications"""
-    all_users = get("users") or {}
-    cutoff = int(time.time()) - (days * 24 * 60 * 60)
-    deleted = 0
-    
-    for user_id in all_users.keys():
-        notifications = get(f"notifications/{user_id}") or {}
-        for notif_id, notif_data in list(notifications.items()):
-            created = notif_data.get("created", 0)
-            if created < cutoff:
-                delete(f"notifications/{user_id}/{notif_id}")
-                deleted += 1
-    
-    return deleted
+    """Delete notifications older than days. Returns notifications removed"""
+    return _delete_user_records("notifications", days)
 
 
 def cleanup_old_activity_logs(days=90):
-    """Clean up old activity logs"""
-    all_users = get("users") or {}
-    cutoff = int(time.time()) - (days * 24 * 60 * 60)
-    deleted = 0
+    """Delete activity logs older than days. Returns logs removed"""
+    return _delete_user_records("user_activity", days)
+
+
+def cleanup_old_admin_logs(days=180):
+    """Delete admin logs older than days. Returns logs removed"""
+    return _delete_buckets("admin_logs", days)
+
+
+def _delete_buckets(path, days):
+    """Drop expired day buckets under path in one write, returns the records they held"""
+    buckets = expired_buckets(path, days)
     
-    for user_id in all_users.keys():
-        activities = get(f"user_activity/{user_id}") or {}
-        for log_id, log_data in list(activities.items()):
-            timestamp = log_data.get("timestamp", 0)
-            if timestamp < cutoff:
-                delete(f"user_activity/{user_id}/{log_id}")
-                deleted += 1
+    # Shallow reads: the records are counted, not downloaded
+    removed = sum(len(list_keys(f"{path}/{bucket}")) for bucket in buckets)
     
-    return deleted
+    batch = WriteBatch()
+    for bucket in buckets:
+        batch.delete(f"{path}/{bucket}")
+    if len(batch):
+        batch.commit()
+    
+    return removed
 
 
-def cleanup_old_admin_logs(days=180):
-    """Clean up old admin logs"""
-    admin_logs = get("admin_logs") or {}
-    cutoff = int(time.time()) - (days * 24 * 60 * 60)
-    deleted = 0
+def _delete_user_records(path, days, chunk_size=500):
+    """Drop path/{uid}/{id} records of expired days, found through the day index"""
+    index = f"{path}_days"
+    removed = 0
     
-    for log_id, log_data in list(admin_logs.items()):
-        timestamp = log_data.get("timestamp", 0)
-        if timestamp < cutoff:
-            delete(f"admin_logs/{log_id}")
-            deleted += 1
+    for bucket in expired_buckets(index, days):
+        batch = WriteBatch()
+        for user_id, record_ids in (get(f"{index}/{bucket}") or {}).items():
+            for record_id in record_ids:
+                batch.delete(f"{path}/{user_id}/{record_id}")
+                removed += 1
+                if len(batch) >= chunk_size:
+                    batch.commit()
+        
+        # The day's index goes last, so an interrupted run is picked up again
+        batch.delete(f"{index}/{bucket}")
+        batch.commit()
     
-    return deleted
+    return removed
 
 
 def run_all_cleanup():
@@ -658,7 +2685,8 @@ def run_all_cleanup():
         "old_requests": cleanup_old_requests(),
         "old_notifications": cleanup_old_notifications(),
         "old_activity_logs": cleanup_old_activity_logs(),
-        "old_admin_logs": cleanup_old_admin_logs()
+        "old_admin_logs": cleanup_old_admin_logs(),
+        "recent_lists": trim_recent_lists()
     }
     
     return results
@@ -681,7 +2709,7 @@ def create_test_user(user_id=None, credits=100, vip=False):
         "last_active": int(time.time())
     }
     
-    set(f"users/{user_id}", test_user)
+    create_user(user_id, test_user)
     return user_id, test_user
 
 
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Local fake Firebase Realtime Database REST server (benchmarks / offline runs)
+"""
+
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from rtdb_tree import etag, join_path, query_node, relative_path, resolve_server_values, tree_get, tree_set
+
+
+def tree_query(node, params):
+    """Apply REST query parameters (orderBy, equalTo, startAt, ...) to a node"""
+    if params.get("shallow") == "true":
+        if isinstance(node, dict):
+            return {key: True for key in node}
+        return node
+
+    if "orderBy" not in params:
+        return node
+    if not isinstance(node, dict):
+        return None
+
+    values = {name: json.loads(params[name])
+              for name in ("orderBy", "equalTo", "startAt", "endAt") if name in params}
+    limits = {name: int(params[name]) for name in ("limitToFirst", "limitToLast") if name in params}
+
+    return query_node(
+        node,
+        order_by=values["orderBy"],
+        equal_to=values.get("equalTo"),
+        start_at=values.get("startAt"),
+        end_at=values.get("endAt"),
+        limit_to_first=limits.get("limitToFirst"),
+        limit_to_last=limits.get("limitToLast")
+    )
+
+
+# ========================
+# HTTP SERVER
+# ========================
+class FakeRTDB:
+    """Threaded fake RTDB serving /<path>.json over keep-alive HTTP
+
+    GET with "Accept: text/event-stream" opens a streaming subscription
+    that behaves like the Firebase REST streaming API. Conditional requests
+    (X-Firebase-ETag / if-match) work as in the REST API.
+    """
+
+    def __init__(self, data=None, latency=0.0, connect_delay=0.0, keepalive=30.0,
+                 host="127.0.0.1", port=0):
+        self.data = data or {}
+        self.latency = latency
+        self.connect_delay = connect_delay
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "connections": 0}
+        self.streams = []
+        self.running = True
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        # Hundreds of clients connect at once under load; the default backlog of 5 resets them
+        self.server.request_queue_size = 1024
+        self.server.server_bind()
+        self.server.server_activate()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def _notify(self, method, path, writes):
+        """Queue stream events for a write (called with self.lock held)"""
+        for stream_path, events in self.streams:
+            base = relative_path(path, stream_path)
+            if method == "PATCH" and base is not None:
+                events.put(("patch", json.dumps({"path": base, "data": writes})))
+                continue
+
+            for key, value in writes.items():
+                write_path = join_path(path, key)
+                below = relative_path(write_path, stream_path)
+                if below is not None:
+                    events.put(("put", json.dumps({"path": below, "data": value})))
+                elif relative_path(stream_path, write_path) is not None:
+                    data = tree_get(self.data, stream_path)
+                    events.put(("put", json.dumps({"path": "/", "data": data})))
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                # Simulate TCP+TLS handshake cost of a new connection
+                fake._count("connections")
+                if fake.connect_delay:
+                    time.sleep(fake.connect_delay)
+                super().setup()
+
+            def log_message(self, format, *args):
+                pass
+
+            def _path(self):
+                path = unquote(urlsplit(self.path).path)
+                if path.endswith(".json"):
+                    path = path[:-5]
+                return path
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"null")
+
+            def _reply(self, payload, status=200, headers=None):
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _handle(self, method):
+                fake._count("requests")
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                path = self._path()
+                params = {key: values[0] for key, values in parse_qs(urlsplit(self.path).query).items()}
+                if_match = self.headers.get("if-match")
+                body = self._body() if method in ("PUT", "PATCH") else None
+                headers = {}
+                status = 200
+                with fake.lock:
+                    current = tree_get(fake.data, path)
+                    if if_match is not None and if_match != etag(current):
+                        # Precondition failed: reply with the current value and its ETag
+                        status = 412
+                        value = current
+                        headers["ETag"] = etag(current)
+                    elif method == "GET":
+                        value = tree_query(current, params)
+                        if self.headers.get("X-Firebase-ETag") == "true":
+                            headers["ETag"] = etag(current)
+                    elif method == "PUT":
+                        value = resolve_server_values(current, body)
+                        fake.data = tree_set(fake.data, path, value)
+                        fake._notify(method, path, {"": value})
+                    elif method == "PATCH":
+                        value = {}
+                        for key, child in body.items():
+                            child_path = join_path(path, key)
+                            value[key] = resolve_server_values(tree_get(fake.data, child_path), child)
+                            fake.data = tree_set(fake.data, child_path, value[key])
+                        fake._notify(method, path, value)
+                    else:
+                        value = None
+                        fake.data = tree_set(fake.data, path, None)
+                        fake._notify(method, path, {"": None})
+                    payload = json.dumps(value).encode()
+
+                self._reply(payload, status, headers)
+
+            def _stream(self):
+                fake._count("requests")
+                path = self._path()
+                events = queue.Queue()
+
+                with fake.lock:
+                    data = tree_get(fake.data, path)
+                    events.put(("put", json.dumps({"path": "/", "data": data})))
+                    fake.streams.append((path, events))
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.close_connection = True
+
+                try:
+                    while fake.running:
+                        try:
+                            event, data = events.get(timeout=fake.keepalive)
+                        except queue.Empty:
+                            event, data = "keep-alive", "null"
+                        message = f"event: {event}\ndata: {data}\n\n".encode()
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(message), message))
+                        self.wfile.flush()
+                except OSError:
+                    pass
+                finally:
+                    with fake.lock:
+                        fake.streams = [stream for stream in fake.streams if stream[1] is not events]
+
+            def do_GET(self):
+                if "text/event-stream" in self.headers.get("Accept", ""):
+                    self._stream()
+                else:
+                    self._handle("GET")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def do_PATCH(self):
+                self._handle("PATCH")
+
+            def do_DELETE(self):
+                self._handle("DELETE")
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local fake RTDB server")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--connect-delay", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeRTDB(latency=args.latency, connect_delay=args.connect_delay, port=args.port)
+    print(f"🔥 Fake RTDB listening on {fake.url}")
+    fake.server.serve_forever()
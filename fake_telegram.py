@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+Local fake Telegram Bot API server that enforces flood limits (benchmarks / offline runs)
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+
+class FakeTelegram:
+    """Answers /bot<token>/<method> like the Bot API
+
+    Sends beyond global_rate per second overall or chat_rate per second
+    to one chat get a 429 with retry_after, as Telegram does. Chats in
+    blocked answer 403 like users who blocked the bot.
+    """
+
+    def __init__(self, latency=0.0, global_rate=30, chat_rate=1, retry_after=1, blocked=(),
+                 host="127.0.0.1", port=0):
+        self.latency = latency
+        self.blocked = {str(chat_id) for chat_id in blocked}
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.recent = deque()
+        self.last_by_chat = {}
+        self.messages = []
+        self.stats = {"requests": 0, "sent": 0, "rate_limited": 0, "blocked": 0}
+        self.message_id = 0
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class(), bind_and_activate=False)
+        self.server.daemon_threads = True
+        # Hundreds of clients connect at once under load; the default backlog of 5 resets them
+        self.server.request_queue_size = 1024
+        self.server.server_bind()
+        self.server.server_activate()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self):
+        """base_url for telegram.Bot (the token is appended to it)"""
+        return f"{self.url}/bot"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _send(self, method, params):
+        """Record a send, or return None if it breaks a flood limit (lock held)"""
+        now = time.monotonic()
+        chat_id = str(params.get("chat_id"))
+
+        while self.recent and now - self.recent[0] >= 1:
+            self.recent.popleft()
+        last = self.last_by_chat.get(chat_id)
+        if len(self.recent) >= self.global_rate or (last is not None and now - last < 1 / self.chat_rate):
+            self.stats["rate_limited"] += 1
+            return None
+
+        self.recent.append(now)
+        self.last_by_chat[chat_id] = now
+        self.stats["sent"] += 1
+        self.message_id += 1
+        self.messages.append({"method": method, "at": now, **params})
+
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if chat_id.lstrip("-").isdigit() else 0, "type": "private"}
+        }
+        if "text" in params:
+            message["text"] = params["text"]
+        if method == "sendPhoto":
+            message["photo"] = []
+        return message
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _params(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+                if "json" in self.headers.get("Content-Type", ""):
+                    return json.loads(body or b"{}")
+                return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                params = self._params()
+                method = urlsplit(self.path).path.rsplit("/", 1)[-1]
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                with fake.lock:
+                    fake.stats["requests"] += 1
+                    if method == "getMe":
+                        result = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+                    elif str(params.get("chat_id")) in fake.blocked:
+                        fake.stats["blocked"] += 1
+                        result = False
+                    else:
+                        result = fake._send(method, params)
+
+                if result is False:
+                    self._reply(403, {
+                        "ok": False,
+                        "error_code": 403,
+                        "description": "Forbidden: bot was blocked by the user"
+                    })
+                elif result is None:
+                    self._reply(429, {
+                        "ok": False,
+                        "error_code": 429,
+                        "description": f"Too Many Requests: retry after {fake.retry_after}",
+                        "parameters": {"retry_after": fake.retry_after}
+                    })
+                else:
+                    self._reply(200, {"ok": True, "result": result})
+
+            do_GET = do_POST
+
+        return Handler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local fake Telegram Bot API server")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    fake = FakeTelegram(latency=args.latency, port=args.port)
+    print(f"🤖 Fake Bot API listening on {fake.base_url}<token>/")
+    fake.server.serve_forever()
@@ -0,0 +1,92 @@
+"""
+Time-sortable record ids (Firebase push-id style)
+
+An id is 8 characters of millisecond timestamp followed by 12 random
+characters, all from an alphabet in ASCII order, so ids sort by creation
+time as plain strings (and with orderByKey). Ids made in the same
+millisecond by one process increment the random part instead of drawing
+a new one, so they stay unique and strictly increasing.
+"""
+
+import os
+import threading
+import time
+
+PUSH_CHARS = "-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ_abcdefghijklmnopqrstuvwxyz"
+TIME_CHARS = 8
+RANDOM_CHARS = 12
+
+
+def _encode_time(timestamp_ms):
+    chars = []
+    for _ in range(TIME_CHARS):
+        chars.append(PUSH_CHARS[timestamp_ms % 64])
+        timestamp_ms //= 64
+    return "".join(reversed(chars))
+
+
+class IdGenerator:
+    """Thread-safe generator of unique, monotonically increasing ids"""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last_time = 0
+        self.last_random = [0] * RANDOM_CHARS
+
+    def new_id(self):
+        with self.lock:
+            now = int(self.clock() * 1000)
+
+            if now > self.last_time:
+                self.last_time = now
+                self.last_random = [byte % 64 for byte in os.urandom(RANDOM_CHARS)]
+            else:
+                # Same millisecond (or clock stepped back): keep the time, bump the suffix
+                self._increment()
+
+            return _encode_time(self.last_time) + "".join(PUSH_CHARS[i] for i in self.last_random)
+
+    def _increment(self):
+        for position in range(RANDOM_CHARS - 1, -1, -1):
+            if self.last_random[position] < 63:
+                self.last_random[position] += 1
+                return
+            self.last_random[position] = 0
+
+        # Suffix space exhausted within one millisecond; borrow the next one
+        self.last_time += 1
+
+
+_generator = IdGenerator()
+
+# A forked child must not continue the parent's random suffix
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=lambda: _generator.__init__(_generator.clock))
+
+
+def new_id():
+    """New unique, time-sortable record id"""
+    return _generator.new_id()
+
+
+def id_timestamp(record_id):
+    """Creation time (ms) of an id; legacy millisecond ids are accepted too"""
+    record_id = str(record_id)
+    if record_id.isdigit():
+        return int(record_id)
+    if len(record_id) != TIME_CHARS + RANDOM_CHARS:
+        raise ValueError(f"not a record id: {record_id!r}")
+
+    timestamp_ms = 0
+    for char in record_id[:TIME_CHARS]:
+        position = PUSH_CHARS.find(char)
+        if position < 0:
+            raise ValueError(f"not a record id: {record_id!r}")
+        timestamp_ms = timestamp_ms * 64 + position
+    return timestamp_ms
+
+
+def id_floor(timestamp_ms):
+    """Smallest id created at timestamp_ms (bound for orderByKey range queries)"""
+    return _encode_time(int(timestamp_ms)) + PUSH_CHARS[0] * RANDOM_CHARS
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+"""
+KSP VIP VPN - Database maintenance commands
+"""
+
+import argparse
+import json
+
+import database
+from backup import backup_chain, export_trees, export_user, import_backup, restore_chain, verify
+from database import (
+    WriteBatch, day_bucket, get, id_bucket, is_bucket, list_keys, rebuild_user_indexes,
+    rebuild_vip_expiry_index, reconcile_dashboard_stats, reconcile_ledger, run_all_cleanup,
+    snapshot_ledger, status_key
+)
+
+
+# ========================
+# HISTORY LAYOUT CHECK
+# ========================
+HISTORIES = {
+    "user_payments": ("payment_requests", "payment_id"),
+    "user_tokens": ("vpn_tokens", "token_id"),
+}
+
+
+def check_history_layout(history_path, fix=False):
+    """Verify history/{uid}/{id} entries mirror their source records"""
+    source_path, id_field = HISTORIES[history_path]
+    source = get(source_path) or {}
+    histories = get(history_path) or {}
+
+    report = {"users": 0, "entries": 0, "problems": []}
+    batch = WriteBatch()
+
+    def problem(kind, user_id, record_id):
+        report["problems"].append({"type": kind, "user_id": user_id, "id": record_id})
+        if fix and record_id in source:
+            owner = str(source[record_id].get("user_id", user_id))
+            batch.set(f"{history_path}/{owner}/{record_id}", source[record_id])
+
+    for user_id, entries in histories.items():
+        report["users"] += 1
+
+        # Per-child writes need a keyed object, not an array
+        if not isinstance(entries, dict):
+            report["problems"].append({"type": "not_keyed", "user_id": user_id, "id": None})
+            continue
+
+        for record_id, entry in entries.items():
+            report["entries"] += 1
+
+            if not isinstance(entry, dict):
+                problem("not_a_record", user_id, record_id)
+            elif record_id not in source:
+                report["problems"].append({"type": "orphan", "user_id": user_id, "id": record_id})
+            elif entry.get(id_field, record_id) != record_id:
+                problem("id_mismatch", user_id, record_id)
+            elif str(source[record_id].get("user_id")) != str(user_id):
+                problem("wrong_user", user_id, record_id)
+            elif entry.get("status") != source[record_id].get("status"):
+                problem("stale_status", user_id, record_id)
+
+    for record_id, record in source.items():
+        user_id = str(record.get("user_id"))
+        entries = histories.get(user_id)
+        if not isinstance(entries, dict) or record_id not in entries:
+            problem("missing", user_id, record_id)
+
+    if fix and batch:
+        report["fixed"] = len(batch.commit())
+
+    return report
+
+
+# ========================
+# STATUS QUEUE KEYS
+# ========================
+def backfill_status_keys(path):
+    """Add status_key to records written before the queue index existed"""
+    records = get(path) or {}
+    batch = WriteBatch()
+
+    for record_id, record in records.items():
+        expected = status_key(record.get("status", "pending"), record_id)
+        if record.get("status_key") != expected:
+            batch.set(f"{path}/{record_id}/status_key", expected)
+
+    return len(batch.commit())
+
+
+# ========================
+# LOG BUCKETS
+# ========================
+# Legacy layouts: admin_logs/{id} (moved into day buckets), and
+# user_activity/{day}/{uid}/{id}, notifications/{day}/{uid}/{id} (moved to {uid}/{id})
+LOG_TREES = {"admin_logs": False, "user_activity": True, "notifications": True}
+
+
+def record_bucket(record_id, record):
+    """Day bucket for a legacy record (its id, else its timestamp)"""
+    try:
+        return id_bucket(record_id)
+    except ValueError:
+        return day_bucket(record.get("timestamp") or record.get("created") or 0)
+
+
+def legacy_records(path, key, per_user):
+    """target path -> record for the legacy records under path/key (none if key is current)"""
+    if per_user:
+        if not is_bucket(key):
+            return None
+        return {
+            f"{path}/{user_id}/{record_id}": record
+            for user_id, records in (get(f"{path}/{key}") or {}).items()
+            for record_id, record in (records or {}).items()
+            if isinstance(record, dict)
+        }
+
+    if is_bucket(key):
+        return None
+    record = get(f"{path}/{key}")
+    return {f"{path}/{record_bucket(key, record)}/{key}": record} if isinstance(record, dict) else {}
+
+
+def migrate_logs(path, per_user, dry_run=False, chunk_size=500):
+    """Move legacy records under path into the current layout (per user, or day buckets)"""
+    moved = 0
+    batch = WriteBatch()
+
+    for key in list_keys(path):
+        records = legacy_records(path, key, per_user)
+        if records is None:
+            continue
+
+        for target, record in records.items():
+            batch.set(target, record)
+            if per_user:
+                # Day index for retention: the record's old bucket
+                batch.set(f"{path}_days/{key}/{target.split('/', 1)[1]}", True)
+            moved += 1
+
+        # Copy and delete land in the same atomic update
+        batch.delete(f"{path}/{key}")
+        if len(batch) >= chunk_size:
+            if not dry_run:
+                batch.commit()
+            batch = WriteBatch()
+
+    if len(batch) and not dry_run:
+        batch.commit()
+
+    return moved
+
+
+# ========================
+# CREDIT LEDGER
+# ========================
+def snapshot_ledgers():
+    """Snapshot every user's settled ledger entries, returns snapshots written"""
+    return sum(1 for user_id in list_keys("ledger") if snapshot_ledger(user_id))
+
+
+# ========================
+# COMMAND LINE
+# ========================
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--db", help="database to work on instead of STORAGE_BACKEND: a Firebase URL, "
+                                     "sqlite:PATH or memory (e.g. a local copy)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    check = commands.add_parser("check-history", help="verify user_payments/user_tokens layout")
+    check.add_argument("--fix", action="store_true", help="rewrite missing or stale entries")
+
+    commands.add_parser("backfill-status-keys", help="add status_key to existing payments/tokens")
+
+    reconcile = commands.add_parser("reconcile", help="rebuild dashboard counters and report drift")
+    reconcile.add_argument("--dry-run", action="store_true", help="report drift without rewriting")
+
+    commands.add_parser("rebuild-indexes", help="rebuild username, search and VIP expiry indexes")
+
+    migrate = commands.add_parser("migrate-logs", help="move logs/notifications from old layouts into the current one")
+    migrate.add_argument("--dry-run", action="store_true", help="count records without moving them")
+
+    ledger = commands.add_parser("reconcile-ledger", help="check the credit ledger against balances and payments")
+    ledger.add_argument("--fix", action="store_true", help="append adjustment entries for balance drift and apply parked writes")
+
+    commands.add_parser("cleanup", help="expire VIPs, drop old requests/logs and trim the dashboard lists")
+
+    commands.add_parser("snapshot-ledgers", help="compact settled ledger entries into balance snapshots")
+
+    export = commands.add_parser("export", help="stream a (resumable) backup into a directory")
+    export.add_argument("directory")
+    export.add_argument("--user", help="export only this user's records")
+
+    restore = commands.add_parser("import", help="restore a backup directory into the database")
+    restore.add_argument("directory")
+    restore.add_argument("--tree", action="append", dest="trees", help="restore only this tree (repeatable)")
+
+    chain = commands.add_parser("backup", help="add a delta (or --full) backup to a backup chain directory")
+    chain.add_argument("root")
+    chain.add_argument("--full", action="store_true", help="start the chain over with a full backup")
+
+    restore_all = commands.add_parser("restore", help="restore the latest full backup plus its deltas")
+    restore_all.add_argument("root")
+
+    check_copy = commands.add_parser("verify", help="diff a restored copy against the source database")
+    check_copy.add_argument("copy_url", help="Firebase URL (or sqlite:PATH) of the restored copy")
+
+    args = parser.parse_args()
+    if args.db:
+        database.use_backend(args.db)
+
+    if args.command == "check-history":
+        ok = True
+        for history_path in HISTORIES:
+            report = check_history_layout(history_path, fix=args.fix)
+            ok = ok and not report["problems"]
+            print(f"📋 {history_path}: {report['users']} users, {report['entries']} entries, "
+                  f"{len(report['problems'])} problems")
+            for item in report["problems"][:20]:
+                print("   " + json.dumps(item))
+            if "fixed" in report:
+                print(f"   🔧 rewrote {report['fixed']} entries")
+        raise SystemExit(0 if ok or args.fix else 1)
+
+    if args.command == "backfill-status-keys":
+        for path in ("payment_requests", "vpn_tokens"):
+            print(f"🔧 {path}: {backfill_status_keys(path)} records updated")
+
+    if args.command == "reconcile":
+        drift = reconcile_dashboard_stats(fix=not args.dry_run)
+        if not drift:
+            print("✅ Dashboard counters match the data")
+        for name, values in drift.items():
+            print(f"⚠️ {name}: stored {values['stored']}, actual {values['actual']}")
+        if drift and not args.dry_run:
+            print("🔧 Counters rebuilt")
+
+    if args.command == "rebuild-indexes":
+        result = rebuild_user_indexes()
+        print(f"🔧 Indexed {result['users']} users: {result['usernames']} usernames, "
+              f"{result['ngrams']} n-grams")
+        print(f"🔧 Indexed {rebuild_vip_expiry_index()} VIP expiries")
+
+    if args.command == "migrate-logs":
+        for path, per_user in LOG_TREES.items():
+            moved = migrate_logs(path, per_user, dry_run=args.dry_run)
+            print(f"{'📋' if args.dry_run else '🔧'} {path}: {moved} records "
+                  f"{'to move' if args.dry_run else 'moved'}")
+
+    if args.command == "reconcile-ledger":
+        report = reconcile_ledger(fix=args.fix)
+        print(f"📒 {report['users']} users, {report['payments']} approved payments checked")
+        for item in report["drift"][:20]:
+            print(f"⚠️ user {item['user_id']}: credits {item['credits']}, ledger {item['ledger']}")
+        for item in report["missing_payments"][:20]:
+            print(f"⚠️ payment {item['payment_id']} ({item['amount']} credits) has no ledger entry")
+        for path in report["pending_writes"][:20]:
+            print(f"{'🔧' if args.fix else '⚠️'} {path} has parked writes{' (applied)' if args.fix else ''}")
+        if report["fixed"]:
+            print(f"🔧 appended {report['fixed']} adjustment entries")
+        ok = not report["missing_payments"] and (args.fix or not report["drift"])
+        raise SystemExit(0 if ok else 1)
+
+    if args.command == "cleanup":
+        for name, removed in run_all_cleanup().items():
+            print(f"🔧 {name}: {removed} removed")
+
+    if args.command == "snapshot-ledgers":
+        print(f"🔧 {snapshot_ledgers()} snapshots written")
+
+    if args.command == "export":
+        if args.user:
+            manifest = export_user(args.directory, args.user)
+        else:
+            manifest = export_trees(args.directory)
+        for name, state in manifest["trees"].items():
+            print(f"📦 {name}: {state['records']} records in {len(state['parts'])} part(s)")
+
+    if args.command == "import":
+        for name, written in import_backup(args.directory, trees=args.trees).items():
+            print(f"🔧 {name}: {written} records restored")
+
+    if args.command == "backup":
+        entry, manifest = backup_chain(args.root, full=args.full)
+        records = sum(state["records"] for state in manifest["trees"].values())
+        print(f"📦 {entry['directory']}: {records} records"
+              + (f" changed since {entry['since']}" if entry["since"] else ""))
+
+    if args.command == "restore":
+        for item in restore_chain(args.root):
+            print(f"🔧 {item['directory']}: {sum(item['restored'].values())} records restored, "
+                  f"{sum(item['deleted'].values())} deleted")
+
+    if args.command == "verify":
+        report = verify(database.backend, args.copy_url)
+        if not report:
+            print("✅ The copy matches the source")
+        for name, diff in report.items():
+            print(f"⚠️ {name}: {diff['missing']} missing, {diff['extra']} extra, {diff['different']} different")
+            for item in diff["examples"]:
+                print("   " + json.dumps(item))
+        raise SystemExit(0 if not report else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+"""
+In-process metrics: latency histograms, counters and gauges for /stats and Prometheus
+"""
+
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NAMESPACE = "kspvpn"
+
+# Upper bounds (seconds) of the latency buckets; one more bucket catches the rest
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+DESCRIPTIONS = {
+    "handler_seconds": "Time to handle one update, by handler and branch",
+    "storage_seconds": "Time of one storage call, by operation and top-level path",
+    "telegram_seconds": "Time of one Bot API call, by method",
+    "errors_total": "Timed calls that raised, by metric and labels",
+    "mirror_reads_total": "Reads served from a live mirror instead of storage",
+}
+
+
+class Histogram:
+    """Bucketed latencies; quantiles are estimated within a bucket"""
+
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Estimated q-quantile (0..1) in seconds, interpolating inside the bucket"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = BUCKETS[index - 1] if index else 0.0
+                upper = BUCKETS[index] if index < len(BUCKETS) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.count, histogram.sum, histogram.max = self.count, self.sum, self.max
+        return histogram
+
+
+class Registry:
+    """Thread-safe store of histograms and counters, plus gauges read on demand
+
+    Series are keyed by name and labels. Recording is one dict lookup and a
+    few additions under a lock, cheap enough to leave on in production.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.enabled = True
+
+    # ========================
+    # RECORDING
+    # ========================
+    def observe(self, name, seconds, **labels):
+        """Add one latency (seconds) to the name histogram"""
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(labels.items()))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, read):
+        """Register read() as a gauge; it returns a number or {suffix: number}"""
+        self.gauges[name] = read
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Time the with-block into the name histogram (errors are counted too)"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc("errors_total", metric=name, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def timed(self, name, labeler=None, **labels):
+        """Decorator timing each call; labeler(*args, **kwargs) adds labels per call"""
+        def decorate(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                extra = labeler(*args, **kwargs) if labeler else {}
+                with self.timer(name, **labels, **extra):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    # ========================
+    # READING
+    # ========================
+    def snapshot(self):
+        """(histograms, counters, gauges) copied at one instant"""
+        with self.lock:
+            histograms = {key: histogram.copy() for key, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                value = read()
+            except Exception:
+                continue
+            if isinstance(value, dict):
+                for suffix, number in value.items():
+                    if isinstance(number, (int, float)) and not isinstance(number, bool):
+                        gauges[f"{name}_{suffix}"] = number
+            elif value is not None:
+                gauges[name] = value
+
+        return histograms, counters, gauges
+
+    def render_prometheus(self):
+        """Everything in the Prometheus text exposition format"""
+        histograms, counters, gauges = self.snapshot()
+        lines = []
+
+        for name in sorted({name for name, _ in histograms}):
+            _header(lines, name, "histogram")
+            for (series, labels), histogram in sorted(histograms.items()):
+                if series != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{NAMESPACE}_{name}_bucket{_labels(labels + (('le', str(bound)),))} {cumulative}")
+                lines.append(f"{NAMESPACE}_{name}_sum{_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{NAMESPACE}_{name}_count{_labels(labels)} {histogram.count}")
+
+        for name in sorted({name for name, _ in counters}):
+            _header(lines, name, "counter")
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f"{NAMESPACE}_{name}{_labels(labels)} {value}")
+
+        for name, value in sorted(gauges.items()):
+            _header(lines, name, "gauge")
+            lines.append(f"{NAMESPACE}_{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def report(self, limit=12):
+        """Plain-text summary: slowest series of each histogram (p95 first), then gauges"""
+        histograms, counters, gauges = self.snapshot()
+        sections = []
+
+        for name in sorted({name for name, _ in histograms}):
+            rows = sorted(
+                ((labels, histogram) for (series, labels), histogram in histograms.items() if series == name),
+                key=lambda row: row[1].quantile(0.95), reverse=True
+            )
+            lines = [f"{name} (n, p50/p95/p99 ms)"]
+            for labels, histogram in rows[:limit]:
+                label = " ".join(str(value) for _, value in labels if value not in ("", None)) or "-"
+                lines.append(f"  {label[:32]:<32} {histogram.count:>6} "
+                             f"{histogram.quantile(0.5) * 1000:>6.1f}/{histogram.quantile(0.95) * 1000:.1f}/"
+                             f"{histogram.quantile(0.99) * 1000:.1f}")
+            if len(rows) > limit:
+                lines.append(f"  ... {len(rows) - limit} more")
+            sections.append("\n".join(lines))
+
+        errors = {labels: value for (name, labels), value in counters.items() if name == "errors_total"}
+        if errors:
+            sections.append("errors\n" + "\n".join(
+                f"  {' '.join(str(value) for _, value in labels if value not in ('', None))[:34]:<34} {count:>6}"
+                for labels, count in sorted(errors.items(), key=lambda item: -item[1])[:limit]
+            ))
+
+        if gauges:
+            sections.append("gauges\n" + "\n".join(
+                f"  {name[:34]:<34} {_number(value):>10}" for name, value in sorted(gauges.items())
+            ))
+
+        return "\n\n".join(sections) or "no metrics recorded yet"
+
+
+def _header(lines, name, kind):
+    if name in DESCRIPTIONS:
+        lines.append(f"# HELP {NAMESPACE}_{name} {DESCRIPTIONS[name]}")
+    lines.append(f"# TYPE {NAMESPACE}_{name} {kind}")
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+def _number(value):
+    return f"{value:.3f}" if isinstance(value, float) else str(value)
+
+
+# Process-wide registry; modules record into it through these
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+gauge = registry.gauge
+timer = registry.timer
+timed = registry.timed
+
+
+# ========================
+# PROMETHEUS ENDPOINT
+# ========================
+class MetricsServer:
+    """Serves GET /metrics in the Prometheus text format"""
+
+    def __init__(self, host="127.0.0.1", port=9108, source=registry):
+        self.source = source
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="metrics-http", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = server.source.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
@@ -0,0 +1,151 @@
+"""
+Live in-memory mirror of a Firebase RTDB path via the REST streaming (SSE) API
+"""
+
+import copy
+import json
+import logging
+import random
+import threading
+import time
+from urllib.parse import quote
+
+from rtdb_tree import join_path, tree_get, tree_set
+
+logger = logging.getLogger(__name__)
+
+
+class TreeMirror:
+    """Background subscriber that keeps a local copy of one path up to date
+
+    Firebase sends a keep-alive event every 30 seconds, so the mirror counts
+    as fresh while it is connected and has heard from the server within
+    stale_after seconds.
+    """
+
+    def __init__(self, session, base_url, path, stale_after=60, read_timeout=90):
+        self.session = session
+        self.base_url = base_url
+        self.path = path.strip("/")
+        self.stale_after = stale_after
+        self.read_timeout = read_timeout
+
+        self.data = None
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.connected = False
+        self.last_event = 0.0
+        self.stats = {"events": 0, "reconnects": 0}
+
+        self.stopping = threading.Event()
+        self.thread = None
+        self.response = None
+
+    # ========================
+    # READS
+    # ========================
+    def fresh(self):
+        """True when reads can be served from the mirror"""
+        return (
+            self.loaded and self.connected
+            and time.monotonic() - self.last_event < self.stale_after
+        )
+
+    def get(self, subpath=""):
+        """Copy of the mirrored value at subpath (None if missing, as Firebase has no empty nodes)"""
+        with self.lock:
+            value = tree_get(self.data, subpath)
+            return copy.deepcopy(value) if value != {} else None
+
+    def wait_until_fresh(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.fresh():
+                return True
+            time.sleep(0.01)
+        return False
+
+    # ========================
+    # STREAM HANDLING
+    # ========================
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f"mirror-{self.path}", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.connected = False
+        if self.response is not None:
+            self.response.close()
+
+    def apply(self, event, payload):
+        """Apply one put/patch event to the local copy"""
+        path = payload.get("path", "/")
+        data = payload.get("data")
+
+        with self.lock:
+            if event == "put":
+                self.data = tree_set(self.data, path, data)
+            elif event == "patch":
+                for key, value in (data or {}).items():
+                    self.data = tree_set(self.data, join_path(path, key), value)
+
+    def _run(self):
+        attempt = 0
+
+        while not self.stopping.is_set():
+            try:
+                self._listen()
+                attempt = 0
+            except Exception as e:
+                if not self.stopping.is_set():
+                    logger.warning("Mirror %s disconnected: %s", self.path, e)
+            finally:
+                self.connected = False
+
+            if self.stopping.is_set():
+                break
+
+            self.stats["reconnects"] += 1
+            self.stopping.wait(random.uniform(0, min(30, 0.5 * (2 ** attempt))))
+            attempt += 1
+
+    def _listen(self):
+        url = f"{self.base_url}/{quote(self.path, safe='/')}.json"
+        self.response = self.session.get(
+            url,
+            headers={"Accept": "text/event-stream"},
+            stream=True,
+            timeout=(5, self.read_timeout)
+        )
+
+        with self.response:
+            self.response.raise_for_status()
+            self.response.encoding = "utf-8"
+            self.connected = True
+            event = None
+
+            # chunk_size=None hands over each chunk as soon as it arrives
+            for line in self.response.iter_lines(chunk_size=None, decode_unicode=True):
+                if self.stopping.is_set():
+                    return
+
+                if line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:"):
+                    self._dispatch(event, line[5:].strip())
+                    event = None
+
+    def _dispatch(self, event, data):
+        self.last_event = time.monotonic()
+        self.stats["events"] += 1
+
+        if event in ("put", "patch"):
+            self.apply(event, json.loads(data))
+            if event == "put" and not self.loaded:
+                self.loaded = True
+        elif event in ("cancel", "auth_revoked"):
+            # Server closed the subscription; reconnect from scratch
+            self.loaded = False
+            raise ConnectionError(f"stream {event}: {data}")
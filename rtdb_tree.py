@@ -0,0 +1,183 @@
+"""
+In-memory Firebase RTDB tree helpers (shared by the live mirror, the fake server and the storage backends)
+"""
+
+import hashlib
+import json
+import re
+import time
+
+
+# ========================
+# PATHS
+# ========================
+def split_path(path):
+    return [part for part in path.strip("/").split("/") if part]
+
+
+def join_path(*parts):
+    return "/".join(part.strip("/") for part in parts if part and part.strip("/"))
+
+
+def relative_path(path, base):
+    """path relative to base ("/"-prefixed), or None if path is not below base"""
+    path_parts, base_parts = split_path(path), split_path(base)
+    if path_parts[:len(base_parts)] != base_parts:
+        return None
+    return "/" + "/".join(path_parts[len(base_parts):])
+
+
+# ========================
+# READ / WRITE
+# ========================
+def tree_get(root, path):
+    """Return node at path (None if missing)"""
+    node = root
+    for part in split_path(path):
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+
+def tree_set(root, path, value):
+    """Set node at path, pruning empty parents on delete. Returns new root"""
+    parts = split_path(path)
+
+    if not parts:
+        return value if value not in (None, {}) else {}
+
+    if not isinstance(root, dict):
+        root = {}
+
+    parents = [root]
+    node = root
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            if value is None:
+                return root
+            child = node[part] = {}
+        node = child
+        parents.append(node)
+
+    if value is None or value == {}:
+        node.pop(parts[-1], None)
+        # Remove parents left empty by the delete
+        for depth in range(len(parts) - 1, 0, -1):
+            if parents[depth]:
+                break
+            parents[depth - 1].pop(parts[depth - 1], None)
+    else:
+        node[parts[-1]] = value
+
+    return root
+
+
+def etag(value):
+    """ETag of a node value (Firebase uses "null_etag" for missing nodes)"""
+    if value is None:
+        return "null_etag"
+    return hashlib.sha1(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+def prune(value):
+    """value without null or empty children (Firebase never stores them)"""
+    if not isinstance(value, dict):
+        return value
+    children = ((key, prune(child)) for key, child in value.items())
+    return {key: child for key, child in children if child is not None and child != {}}
+
+
+def has_server_values(value):
+    """True if value holds any {".sv": ...} placeholder"""
+    return isinstance(value, dict) and (".sv" in value or any(map(has_server_values, value.values())))
+
+
+def resolve_server_values(current, value):
+    """Replace {".sv": ...} placeholders (increment, timestamp) with real values"""
+    if not isinstance(value, dict):
+        return value
+
+    server_value = value.get(".sv")
+    if server_value == "timestamp":
+        return int(time.time() * 1000)
+    if isinstance(server_value, dict) and "increment" in server_value:
+        base = current if isinstance(current, (int, float)) and not isinstance(current, bool) else 0
+        return base + server_value["increment"]
+
+    current = current if isinstance(current, dict) else {}
+    return {key: resolve_server_values(current.get(key), child) for key, child in value.items()}
+
+
+# ========================
+# QUERIES
+# ========================
+def order_value(key, value, order_by):
+    """Value a child is ordered by ("$key", "$value" or a child path)"""
+    if order_by == "$key":
+        return key
+    if order_by == "$value":
+        return value
+    for part in order_by.split("/"):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def rank(value):
+    """Firebase ordering: null < false < true < numbers < strings < objects"""
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (1, int(value))
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    return (4, 0)
+
+
+INTEGER_KEY = re.compile(r"-?(0|[1-9][0-9]*)")
+
+
+def key_rank(key):
+    """Firebase key ordering: 32-bit integer keys first (numerically), then strings"""
+    key = str(key)
+    if INTEGER_KEY.fullmatch(key) and -2 ** 31 <= int(key) < 2 ** 31:
+        return (0, int(key), "")
+    return (1, 0, key)
+
+
+def sort_key(key, value, order_by):
+    """Sort key for a child in query order (ties broken by key)"""
+    if order_by == "$key":
+        return key_rank(key)
+    return rank(order_value(key, value, order_by)), key_rank(key)
+
+
+def query_node(node, order_by="$key", equal_to=None, start_at=None, end_at=None,
+               limit_to_first=None, limit_to_last=None):
+    """Evaluate a Firebase query on the children of node, in query order"""
+    if not isinstance(node, dict):
+        return {}
+
+    position = key_rank if order_by == "$key" else rank
+
+    items = []
+    for key, value in node.items():
+        value_rank = position(order_value(key, value, order_by))
+        if equal_to is not None and value_rank != position(equal_to):
+            continue
+        if start_at is not None and value_rank < position(start_at):
+            continue
+        if end_at is not None and value_rank > position(end_at):
+            continue
+        items.append((value_rank, key_rank(key), key, value))
+
+    items.sort(key=lambda item: item[:2])
+    if limit_to_first is not None:
+        items = items[:limit_to_first]
+    if limit_to_last is not None:
+        items = items[max(0, len(items) - limit_to_last):] if limit_to_last else []
+
+    return {key: value for _, _, key, value in items}
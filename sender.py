@@ -0,0 +1,284 @@
+"""
+Rate-limited outbound queue for Telegram sends
+
+Telegram allows about 30 messages per second overall and 1 per second to
+any one chat; past that it answers 429 "retry after N". Handlers enqueue
+sends here and return at once, and a scheduler thread releases them no
+faster than those limits, highest priority lane first.
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, served in this order
+ADMIN, USER, BULK = 0, 1, 2
+
+# Admin messages queued behind each other are merged up to Telegram's text limit
+MAX_TEXT = 4096
+COALESCE_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+MAX_RETRIES = 5
+
+
+class TokenBucket:
+    """Allows rate events per second, with bursts of up to capacity"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 if one is)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return max(self.updated - now, 0) + (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, now, seconds):
+        """Hold the bucket empty for seconds (after a 429 retry_after)"""
+        self.tokens = 0
+        self.updated = max(self.updated, now + seconds)
+
+    def full(self, now):
+        self._refill(now)
+        return now >= self.updated and self.tokens >= self.capacity
+
+
+class _Message:
+    __slots__ = ("method", "chat_id", "kwargs", "priority", "future", "queued_at", "count", "retries", "trace")
+
+    def __init__(self, method, chat_id, kwargs, priority):
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.queued_at = time.monotonic()
+        self.count = 1
+        self.retries = 0
+        # Keeps the queueing update's trace open until this is sent
+        self.trace = tracing.detach()
+
+    def coalescable(self):
+        return self.method == "send_message" and frozenset(self.kwargs) <= {"chat_id", "text", "parse_mode"}
+
+
+class SendScheduler:
+    """Queues bot sends and releases them within Telegram's flood limits
+
+    bot is anything with send_message/send_photo/... methods (a
+    telegram.Bot). Every enqueue returns a Future for the API result.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, admin_chat=None, workers=8):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.admin_chat = str(admin_chat) if admin_chat is not None else None
+
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_buckets = {}
+        self.lanes = [OrderedDict() for _ in (ADMIN, USER, BULK)]
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.in_flight = 0
+        self.stats = {"queued": 0, "sent": 0, "coalesced": 0, "retried": 0, "failed": 0}
+
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sender")
+        self.thread = None
+        self.running = True
+        self.last_prune = time.monotonic()
+
+    # ========================
+    # PUBLIC API
+    # ========================
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="send-scheduler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=10):
+        """Send what is queued (up to timeout), then stop"""
+        self.flush(timeout)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.pool.shutdown(wait=True)
+
+    def flush(self, timeout=None):
+        """Wait until everything queued has been sent; False on timeout"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending or self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def send(self, method, chat_id, priority=None, **kwargs):
+        """Queue a bot API call; returns a Future for its result"""
+        if priority is None:
+            priority = ADMIN if str(chat_id) == self.admin_chat else USER
+        message = _Message(method, chat_id, {"chat_id": chat_id, **kwargs}, priority)
+
+        with self.condition:
+            self.stats["queued"] += 1
+            merged = self._coalesce(message)
+            if merged is not None:
+                tracing.release(message.trace)
+                return merged.future
+
+            self.lanes[priority].setdefault(chat_id, deque()).append(message)
+            self.pending += 1
+            self.condition.notify()
+
+        return message.future
+
+    def send_message(self, chat_id, text, priority=None, **kwargs):
+        return self.send("send_message", chat_id, priority, text=text, **kwargs)
+
+    def send_photo(self, chat_id, photo, priority=None, **kwargs):
+        return self.send("send_photo", chat_id, priority, photo=photo, **kwargs)
+
+    def metrics(self):
+        with self.condition:
+            return {**self.stats, "pending": self.pending, "in_flight": self.in_flight,
+                    "chats": len(self.chat_buckets)}
+
+    # ========================
+    # SCHEDULING
+    # ========================
+    def _coalesce(self, message):
+        """Merge an admin text into the admin's last queued text (lock held)"""
+        if str(message.chat_id) != self.admin_chat or not message.coalescable():
+            return None
+
+        queued = self.lanes[message.priority].get(message.chat_id)
+        if not queued:
+            return None
+
+        last = queued[-1]
+        if not last.coalescable() or last.kwargs.get("parse_mode") != message.kwargs.get("parse_mode"):
+            return None
+        text = last.kwargs["text"] + COALESCE_SEPARATOR + message.kwargs["text"]
+        # Telegram measures text length in UTF-16 code units
+        if len(text.encode("utf-16-le")) // 2 > MAX_TEXT:
+            return None
+
+        last.kwargs["text"] = text
+        last.count += 1
+        self.stats["coalesced"] += 1
+        return last
+
+    def _next(self, now):
+        """Pop the next message allowed out now, or return how long to wait (lock held)"""
+        wait = self.global_bucket.delay(now)
+        if wait > 0:
+            return None, wait
+
+        wait = None
+        for lane in self.lanes:
+            for chat_id, queued in lane.items():
+                bucket = self.chat_buckets.get(chat_id)
+                delay = bucket.delay(now) if bucket is not None else 0
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    continue
+
+                message = queued.popleft()
+                if queued:
+                    lane.move_to_end(chat_id)
+                else:
+                    del lane[chat_id]
+
+                if bucket is None:
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+                bucket.take(now)
+                self.global_bucket.take(now)
+                return message, 0
+
+        return None, wait
+
+    def _prune(self, now):
+        """Forget buckets of chats that have been idle long enough to be full (lock held)"""
+        if now - self.last_prune < 60:
+            return
+        self.last_prune = now
+        self.chat_buckets = {chat_id: bucket for chat_id, bucket in self.chat_buckets.items()
+                             if not bucket.full(now)}
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if not self.running:
+                        return
+                    now = time.monotonic()
+                    message, wait = self._next(now)
+                    if message is not None:
+                        self.pending -= 1
+                        self.in_flight += 1
+                        break
+                    self._prune(now)
+                    self.condition.wait(wait)
+
+            self.pool.submit(self._send, message)
+
+    def _send(self, message):
+        try:
+            with tracing.resume(message.trace, "outbox", message.method, attempt=message.retries + 1):
+                result = getattr(self.bot, message.method)(**message.kwargs)
+        except Exception as e:
+            retry_after = getattr(e, "retry_after", None)
+            requeue = retry_after is not None and message.retries < MAX_RETRIES
+            with self.condition:
+                self.in_flight -= 1
+                if requeue:
+                    # Flood limit hit anyway: hold this chat and every send for retry_after
+                    # (a 429 may come from the global limit), and put the message back in front
+                    message.retries += 1
+                    self.stats["retried"] += 1
+                    now = time.monotonic()
+                    bucket = self.chat_buckets.setdefault(message.chat_id, TokenBucket(self.chat_rate))
+                    bucket.pause(now, retry_after)
+                    self.global_bucket.pause(now, retry_after)
+                    lane = self.lanes[message.priority]
+                    lane.setdefault(message.chat_id, deque()).appendleft(message)
+                    self.pending += 1
+                else:
+                    self.stats["failed"] += message.count
+                self.condition.notify_all()
+
+            if not requeue:
+                # Bulk senders (broadcasts) count their own failures
+                level = logging.DEBUG if message.priority == BULK else logging.WARNING
+                logger.log(level, "Send %s to %s failed: %s", message.method, message.chat_id, e)
+                tracing.release(message.trace)
+                message.future.set_exception(e)
+            return
+
+        with self.condition:
+            self.in_flight -= 1
+            self.stats["sent"] += message.count
+            self.condition.notify_all()
+        tracing.release(message.trace)
+        message.future.set_result(result)
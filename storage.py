@@ -0,0 +1,431 @@
+"""
+Storage backends behind the database helpers
+
+database.py reads and writes Firebase-style paths ("users/123/credits")
+through one Backend. FirebaseBackend (in database.py) talks to the RTDB
+REST API; MemoryBackend keeps the tree in a dict and SQLiteBackend in a
+local SQLite file with real indexes, so the bot, the admin tools and the
+benchmarks can run offline at local-database speed.
+"""
+
+import copy
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from rtdb_tree import (
+    etag, has_server_values, join_path, key_rank, prune, query_node, resolve_server_values, split_path, tree_get,
+    tree_set
+)
+
+
+class PreconditionFailed(Exception):
+    """A conditional write lost: the value changed since it was read"""
+
+    def __init__(self, value, etag):
+        super().__init__("precondition failed")
+        self.value = value
+        self.etag = etag
+
+
+def shallow_node(node):
+    """Firebase shallow read of node: objects below it become True"""
+    if not isinstance(node, dict):
+        return node
+    return {key: True if isinstance(value, dict) else value for key, value in node.items()}
+
+
+# ========================
+# INTERFACE
+# ========================
+class Backend:
+    """Path-addressed JSON tree with Firebase RTDB semantics
+
+    Writes accept {".sv": ...} server values. update writes every key of
+    data (a child path) atomically, so a WriteBatch is one update at the
+    root. query returns the matching children; callers sort them.
+    """
+
+    def get(self, path, shallow=False):
+        raise NotImplementedError
+
+    def set(self, path, value):
+        raise NotImplementedError
+
+    def update(self, path, data):
+        raise NotImplementedError
+
+    def delete(self, path):
+        self.set(path, None)
+
+    def query(self, path, order_by="$key", equal_to=None, start_at=None, end_at=None,
+              limit_to_first=None, limit_to_last=None):
+        return query_node(self.get(path), order_by, equal_to, start_at, end_at, limit_to_first, limit_to_last)
+
+    def read_versioned(self, path):
+        """(value, etag) of path, for a following write_if"""
+        raise NotImplementedError
+
+    def write_if(self, path, value, expected_etag):
+        """Write value if path still has expected_etag, else raise PreconditionFailed"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+# ========================
+# IN-MEMORY
+# ========================
+class MemoryBackend(Backend):
+    """Whole tree in one dict (tests, benchmarks, throwaway runs)"""
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.lock = threading.RLock()
+
+    def get(self, path, shallow=False):
+        with self.lock:
+            node = tree_get(self.data, path)
+            return shallow_node(node) if shallow else copy.deepcopy(node)
+
+    def set(self, path, value):
+        with self.lock:
+            self._write(path, value)
+
+    def update(self, path, data):
+        with self.lock:
+            for key, value in data.items():
+                self._write(join_path(path, key), value)
+
+    def query(self, path, order_by="$key", equal_to=None, start_at=None, end_at=None,
+              limit_to_first=None, limit_to_last=None):
+        with self.lock:
+            return copy.deepcopy(query_node(
+                tree_get(self.data, path),
+                order_by, equal_to, start_at, end_at, limit_to_first, limit_to_last
+            ))
+
+    def read_versioned(self, path):
+        with self.lock:
+            node = tree_get(self.data, path)
+            return copy.deepcopy(node), etag(node)
+
+    def write_if(self, path, value, expected_etag):
+        with self.lock:
+            node = tree_get(self.data, path)
+            if etag(node) != expected_etag:
+                raise PreconditionFailed(copy.deepcopy(node), etag(node))
+            self._write(path, value)
+
+    def _write(self, path, value):
+        value = prune(resolve_server_values(tree_get(self.data, path), copy.deepcopy(value)))
+        self.data = tree_set(self.data, path, value)
+
+
+# ========================
+# SQLITE
+# ========================
+# Depth of the rows each tree is stored as: 1 (the default) keeps one row
+# per child (users/{uid}), 2 one per grandchild (ledger/{uid}/{txid}) and
+# 0 the whole tree in one row. Queries on the parent of the rows run in SQL.
+RECORD_DEPTHS = {
+    "user_payments": 2,
+    "user_tokens": 2,
+    "ledger": 2,
+    "ledger_snapshots": 2,
+    "search_index": 2,
+    "admin_logs": 2,
+    "user_activity": 2,
+    "notifications": 2,
+    "user_activity_days": 2,
+    "notifications_days": 2,
+    "stats": 0,
+}
+
+# Child fields with an index (the .indexOn fields of database.rules.json)
+INDEXED_FIELDS = ("status", "status_key", "user_id", "created", "updated", "ref")
+
+# Separates the keys of a parent path; Firebase keys can't hold control
+# characters, so every path below "a" sorts between "a" SEP and "a" END
+SEP, END = "\x1f", "\x20"
+
+
+def key_order(key):
+    """Text that sorts like key_rank (32-bit integer keys first, numerically)"""
+    kind, number, text = key_rank(key)
+    return f"0{number + 2 ** 31:010d}" if kind == 0 else f"1{text}"
+
+
+def field_sql(order_by):
+    """SQL expression for the child field a query orders by"""
+    if order_by == "$value":
+        return "json_extract(value, '$')"
+    parts = order_by.split("/")
+    if any('"' in part or "'" in part for part in parts):
+        raise ValueError(f"Unsupported order_by: {order_by}")
+    return "json_extract(value, '$." + ".".join(f'"{part}"' for part in parts) + "')"
+
+
+class SQLiteBackend(Backend):
+    """Tree stored as JSON rows in SQLite, with real indexes for queries
+
+    Each row is one record (see RECORD_DEPTHS) keyed by its parent path and
+    key. Queries on the children of a parent path filter, order and limit
+    in SQL; ordering by INDEXED_FIELDS or $key uses an index. Values of one
+    field are expected to share a type (booleans order as 0/1).
+    """
+
+    def __init__(self, path=":memory:", indexed_fields=INDEXED_FIELDS):
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        if path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            "parent TEXT NOT NULL, key TEXT NOT NULL, ord TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (parent, key))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS nodes_ord ON nodes (parent, ord)")
+        for field in indexed_fields:
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS nodes_{field} ON nodes (parent, {field_sql(field)}, ord)")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    # ========================
+    # PUBLIC API
+    # ========================
+    def get(self, path, shallow=False):
+        with self._reading():
+            parts = split_path(path)
+            if shallow:
+                return self._shallow(parts)
+            return self._get(parts)
+
+    def set(self, path, value):
+        with self._writing():
+            self._set(split_path(path), value)
+
+    def update(self, path, data):
+        with self._writing():
+            for key, value in data.items():
+                self._set(split_path(join_path(path, key)), value)
+
+    def read_versioned(self, path):
+        with self._reading():
+            value = self._get(split_path(path))
+            return value, etag(value)
+
+    def write_if(self, path, value, expected_etag):
+        parts = split_path(path)
+        with self._writing():
+            current = self._get(parts)
+            if etag(current) != expected_etag:
+                raise PreconditionFailed(current, etag(current))
+            self._set(parts, value)
+
+    def query(self, path, order_by="$key", equal_to=None, start_at=None, end_at=None,
+              limit_to_first=None, limit_to_last=None):
+        parts = split_path(path)
+        if not parts or len(parts) != self._length(parts) - 1:
+            return super().query(path, order_by, equal_to, start_at, end_at, limit_to_first, limit_to_last)
+
+        column = "ord" if order_by == "$key" else field_sql(order_by)
+        if order_by == "$key":
+            equal_to, start_at, end_at = (
+                None if value is None else key_order(str(value)) for value in (equal_to, start_at, end_at)
+            )
+
+        where, params = ["parent = ?"], [SEP.join(parts)]
+        if equal_to is not None:
+            where.append(f"{column} = ?")
+            params.append(equal_to)
+        if start_at is not None:
+            where.append(f"{column} >= ?")
+            params.append(start_at)
+
+        select = f"SELECT key, value, {column} AS field, ord FROM nodes WHERE "
+        if end_at is not None and start_at is None and equal_to is None and column != "ord":
+            # Missing fields order first (null), so they fall below any end;
+            # a union keeps both halves on the index
+            sql = (f"{select}{' AND '.join(where)} AND {column} IS NULL UNION ALL "
+                   f"{select}{' AND '.join(where)} AND {column} <= ?")
+            params += params + [end_at]
+        else:
+            if end_at is not None:
+                where.append(f"{column} <= ?")
+                params.append(end_at)
+            sql = select + " AND ".join(where)
+
+        if limit_to_first is not None:
+            sql += f" ORDER BY field, ord LIMIT {int(limit_to_first)}"
+        elif limit_to_last is not None:
+            sql += f" ORDER BY field DESC, ord DESC LIMIT {int(limit_to_last)}"
+
+        with self._reading():
+            rows = self.db.execute(sql, params).fetchall()
+        if limit_to_first is None and limit_to_last is not None:
+            rows.reverse()
+        if limit_to_first is not None and limit_to_last is not None:
+            rows = rows[max(0, len(rows) - limit_to_last):] if limit_to_last else []
+        return {key: json.loads(value) for key, value, _, _ in rows}
+
+    # ========================
+    # ROWS
+    # ========================
+    @contextmanager
+    def _reading(self):
+        with self.lock:
+            if self.db.in_transaction:
+                yield
+                return
+            self.db.execute("BEGIN")
+            try:
+                yield
+            finally:
+                self.db.execute("COMMIT")
+
+    @contextmanager
+    def _writing(self):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    @staticmethod
+    def _length(parts):
+        """Number of path parts of a record in the tree parts belongs to"""
+        return RECORD_DEPTHS.get(parts[0], 1) + 1
+
+    def _row(self, parts):
+        row = self.db.execute(
+            "SELECT value FROM nodes WHERE parent = ? AND key = ?", (SEP.join(parts[:-1]), parts[-1])
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _rows_below(self, parts):
+        """(parent, key, value) of every row strictly below parts"""
+        if not parts:
+            return self.db.execute("SELECT parent, key, value FROM nodes")
+        parent = SEP.join(parts)
+        return self.db.execute(
+            "SELECT parent, key, value FROM nodes WHERE parent = ? OR (parent >= ? AND parent < ?)",
+            (parent, parent + SEP, parent + END)
+        )
+
+    def _get(self, parts):
+        if not parts:
+            return self._assemble(parts)
+
+        # The record holding parts, or a plain value written higher up
+        length = self._length(parts)
+        for depth in range(min(len(parts), length), 0, -1):
+            value = self._row(parts[:depth])
+            if value is not None:
+                return tree_get(value, "/".join(parts[depth:]))
+
+        return self._assemble(parts) if len(parts) < length else None
+
+    def _assemble(self, parts):
+        node = None
+        for parent, key, value in self._rows_below(parts):
+            below = (parent.split(SEP) if parent else []) + [key]
+            node = tree_set(node, "/".join(below[len(parts):]), json.loads(value))
+        return node
+
+    def _shallow(self, parts):
+        if parts:
+            # Inside a record, or a plain value written at or above parts
+            length = self._length(parts)
+            for depth in range(min(len(parts), length), 0, -1):
+                value = self._row(parts[:depth])
+                if value is not None:
+                    return shallow_node(tree_get(value, "/".join(parts[depth:])))
+            if len(parts) >= length:
+                return None
+
+        parent = SEP.join(parts)
+        node = {
+            key: json.loads(value) for key, value in self.db.execute(
+                "SELECT key, CASE WHEN json_type(value) = 'object' THEN 'true' ELSE value END "
+                "FROM nodes WHERE parent = ?", (parent,)
+            )
+        }
+
+        # Keys with rows further down: one index probe per key, skipping its rows
+        low, high = (parent + SEP, parent + END) if parts else (SEP, None)
+        while True:
+            sql, params = "SELECT parent FROM nodes WHERE parent >= ?", [low]
+            if high is not None:
+                sql += " AND parent < ?"
+                params.append(high)
+            row = self.db.execute(sql + " ORDER BY parent LIMIT 1", params).fetchone()
+            if row is None:
+                break
+            child = row[0].split(SEP)[len(parts)]
+            node[child] = True
+            low = SEP.join(parts + [child]) + END
+
+        return node or None
+
+    def _set(self, parts, value):
+        if has_server_values(value):
+            value = resolve_server_values(self._get(parts), value)
+        value = prune(value)
+
+        if not parts:
+            if value is not None and not isinstance(value, dict):
+                raise ValueError("The root can only hold an object")
+            self.db.execute("DELETE FROM nodes")
+            for key, child in (value or {}).items():
+                self._insert([key], child)
+            return
+
+        # A plain value written higher up is replaced by anything below it
+        length = self._length(parts)
+        if value is not None:
+            for depth in range(1, min(len(parts), length)):
+                self._delete_row(parts[:depth])
+
+        if len(parts) > length:
+            record = parts[:length]
+            current = self._row(record)
+            if value is None and not isinstance(current, dict):
+                return
+            value = tree_set(current, "/".join(parts[length:]), value)
+            parts = record
+        elif len(parts) < length:
+            parent = SEP.join(parts)
+            self.db.execute(
+                "DELETE FROM nodes WHERE parent = ? OR (parent >= ? AND parent < ?)",
+                (parent, parent + SEP, parent + END)
+            )
+
+        self._delete_row(parts)
+        self._insert(parts, value)
+
+    def _delete_row(self, parts):
+        self.db.execute("DELETE FROM nodes WHERE parent = ? AND key = ?", (SEP.join(parts[:-1]), parts[-1]))
+
+    def _insert(self, parts, value):
+        if value is None or value == {}:
+            return
+        if isinstance(value, dict) and len(parts) < self._length(parts):
+            for key, child in value.items():
+                self._insert(parts + [key], child)
+            return
+        self.db.execute(
+            "INSERT INTO nodes (parent, key, ord, value) VALUES (?, ?, ?, ?)",
+            (SEP.join(parts[:-1]), parts[-1], key_order(parts[-1]),
+             json.dumps(value, ensure_ascii=False, separators=(",", ":")))
+        )
@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+"""
+Request-scoped tracing: one trace per update, spans for storage and Bot API calls
+
+A handler opens a trace; storage primitives and Bot API calls made while
+it runs add spans with their timing and payload size. Sends queued on the
+outbox stay linked to the trace, so it is finished only once they went
+out. Traces slower than slow_ms (or that raised) are appended to a JSON
+lines file; run this module to summarize that file.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+settings = {"path": None, "slow_ms": 1000, "sample": 1.0, "max_spans": 200}
+
+_local = threading.local()
+_write_lock = threading.Lock()
+
+
+def configure(path, slow_ms=1000, sample=1.0, max_spans=200):
+    """Write traces slower than slow_ms to path (a sample fraction of them); None turns tracing off"""
+    settings.update(path=path, slow_ms=slow_ms, sample=sample, max_spans=max_spans)
+
+
+def payload_size(value):
+    """Bytes of value as JSON (None if it doesn't serialize)"""
+    if value is None:
+        return 0
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    try:
+        return len(json.dumps(value, separators=(",", ":"), default=str))
+    except (TypeError, ValueError):
+        return None
+
+
+class Trace:
+    __slots__ = ("trace_id", "name", "attrs", "started_at", "start", "duration", "spans", "dropped",
+                 "pending", "error", "lock")
+
+    def __init__(self, name, attrs):
+        self.trace_id = os.urandom(8).hex()
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.dropped = 0
+        self.pending = 1
+        self.error = None
+        self.lock = threading.Lock()
+
+    def offset_ms(self, now=None):
+        return round(((now or time.perf_counter()) - self.start) * 1000, 3)
+
+
+class Span:
+    """Handle on an open span for adding payload sizes and notes"""
+
+    __slots__ = ("record",)
+
+    def __init__(self, record):
+        self.record = record
+
+    def sent(self, value):
+        self._size("sent_bytes", value)
+        return value
+
+    def received(self, value):
+        self._size("received_bytes", value)
+        return value
+
+    def _size(self, key, value):
+        if value is None or isinstance(value, (str, bytes)):
+            self.record[key] = payload_size(value)
+        else:
+            # Serialized only if the trace is written (see _finish); most are discarded
+            self.record.setdefault("payloads", {})[key] = value
+
+    def note(self, **attrs):
+        self.record.update(attrs)
+
+
+class _NullSpan:
+    """Stand-in outside a trace: records nothing, serializes nothing"""
+
+    def sent(self, value):
+        return value
+
+    def received(self, value):
+        return value
+
+    def note(self, **attrs):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+def current():
+    """The trace the calling thread is working on, or None"""
+    return getattr(_local, "trace", None)
+
+
+# ========================
+# RECORDING
+# ========================
+@contextmanager
+def trace(name, **attrs):
+    """Trace the with-block (one update); nested calls join the outer trace"""
+    if settings["path"] is None or current() is not None:
+        yield current()
+        return
+
+    active = Trace(name, attrs)
+    _local.trace, _local.stack = active, []
+    try:
+        yield active
+    except Exception as e:
+        active.error = repr(e)[:200]
+        raise
+    finally:
+        active.duration = time.perf_counter() - active.start
+        _local.trace, _local.stack = None, []
+        _release(active)
+
+
+@contextmanager
+def span(kind, name, **attrs):
+    """Time the with-block as a span of the current trace (no-op outside one)"""
+    active = current()
+    if active is None:
+        yield NULL_SPAN
+        return
+
+    stack = _local.stack
+    record = {"kind": kind, "name": name, "parent": stack[-1] if stack else 0,
+              "start_ms": active.offset_ms(), **attrs}
+    with active.lock:
+        record["id"] = len(active.spans) + active.dropped + 1
+        if len(active.spans) < settings["max_spans"]:
+            active.spans.append(record)
+        else:
+            active.dropped += 1
+
+    stack.append(record["id"])
+    start = time.perf_counter()
+    try:
+        yield Span(record)
+    except Exception as e:
+        record["error"] = type(e).__name__
+        raise
+    finally:
+        record["ms"] = round((time.perf_counter() - start) * 1000, 3)
+        stack.pop()
+
+
+def detach():
+    """Link for work the current trace hands to another thread (None outside a trace)
+
+    The trace is written only after every link is released.
+    """
+    active = current()
+    if active is None:
+        return None
+    with active.lock:
+        active.pending += 1
+    stack = _local.stack
+    return active, stack[-1] if stack else 0, time.perf_counter()
+
+
+@contextmanager
+def resume(link, kind, name, **attrs):
+    """Continue a detached trace on this thread inside one span; wait_ms is the time since detach"""
+    if link is None:
+        yield NULL_SPAN
+        return
+
+    active, parent, detached_at = link
+    saved = current(), getattr(_local, "stack", [])
+    _local.trace, _local.stack = active, [parent]
+    try:
+        with span(kind, name, wait_ms=round((time.perf_counter() - detached_at) * 1000, 3), **attrs) as opened:
+            yield opened
+    finally:
+        _local.trace, _local.stack = saved
+
+
+def release(link):
+    """Done with a detached link"""
+    if link is not None:
+        _release(link[0])
+
+
+def _release(active):
+    with active.lock:
+        active.pending -= 1
+        if active.pending:
+            return
+    _finish(active)
+
+
+def _finish(active):
+    path = settings["path"]
+    duration_ms = active.duration * 1000
+    if path is None or (duration_ms < settings["slow_ms"] and active.error is None):
+        return
+    if active.error is None and random.random() >= settings["sample"]:
+        return
+
+    for item in active.spans:
+        for key, value in item.pop("payloads", {}).items():
+            item[key] = payload_size(value)
+
+    record = {
+        "trace_id": active.trace_id,
+        "name": active.name,
+        "started_at": round(active.started_at, 3),
+        "duration_ms": round(duration_ms, 3),
+        "complete_ms": active.offset_ms(),
+        "attrs": active.attrs,
+        "spans": active.spans,
+    }
+    if active.error is not None:
+        record["error"] = active.error
+    if active.dropped:
+        record["dropped_spans"] = active.dropped
+
+    line = json.dumps(record, default=str, ensure_ascii=False) + "\n"
+    try:
+        with _write_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+    except OSError as e:
+        logger.warning("Could not write trace to %s: %s", path, e)
+
+
+# ========================
+# SUMMARY
+# ========================
+def load(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _quantile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0
+
+
+def summarize(traces, top=10):
+    """Text report: trace names by p95, where their time goes, and the slowest traces"""
+    by_name = {}
+    for record in traces:
+        by_name.setdefault(record["name"], []).append(record)
+
+    lines = [f"{len(traces)} traces\n", f"{'trace':<34} {'n':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"]
+    ranked = sorted(by_name.items(), key=lambda item: -_quantile([t["duration_ms"] for t in item[1]], 0.95))
+    for name, records in ranked:
+        durations = [record["duration_ms"] for record in records]
+        lines.append(f"{name[:34]:<34} {len(records):>6} {_quantile(durations, 0.5):>9.1f} "
+                     f"{_quantile(durations, 0.95):>9.1f} {max(durations):>9.1f}")
+
+    for name, records in ranked[:top]:
+        spans = {}
+        for record in records:
+            # Spans under an outbox send ran after the handler returned
+            detached = set()
+            for item in record["spans"]:
+                if item["kind"] == "outbox" or item["parent"] in detached:
+                    detached.add(item["id"])
+                spans.setdefault((item["kind"], item["name"]), []).append((item, item["id"] not in detached))
+
+        total = sum(record["duration_ms"] for record in records)
+        lines.append(f"\n{name}: spans per trace (share = inline time / handler time)")
+        lines.append(f"  {'span':<36} {'calls':>6} {'avg ms':>8} {'p95 ms':>8} {'share':>6} {'bytes':>8}")
+        rows = sorted(spans.items(), key=lambda item: -sum(span.get("ms", 0) for span, _ in item[1]))
+        for (kind, span_name), items in rows[:top]:
+            spent = [item.get("ms", 0) for item, _ in items]
+            inline = sum(item.get("ms", 0) for item, is_inline in items if is_inline)
+            size = sum((item.get("sent_bytes") or 0) + (item.get("received_bytes") or 0) for item, _ in items)
+            lines.append(f"  {kind + ' ' + span_name:<36.36} {len(items) / len(records):>6.1f} "
+                         f"{sum(spent) / len(items):>8.1f} {_quantile(spent, 0.95):>8.1f} "
+                         f"{inline / total if total else 0:>6.0%} {size / len(items):>8.0f}")
+
+    lines.append(f"\nslowest {top} traces")
+    for record in sorted(traces, key=lambda t: -t["duration_ms"])[:top]:
+        attrs = " ".join(f"{key}={value}" for key, value in record["attrs"].items() if value not in ("", None))
+        lines.append(f"\n{record['duration_ms']:.1f} ms (complete {record['complete_ms']:.1f} ms) {record['name']} "
+                     f"{attrs} [{record['trace_id']}]" + (f" ❌ {record['error']}" if record.get("error") else ""))
+        depth = {0: 0}
+        for item in record["spans"]:
+            depth[item["id"]] = depth.get(item["parent"], 0) + 1
+            size = item.get("sent_bytes") or item.get("received_bytes")
+            # Storage spans are named by tree; the waterfall shows the full path
+            name = f"{item['name'].split()[0]} {item['path']}" if item.get("path") else item["name"]
+            lines.append(f"  {item['start_ms']:>9.1f} +{item.get('ms', 0):>8.1f} ms "
+                         f"{'  ' * (depth[item['id']] - 1)}{item['kind']} {name}"
+                         + (f" wait {item['wait_ms']:.1f} ms" if "wait_ms" in item else "")
+                         + (f" {size} B" if size else "")
+                         + (f" ❌ {item['error']}" if "error" in item else ""))
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Summarize slow traces written by the bot")
+    parser.add_argument("file", nargs="?", default="traces.jsonl")
+    parser.add_argument("--top", type=int, default=10, help="trace names, spans and slowest traces to show")
+    parser.add_argument("--name", help="only traces whose name starts with this")
+    args = parser.parse_args()
+
+    traces = [record for record in load(args.file) if not args.name or record["name"].startswith(args.name)]
+    print(summarize(traces, args.top) if traces else "no traces")
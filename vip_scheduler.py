@@ -0,0 +1,155 @@
+"""
+VIP expiry scheduler: wakes up exactly when the next subscription ends
+
+Index entries due within the next reload window are read from vip_expiry
+into an in-process min-heap, so the work per wake-up is proportional to
+the users expiring, not to the user count. Users get an "expiring soon"
+message VIP_WARN_DAYS ahead and an "expired" one when VIP is turned off.
+"""
+
+import heapq
+import logging
+import threading
+import time
+
+from database import VIP_EXPIRED_MESSAGE, VIP_WARN_DAYS, expire_vip, get_expiring, warn_vip_expiry
+
+logger = logging.getLogger(__name__)
+
+# Re-read the index this often; entries due before the next read are queued
+RELOAD_EVERY = 3600
+RETRY_AFTER = 60
+# A failed event is retried after this, doubling per failure up to EVENT_RETRY_MAX
+EVENT_RETRY_AFTER = 10
+EVENT_RETRY_MAX = 600
+
+WARN, EXPIRE = 0, 1
+
+
+class ExpiryScheduler:
+    """Background thread that warns and expires VIP users on time"""
+
+    def __init__(self, outbox=None, warn_days=VIP_WARN_DAYS, reload_every=RELOAD_EVERY, page_size=500):
+        self.outbox = outbox
+        self.warn_seconds = warn_days * 24 * 60 * 60
+        self.reload_every = reload_every
+        self.page_size = page_size
+
+        self.heap = []
+        self.queued = set()
+        self.failures = {}
+        self.horizon = 0
+        self.next_reload = 0
+        self.wakeup = threading.Condition()
+        self.stopping = False
+        self.thread = None
+        self.stats = {"reloads": 0, "loaded": 0, "warned": 0, "expired": 0, "retried": 0}
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="vip-expiry", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.wakeup:
+            self.stopping = True
+            self.wakeup.notify()
+
+    def schedule(self, user_id, expiry, warned=False):
+        """Queue one subscription end (ignored past the loaded window; the next reload gets it)"""
+        expiry = int(expiry)
+        if expiry > self.horizon:
+            return
+
+        with self.wakeup:
+            if not warned:
+                self._push(expiry - self.warn_seconds, WARN, str(user_id), expiry)
+            self._push(expiry, EXPIRE, str(user_id), expiry)
+            self.wakeup.notify()
+
+    def _push(self, at, kind, user_id, expiry):
+        if (kind, user_id, expiry) not in self.queued:
+            self.queued.add((kind, user_id, expiry))
+            heapq.heappush(self.heap, (at, kind, user_id, expiry))
+
+    def reload(self):
+        """Queue every index entry that needs action before the next reload"""
+        now = time.time()
+        self.horizon = int(now + self.warn_seconds + self.reload_every)
+        cursor = None
+
+        while True:
+            page = get_expiring(self.horizon, limit=self.page_size, cursor=cursor)
+            for entry in page["items"].values():
+                self.schedule(entry["user_id"], entry["expiry"], warned=entry.get("warned", False))
+                self.stats["loaded"] += 1
+
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        self.next_reload = now + self.reload_every
+        self.stats["reloads"] += 1
+
+    def run_due(self):
+        """Handle every event that is due, returns how many ran"""
+        ran = 0
+        while True:
+            with self.wakeup:
+                if not self.heap or self.heap[0][0] > time.time():
+                    return ran
+                _, kind, user_id, expiry = heapq.heappop(self.heap)
+                self.queued.discard((kind, user_id, expiry))
+
+            try:
+                if kind == WARN:
+                    # Too late to warn once it has already ended
+                    message = warn_vip_expiry(user_id, expiry) if expiry > time.time() else None
+                    if message:
+                        self.stats["warned"] += 1
+                        self._send(user_id, message)
+                elif expire_vip(user_id, expiry):
+                    self.stats["expired"] += 1
+                    self._send(user_id, VIP_EXPIRED_MESSAGE)
+            except Exception:
+                logger.exception("VIP expiry event for %s failed", user_id)
+                self._retry(kind, user_id, expiry)
+            else:
+                self.failures.pop((kind, user_id, expiry), None)
+            ran += 1
+
+    def _retry(self, kind, user_id, expiry):
+        """Queue a failed event again after a backoff instead of waiting for the next reload"""
+        event = (kind, user_id, expiry)
+        failures = self.failures.get(event, 0)
+        self.failures[event] = failures + 1
+        delay = min(EVENT_RETRY_AFTER * 2 ** failures, EVENT_RETRY_MAX)
+
+        with self.wakeup:
+            self._push(time.time() + delay, kind, user_id, expiry)
+        self.stats["retried"] += 1
+
+    def _send(self, user_id, text):
+        if self.outbox is not None:
+            self.outbox.send_message(user_id, text)
+
+    def _run(self):
+        while True:
+            with self.wakeup:
+                if self.stopping:
+                    return
+
+            try:
+                if time.time() >= self.next_reload:
+                    self.reload()
+                self.run_due()
+            except Exception:
+                logger.exception("VIP expiry scheduler failed")
+                self.next_reload = time.time() + RETRY_AFTER
+
+            with self.wakeup:
+                wake_at = self.next_reload
+                if self.heap:
+                    wake_at = min(wake_at, self.heap[0][0])
+                if not self.stopping:
+                    self.wakeup.wait(max(0.0, wake_at - time.time()))
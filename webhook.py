@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Webhook ingestion: acknowledge Telegram updates at once, process them from a bounded queue
+"""
+
+import json
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """Local HTTP endpoint that feeds Telegram updates to a worker pool
+
+    POSTs are answered as soon as the update is queued. When the queue is
+    full the update is refused with 429, and Telegram redelivers it later,
+    so a burst backs up at Telegram instead of in our memory. GET
+    {path}/metrics needs the same secret token header; without a secret
+    token it is not served (use the localhost MetricsServer instead).
+    """
+
+    def __init__(self, process_update, host="127.0.0.1", port=8443, path="/telegram",
+                 queue_size=1000, workers=32, secret_token=None, sample_size=1000):
+        self.process_update = process_update
+        self.path = path
+        self.secret_token = secret_token
+        self.workers = workers
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stats = {"received": 0, "processed": 0, "rejected": 0, "errors": 0, "max_depth": 0}
+        self.waits = deque(maxlen=sample_size)
+        self.threads = []
+        self.running = True
+
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}{self.path}"
+
+    def start(self):
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"webhook-{number}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+        thread = threading.Thread(target=self.server.serve_forever, name="webhook-http", daemon=True)
+        thread.start()
+        self.threads.append(thread)
+        return self
+
+    def stop(self, drain=True):
+        """Stop accepting updates; with drain, finish the queued ones first"""
+        self.server.shutdown()
+        self.server.server_close()
+        if drain:
+            self.queue.join()
+        self.running = False
+
+    # ========================
+    # METRICS
+    # ========================
+    def metrics(self):
+        """Queue depth, counters and time-in-queue (ms) over recent updates"""
+        with self.lock:
+            waits = sorted(self.waits)
+            stats = dict(self.stats)
+
+        stats["depth"] = self.queue.qsize()
+        stats["capacity"] = self.queue.maxsize
+        if waits:
+            stats["wait_ms"] = {
+                "avg": round(sum(waits) / len(waits) * 1000, 2),
+                "p50": round(waits[len(waits) // 2] * 1000, 2),
+                "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))] * 1000, 2),
+                "max": round(waits[-1] * 1000, 2)
+            }
+        return stats
+
+    def _count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    # ========================
+    # QUEUE
+    # ========================
+    def submit(self, update):
+        """Queue a decoded update; False if the queue is full"""
+        try:
+            self.queue.put_nowait((time.monotonic(), update))
+        except queue.Full:
+            self._count("rejected")
+            return False
+
+        depth = self.queue.qsize()
+        with self.lock:
+            self.stats["received"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], depth)
+        return True
+
+    def _work(self):
+        while self.running:
+            try:
+                queued_at, update = self.queue.get(timeout=0.5)
+            except queue.Empty:
+                continue
+
+            with self.lock:
+                self.waits.append(time.monotonic() - queued_at)
+
+            try:
+                self.process_update(update)
+                self._count("processed")
+            except Exception:
+                self._count("errors")
+                logger.exception("Webhook update failed")
+            finally:
+                self.queue.task_done()
+
+    # ========================
+    # HTTP
+    # ========================
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, status, payload=b""):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _authorized(self):
+                return self.headers.get("X-Telegram-Bot-Api-Secret-Token") == server.secret_token
+
+            def do_GET(self):
+                if self.path != server.path + "/metrics" or not server.secret_token:
+                    return self._reply(404)
+                if not self._authorized():
+                    return self._reply(403)
+                self._reply(200, json.dumps(server.metrics()).encode())
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length)
+
+                if self.path != server.path:
+                    return self._reply(404)
+                if server.secret_token and not self._authorized():
+                    return self._reply(403)
+
+                try:
+                    update = json.loads(body)
+                except ValueError:
+                    return self._reply(400)
+
+                self._reply(200 if server.submit(update) else 429)
+
+        return Handler
+
+
+# ========================
+# LOCAL TESTING
+# ========================
+def post_updates(url, updates, secret_token=None):
+    """POST recorded updates to a webhook; returns status code counts"""
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret_token} if secret_token else {}
+    statuses = {}
+
+    with requests.Session() as session:
+        for update in updates:
+            status = session.post(url, json=update, headers=headers, timeout=10).status_code
+            statuses[status] = statuses.get(status, 0) + 1
+
+    return statuses
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="POST recorded updates (JSON lines) to a local webhook")
+    parser.add_argument("url", help="e.g. http://127.0.0.1:8443/telegram")
+    parser.add_argument("file", help="file with one Telegram update per line")
+    parser.add_argument("--secret-token")
+    args = parser.parse_args()
+
+    with open(args.file) as f:
+        recorded = [json.loads(line) for line in f if line.strip()]
+
+    print(f"📨 {post_updates(args.url, recorded, args.secret_token)}")
+    if args.secret_token:
+        headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret_token}
+        print(f"📊 {requests.get(args.url + '/metrics', headers=headers, timeout=10).json()}")